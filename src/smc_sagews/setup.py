@@ -26,4 +26,6 @@ setup(
     ],
     keywords='server mathematics cloud',
     test_suite='nose.collector',
-    tests_require=['nose'])
+    tests_require=['nose'],
+    # optional: the JSON codec tests for these are skipped if not installed
+    extras_require={'test': ['pytest', 'orjson', 'ujson']})
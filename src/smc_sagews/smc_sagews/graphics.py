@@ -21,7 +21,8 @@
 
 from __future__ import absolute_import
 
-import json, math
+import json, math, warnings
+import numpy
 from . import sage_salvus
 
 from uuid import uuid4
@@ -42,6 +43,125 @@ def json_float(t):
         return t
 
 
+# characters of the numbers in the vertex and face lines Sage writes
+_OBJ_FLOAT_CHARS = dict.fromkeys(map(ord, '0123456789.e+- '))
+_OBJ_INT_CHARS = dict.fromkeys(map(ord, '0123456789 '))
+
+
+def _numbers(s, dtype, chars):
+    """
+    Return the numbers in s, which are separated by single spaces, as a
+    numpy array, or None if s has other characters than chars in it.
+    """
+    if not s:
+        return numpy.zeros(0, dtype=dtype)
+    if s.translate(chars) or '  ' in s or s[0] == ' ' or s[-1] == ' ':
+        return None
+    with warnings.catch_warnings():
+        # depending on the version, numpy raises an error or warns about
+        # data it can't parse, and stops there
+        warnings.simplefilter('ignore')
+        try:
+            a = numpy.fromstring(s, dtype=dtype, sep=' ')
+        except ValueError:
+            return None
+    if a.size != s.count(' ') + 1:
+        return None
+    return a
+
+
+def parse_obj_geometry(obj):
+    """
+    Return the face geometry and the vertex coordinates (with None for nan
+    and infinity) in the OBJ text of an IndexFaceSet, for
+    graphics3d_to_jsonable.
+
+    The numbers are converted all at once with numpy.  Text that isn't
+    laid out the way Sage writes it is parsed by _parse_obj_geometry_slow
+    instead, which gives the same result.
+    """
+    lines = obj.split('\n')
+    vertices = '\n'.join([line for line in lines if 'v' in line])
+    others = [line for line in lines if 'v' not in line]
+    faces = '\n'.join([line for line in others if line[:2] == 'f '])
+    material_name = ''
+    for line in [line for line in others if line[:2] != 'f ']:
+        k = line.split()
+        if not k:
+            continue
+        if k[0] == 'f' or k[0] == 'usemtl' and len(k) < 2:
+            return _parse_obj_geometry_slow(obj)
+        if k[0] == 'usemtl':
+            material_name = k[1]
+    # every line with a v in it has to be a vertex
+    if vertices and (vertices[:2] != 'v ' or vertices.count('\nv ') !=
+                     vertices.count('\n')):
+        return _parse_obj_geometry_slow(obj)
+
+    a = _numbers(vertices[2:].replace('\nv ', ' '), float, _OBJ_FLOAT_CHARS)
+    f = _numbers(faces[2:].replace('\nf ', ' '), int, _OBJ_INT_CHARS)
+    if a is None or f is None:
+        return _parse_obj_geometry_slow(obj)
+    # the number of spaces in each face line is its number of vertices
+    b = numpy.frombuffer(faces.encode('ascii'), dtype=numpy.uint8)
+    spaces = numpy.concatenate(([0], numpy.cumsum(b == ord(' '))))
+    ends = numpy.append(numpy.flatnonzero(b == ord('\n')), len(b))
+    sizes = numpy.diff(numpy.concatenate(([0], spaces[ends]))) if faces else []
+    if f.size != numpy.sum(sizes):
+        return _parse_obj_geometry_slow(obj)
+
+    vertex_geometry = a.tolist()
+    finite = numpy.isfinite(a)
+    if not finite.all():
+        vertex_geometry = [
+            x if ok else None
+            for x, ok in zip(vertex_geometry, finite.tolist())
+        ]
+    # the faces of an IndexFaceSet are usually all triangles or all
+    # quadrilaterals
+    if not len(sizes):
+        faces = []
+    elif sizes.min() == sizes.max():
+        faces = f.reshape(-1, int(sizes[0])).tolist()
+    else:
+        f = f.tolist()
+        ends = numpy.cumsum(sizes).tolist()
+        faces = [f[i - n:i] for i, n in zip(ends, sizes.tolist())]
+    return [{
+        "material_name": material_name,
+        "faces": faces
+    }], vertex_geometry
+
+
+def _parse_obj_geometry_slow(obj):
+    # the line by line parser that parse_obj_geometry replaces
+    material_name = ''
+    faces = []
+    for item in obj.split("\n"):
+        tmp = str(item.strip())
+        if not tmp:
+            continue
+        k = tmp.split()
+        if k[0] == "usemtl":  # material name
+            material_name = k[1]
+        elif k[0] == 'f':  # face
+            v = [int(a) for a in k[1:]]
+            faces.append(v)
+    vertex_geometry = []
+    for item in obj.split("\n"):
+        if "v" in item:
+            tmp = str(item.strip())
+            for t in tmp.split():
+                try:
+                    vertex_geometry.append(json_float(t))
+                except ValueError:
+                    pass
+    return [{
+        "material_name": material_name,
+        "faces": faces
+    }], vertex_geometry
+
+
 #######################################################
 # Three.js based plotting
 #######################################################
@@ -230,23 +350,6 @@ def jsonable(x):
 def graphics3d_to_jsonable(p):
     obj_list = []
 
-    def parse_obj(obj):
-        material_name = ''
-        faces = []
-        for item in obj.split("\n"):
-            tmp = str(item.strip())
-            if not tmp:
-                continue
-            k = tmp.split()
-            if k[0] == "usemtl":  # material name
-                material_name = k[1]
-            elif k[0] == 'f':  # face
-                v = [int(a) for a in k[1:]]
-                faces.append(v)
-            # other types are parse elsewhere in a different pass.
-
-        return [{"material_name": material_name, "faces": faces}]
-
     def parse_texture(p):
         texture_dict = []
         textures = p.texture_set()
@@ -387,21 +490,11 @@ def graphics3d_to_jsonable(p):
     def convert_index_face_set(p, T, extra_kwds):
         if T is not None:
             p = p.transform(T=T)
-        face_geometry = parse_obj(p.obj())
         if hasattr(p, 'has_local_colors') and p.has_local_colors():
             convert_index_face_set_with_colors(p, T, extra_kwds)
             return
+        face_geometry, vertex_geometry = parse_obj_geometry(p.obj())
         material = parse_mtl(p)
-        vertex_geometry = []
-        obj = p.obj()
-        for item in obj.split("\n"):
-            if "v" in item:
-                tmp = str(item.strip())
-                for t in tmp.split():
-                    try:
-                        vertex_geometry.append(json_float(t))
-                    except ValueError:
-                        pass
         myobj = {
             "face_geometry": face_geometry,
             "type": 'index_face_set',
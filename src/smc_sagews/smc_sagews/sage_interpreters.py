@@ -0,0 +1,303 @@
+"""
+sage_interpreters.py
+
+Long-lived interpreter processes for the %perl and %ruby modes.
+
+Each interpreter runs a small driver loop that reads requests framed as
+"<number of bytes>\\n<code>" from its stdin, evaluates the code in the
+same top level scope as the previous requests, and writes a random token
+followed by a status digit and a newline when it is done.  Everything
+written before the token is output of the code, which is streamed back
+to the cell as it arrives.
+"""
+
+#########################################################################################
+#       Copyright (C) 2016, SageMath, Inc.                                              #
+#                                                                                       #
+#  Distributed under the terms of the GNU General Public License (GPL), version 2+      #
+#                                                                                       #
+#                  http://www.gnu.org/licenses/                                         #
+#########################################################################################
+
+from __future__ import absolute_import
+import codecs
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+from uuid import uuid4
+
+# The code is evaluated in a sub that is defined before any lexical
+# variables, so that it can't see (or change) those of the loop.
+PERL_DRIVER = r'''
+sub salvus_eval { package main; no strict; eval $_[0]; return $@; }
+binmode STDIN;
+select(STDERR); $| = 1; select(STDOUT); $| = 1;
+$SIG{INT} = sub { die "KeyboardInterrupt\n" };
+my $token = shift @ARGV;
+while (defined(my $n = <STDIN>)) {
+    my $code = '';
+    read(STDIN, $code, $n) == $n or last;
+    my $err = salvus_eval($code);
+    print STDERR $err if $err;
+    print $token . ($err ? 1 : 0) . "\n";
+}
+'''
+
+RUBY_DRIVER = r'''
+$stdout.sync = true
+$stderr.sync = true
+$stdin.binmode
+def salvus_loop(token)
+  while (n = $stdin.gets)
+    code = $stdin.read(n.to_i)
+    break if code.nil?
+    status = 0
+    begin
+      eval(code.force_encoding('UTF-8'), TOPLEVEL_BINDING, '(cell)', 1)
+    rescue SystemExit
+      raise
+    rescue Exception => e
+      $stderr.puts "#{e.class}: #{e.message}"
+      status = 1
+    end
+    $stdout.write("#{token}#{status}\n")
+  end
+end
+salvus_loop(ARGV[0])
+'''
+
+# name --> command line of the driver (the token is appended)
+DRIVERS = {
+    'perl': ['sage-native-execute', 'perl', '-e', PERL_DRIVER],
+    'ruby': ['sage-native-execute', 'ruby', '-e', RUBY_DRIVER],
+}
+
+
+def rss(pid):
+    """
+    Return the resident set size of the process pid in bytes, or 0 if it
+    is not known.
+    """
+    try:
+        with open('/proc/%s/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+class Interpreter(object):
+    """
+    A long-lived interpreter process running a driver loop (see DRIVERS).
+
+    INPUT:
+
+    - ``name`` -- name of the language, used in messages
+    - ``args`` -- command line of the driver
+    - ``max_rss`` -- (default: None) if given, the interpreter is stopped
+      as soon as its resident set size exceeds this many bytes
+    """
+    def __init__(self, name, args, max_rss=None):
+        self.name = name
+        self._args = args
+        self.max_rss = max_rss
+        self._proc = None
+        self.last_used = time.time()
+
+    def __repr__(self):
+        return "%s interpreter (%s)" % (self.name, "pid %s" % self._proc.pid
+                                        if self.running() else "not running")
+
+    def running(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self):
+        self.close()
+        token = uuid4().hex
+        self._marker = token.encode('ascii')
+        self._proc = subprocess.Popen(self._args + [token],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT,
+                                      close_fds=True)
+
+    def close(self):
+        """
+        Stop the interpreter; it is started again the next time it is used.
+        """
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        for f in [proc.stdin, proc.stdout]:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        if proc.poll() is None:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        proc.wait()
+
+    def __call__(self, code):
+        """
+        Evaluate code in the interpreter, writing its output to sys.stdout
+        as it arrives.  Returns True if the code raised no error.
+        """
+        if not self.running():
+            self.start()
+        data = code.encode('utf8')
+        try:
+            self._proc.stdin.write(('%s\n' % len(data)).encode('ascii') +
+                                   data)
+            self._proc.stdin.flush()
+        except (IOError, OSError):
+            # it exited since it was last used
+            self.start()
+            self._proc.stdin.write(('%s\n' % len(data)).encode('ascii') +
+                                   data)
+            self._proc.stdin.flush()
+        try:
+            return self._read(sys.stdout)
+        except KeyboardInterrupt:
+            self._interrupt()
+            raise
+        finally:
+            self.last_used = time.time()
+
+    def _read(self, out, timeout=None):
+        """
+        Copy the output of the interpreter to out until the end of the
+        response, and return whether the code raised no error.  Returns
+        None if the end doesn't come within timeout seconds.
+        """
+        fd = self._proc.stdout.fileno()
+        decoder = codecs.getincrementaldecoder('utf8')('replace')
+        marker = self._marker
+        buf = b''
+        pending = False
+        deadline = None if timeout is None else time.time() + timeout
+        next_check = time.time() + 1
+        while True:
+            wait = .1 if deadline is None else min(.1, deadline - time.time())
+            if wait <= 0:
+                return None
+            if not select.select([fd], [], [], wait)[0]:
+                # output paused, so send what there is
+                if pending:
+                    out.flush()
+                    pending = False
+            else:
+                data = os.read(fd, 65536)
+                if not data:
+                    if buf:
+                        out.write(decoder.decode(buf, True))
+                    self.close()
+                    sys.stderr.write("\n%s exited; it will be restarted\n" %
+                                     self.name)
+                    return False
+                buf += data
+                i = buf.find(marker)
+                if i == -1:
+                    # the end of buf might be the start of the marker
+                    i = max(0, len(buf) - len(marker))
+                if i:
+                    out.write(decoder.decode(buf[:i]))
+                    buf = buf[i:]
+                    pending = True
+                if buf.startswith(marker) and b'\n' in buf:
+                    out.write(decoder.decode(b'', True))
+                    ok = buf[len(marker):len(marker) + 1] == b'0'
+                    return self._check_rss() and ok
+            if time.time() >= next_check:
+                next_check = time.time() + 1
+                if not self._check_rss():
+                    return False
+
+    def _check_rss(self):
+        # stop the interpreter if it uses too much memory
+        if self.max_rss and rss(self._proc.pid) > self.max_rss:
+            self.close()
+            sys.stderr.write(
+                "\n%s used more than %s MB of memory and was stopped; it will be restarted\n"
+                % (self.name, self.max_rss // 2**20))
+            return False
+        return True
+
+    def _interrupt(self):
+        # interrupt the code, and wait a little for the end of its output,
+        # so that the interpreter can be used again
+        if not self.running():
+            return
+        try:
+            os.kill(self._proc.pid, signal.SIGINT)
+            if self._read(sys.stdout, timeout=2) is None:
+                self.close()
+        except (Exception, KeyboardInterrupt):
+            self.close()
+
+
+class Interpreters(object):
+    """
+    The interpreters of a Sage session, one per language, each started the
+    first time it is used.
+
+    INPUT:
+
+    - ``idle_timeout`` -- (default: 1800) seconds after which an unused
+      interpreter is stopped (see close_idle)
+    - ``max_rss`` -- (default: None) max resident set size of each
+      interpreter in bytes
+    """
+    def __init__(self, idle_timeout=1800, max_rss=None):
+        self.idle_timeout = idle_timeout
+        self.max_rss = max_rss
+        self._interpreters = {}
+
+    def __getitem__(self, name):
+        if name not in self._interpreters:
+            self._interpreters[name] = Interpreter(name,
+                                                   DRIVERS[name],
+                                                   max_rss=self.max_rss)
+        return self._interpreters[name]
+
+    def __repr__(self):
+        return "Interpreters: %s" % sorted(
+            name for name, I in self._interpreters.items() if I.running())
+
+    def close(self, name=None):
+        """
+        Stop the interpreter for the given language, or all of them, losing
+        their state.
+        """
+        for n, I in list(self._interpreters.items()):
+            if name is None or n == name:
+                I.close()
+
+    def close_idle(self):
+        """
+        Stop the interpreters that have not been used for idle_timeout
+        seconds.  Returns the number of seconds until the next one of
+        those that are still running would be stopped, or None if none are.
+        """
+        now = time.time()
+        wait = None
+        for I in self._interpreters.values():
+            if not I.running():
+                continue
+            left = I.last_used + self.idle_timeout - now
+            if left <= 0:
+                I.close()
+            elif wait is None or left < wait:
+                wait = left
+        return wait
+
+
+interpreters = Interpreters(
+    idle_timeout=float(
+        os.environ.get('COCALC_SAGE_SERVER_INTERPRETER_IDLE_TIMEOUT', 1800)),
+    max_rss=int(os.environ.get('COCALC_SAGE_SERVER_INTERPRETER_MAX_RSS_MB',
+                               2000)) * 2**20 or None)
@@ -21,6 +21,7 @@ from __future__ import absolute_import
 import os
 import string
 import textwrap
+import time
 import six
 
 salvus = None  # set externally
@@ -40,8 +41,10 @@ class JUPYTER(object):
         '''
         Returns the list of available Jupyter kernels.
         '''
-        v = os.popen("jupyter kernelspec list").readlines()
-        return ''.join(x for x in v if not x.strip().startswith('sage'))
+        specs = kernels.kernelspecs()
+        return 'Available kernels:\n' + ''.join(
+            '  %-20s %s\n' % (name, specs[name]) for name in sorted(specs)
+            if not name.startswith('sage'))
 
     def _get_doc(self):
         ds0 = textwrap.dedent(r"""\
@@ -80,6 +83,15 @@ class JUPYTER(object):
             | p1('print(a)')   # prints 5
             | p2('print(a)')   # prints 10
 
+        By default, a kernel is only started when jupyter is called, which takes a few
+        seconds.  Starting kernels in advance is opt-in: set the environment variable
+        COCALC_SAGE_SERVER_JUPYTER_WARM to a comma separated list of kernel names, e.g.,
+        "python3,ir", before the Sage server starts, and a kernel of each of these names
+        is started while the worksheet is idle, so the next jupyter(name) is faster.
+        COCALC_SAGE_SERVER_JUPYTER_POOL_SIZE (default 0) is the number of spare kernels
+        kept ready for each name that was used, and kernels started in advance are
+        stopped if unused for COCALC_SAGE_SERVER_JUPYTER_IDLE_TIMEOUT seconds (default 600).
+
         For details on supported features and known issues, see the SMC Wiki page:
         https://github.com/sagemathinc/cocalc/wiki/sagejupyter
         """)
@@ -94,6 +106,180 @@ class JUPYTER(object):
 jupyter = JUPYTER()
 
 
+class KernelPool(object):
+    r"""
+    Start jupyter kernels for a Sage session.
+
+    All kernels share one kernel spec manager, whose kernel specs are looked
+    up only once, and one ZMQ context.  When the session is idle (see warm),
+    one kernel of each name in ``warm`` is started in advance, and so are up
+    to ``size`` more kernels of each name that was asked for.  The next
+    ``jupyter(name)`` then only has to wait for one of them to be ready,
+    instead of starting a new one.  Spare kernels are off by default
+    (``size=0``), since most names are asked for once per session, e.g., by
+    %r, %octave and %python3, which keep their kernel.  Nothing is started
+    in advance unless ``warm`` or ``size`` is set, see ``jupyter?``.
+
+    A kernel started in advance is only used if the session's working
+    directory is still the same as when it was started, since that is the
+    working directory of the kernel.  Kernels that are not used within
+    ``idle_timeout`` seconds are stopped (see close_idle), and not started
+    again until their name is asked for.
+    """
+    def __init__(self, size=0, warm=(), idle_timeout=600):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._warm = set(warm)
+        self._wanted = set(warm)
+        self._pool = {}  # kernel name --> list of (km, kc, cwd, started)
+        self._ksm = None
+        self._specs = None
+        self._context = None
+        self._atexit = False
+
+    def kernel_spec_manager(self):
+        if self._ksm is None:
+            from jupyter_client.kernelspec import KernelSpecManager
+            self._ksm = KernelSpecManager()
+        return self._ksm
+
+    def kernelspecs(self):
+        """
+        Return a dict mapping the names of the installed kernels to their
+        directories.
+        """
+        if self._specs is None:
+            self._specs = self.kernel_spec_manager().find_kernel_specs()
+        return self._specs
+
+    def _start(self, kernel_name):
+        # start a kernel, without waiting for it to be ready
+        import jupyter_client  # TIMING: takes a bit of time
+        import zmq
+        import warnings
+        if self._context is None:
+            self._context = zmq.Context.instance()
+        if not self._atexit:
+            import atexit
+            atexit.register(self.shutdown)
+            self._atexit = True
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            km = jupyter_client.KernelManager(
+                kernel_name=kernel_name,
+                kernel_spec_manager=self.kernel_spec_manager(),
+                context=self._context)
+            km.start_kernel()
+            import sage.interfaces.cleaner
+            sage.interfaces.cleaner.cleaner(km.kernel.pid, "km.kernel.pid")
+            kc = km.client()
+            kc.start_channels()
+        return km, kc, os.getcwd()
+
+    def _stop(self, km, kc):
+        try:
+            kc.stop_channels()
+            km.shutdown_kernel(now=True)
+        except Exception:
+            pass
+
+    def get(self, kernel_name):
+        """
+        Return (km, kc), the manager and client of a kernel of the given
+        name, which is ready to execute code.
+        """
+        self._wanted.add(kernel_name)
+        pool = self._pool.get(kernel_name, [])
+        km = None
+        while pool and km is None:
+            km, kc, cwd, _ = pool.pop(0)
+            if cwd != os.getcwd() or not km.is_alive():
+                self._stop(km, kc)
+                km = None
+        if km is None:
+            km, kc, _ = self._start(kernel_name)
+        try:
+            kc.wait_for_ready(timeout=60)
+        except RuntimeError:
+            self._stop(km, kc)
+            raise
+        return km, kc
+
+    def warm(self):
+        """
+        Start one kernel that is to be kept ready, if any is missing.
+        Returns whether one was started.
+        """
+        for kernel_name in sorted(self._wanted):
+            pool = self._pool.setdefault(kernel_name, [])
+            size = self.size
+            if kernel_name in self._warm:
+                size = max(1, size)
+            if len(pool) < size:
+                try:
+                    pool.append(self._start(kernel_name) + (time.time(), ))
+                except Exception:
+                    # e.g., not installed -- don't try again
+                    self._wanted.discard(kernel_name)
+                return True
+        return False
+
+    def close_idle(self):
+        """
+        Stop the kernels started in advance that have not been used for
+        idle_timeout seconds.  Returns the number of seconds until the next
+        one of those that are still running would be stopped, or None if
+        none are.
+        """
+        now = time.time()
+        wait = None
+        for kernel_name, pool in self._pool.items():
+            for entry in list(pool):
+                left = entry[3] + self.idle_timeout - now
+                if left <= 0:
+                    pool.remove(entry)
+                    self._stop(entry[0], entry[1])
+                    # don't start another one right away
+                    self._wanted.discard(kernel_name)
+                    self._warm.discard(kernel_name)
+                elif wait is None or left < wait:
+                    wait = left
+        return wait
+
+    def shutdown(self):
+        """
+        Stop the kernels that were started in advance.
+        """
+        for pool in self._pool.values():
+            while pool:
+                km, kc, _, _ = pool.pop()
+                self._stop(km, kc)
+
+
+kernels = KernelPool(
+    size=int(os.environ.get('COCALC_SAGE_SERVER_JUPYTER_POOL_SIZE', 0)),
+    warm=[
+        name for name in os.environ.get('COCALC_SAGE_SERVER_JUPYTER_WARM',
+                                        '').split(',') if name
+    ],
+    idle_timeout=float(
+        os.environ.get('COCALC_SAGE_SERVER_JUPYTER_IDLE_TIMEOUT', 600)))
+
+# converter of ANSI color codes to html, created when first needed
+_ansi2html = None
+
+
+def ansi2html(s):
+    global _ansi2html
+    if _ansi2html is None:
+        from ansi2html import Ansi2HTMLConverter  # TIMING: this is surprisingly bad.
+        # inline: no header or style tags, useful for full == False
+        # linkify: little gimmik, translates URLs to anchor tags
+        _ansi2html = Ansi2HTMLConverter(inline=True, linkify=True)
+    # `full = False` or else cell output is huge
+    return _ansi2html.convert(s, full=False)
+
+
 def _jkmagic(kernel_name, **kwargs):
     r"""
     Called when user issues `my_kernel = jupyter("kernel_name")` from a cell, not intended to be called directly by user.
@@ -106,28 +292,14 @@ def _jkmagic(kernel_name, **kwargs):
     -  ``kernel_name`` -- name of kernel as it appears in output of `jupyter kernelspec list`
 
     """
-    # CRITICAL: We import these here rather than at module scope, since they can take nearly a second
-    # i CPU time to import.
-    import jupyter_client  # TIMING: takes a bit of time
-    from ansi2html import Ansi2HTMLConverter  # TIMING: this is surprisingly bad.
     from six.moves.queue import Empty  # TIMING: cheap
     import base64, tempfile, sys, re  # TIMING: cheap
 
-    import warnings
     import sage.misc.latex
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", DeprecationWarning)
-        km, kc = jupyter_client.manager.start_new_kernel(
-            kernel_name=kernel_name)
-        import sage.interfaces.cleaner
-        sage.interfaces.cleaner.cleaner(km.kernel.pid, "km.kernel.pid")
-        import atexit
-        atexit.register(km.shutdown_kernel)
-        atexit.register(kc.hb_channel.close)
-
-    # inline: no header or style tags, useful for full == False
-    # linkify: little gimmik, translates URLs to anchor tags
-    conv = Ansi2HTMLConverter(inline=True, linkify=True)
+    km, kc = kernels.get(kernel_name)
+    import atexit
+    atexit.register(km.shutdown_kernel)
+    atexit.register(kc.hb_channel.close)
 
     def hout(s, block=True, scroll=False, error=False):
         r"""
@@ -143,10 +315,9 @@ def _jkmagic(kernel_name, **kwargs):
 
         -  ``error`` - set true to send text output to stderr
         """
-        # `full = False` or else cell output is huge
         if "\x1b[" in s:
             # use html output if ansi control code found in string
-            h = conv.convert(s, full=False)
+            h = ansi2html(s)
             if block:
                 h2 = '<pre style="font-family:monospace;">' + h + '</pre>'
             else:
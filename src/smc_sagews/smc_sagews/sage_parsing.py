@@ -13,7 +13,11 @@ Code for parsing Sage code blocks sensibly.
 #########################################################################################
 
 from __future__ import absolute_import
+import collections
+import hashlib
+import re
 import string
+import sys
 import traceback
 import __future__ as future
 import ast
@@ -97,10 +101,23 @@ def preparse_code(code):
     return sage.all_cmdline.preparse(code, ignore_prompts=True)
 
 
-def strip_string_literals(code, state=None):
-    new_code = []
-    literals = {}
-    counter = 0
+# the next quote or comment, outside of a string literal
+_LITERAL_START = re.compile('[\'"#]')
+# the next quote, inside of a string literal
+_QUOTE = re.compile('[\'"]')
+
+
+def scan_literals(code, state=None):
+    """
+    Find the string literals and comments in code in a single pass.
+
+    Returns a list of (start, stop, kind) spans with kind 'string' or
+    'comment', in order, and the state at the end of the code, which
+    can be passed back in to continue scanning more code.  A string
+    literal that is not closed extends to the end of the code.
+    """
+    spans = []
+    n = len(code)
     start = q = 0
     if state is None:
         in_quote = False
@@ -108,31 +125,12 @@ def strip_string_literals(code, state=None):
     else:
         in_quote, raw = state
     while True:
-        sig_q = code.find("'", q)
-        dbl_q = code.find('"', q)
-        hash_q = code.find('#', q)
-        q = min(sig_q, dbl_q)
-        if q == -1: q = max(sig_q, dbl_q)
-        if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
-            # it's a comment
-            newline = code.find('\n', hash_q)
-            if newline == -1: newline = len(code)
-            counter += 1
-            label = "L%s" % counter
-            literals[label] = code[hash_q:newline]
-            new_code.append(code[start:hash_q].replace('%', '%%'))
-            new_code.append("%%(%s)s" % label)
-            start = q = newline
-        elif q == -1:
-            if in_quote:
-                counter += 1
-                label = "L%s" % counter
-                literals[label] = code[start:]
-                new_code.append("%%(%s)s" % label)
-            else:
-                new_code.append(code[start:].replace('%', '%%'))
-            break
-        elif in_quote:
+        if in_quote:
+            m = _QUOTE.search(code, q)
+            if m is None:
+                spans.append((start, n, 'string'))
+                break
+            q = m.start()
             if code[q - 1] == '\\':
                 k = 2
                 while code[q - k] == '\\':
@@ -140,26 +138,91 @@ def strip_string_literals(code, state=None):
                 if k % 2 == 0:
                     q += 1
             if code[q:q + len(in_quote)] == in_quote:
-                counter += 1
-                label = "L%s" % counter
-                literals[label] = code[start:q + len(in_quote)]
-                new_code.append("%%(%s)s" % label)
                 q += len(in_quote)
+                spans.append((start, q, 'string'))
                 start = q
                 in_quote = False
             else:
                 q += 1
         else:
-            raw = q > 0 and code[q - 1] in 'rR'
-            if len(code) >= q + 3 and (code[q + 1] == code[q] == code[q + 2]):
-                in_quote = code[q] * 3
+            m = _LITERAL_START.search(code, q)
+            if m is None:
+                break
+            q = m.start()
+            if code[q] == '#':
+                newline = code.find('\n', q)
+                if newline == -1:
+                    newline = n
+                spans.append((q, newline, 'comment'))
+                start = q = newline
             else:
-                in_quote = code[q]
-            new_code.append(code[start:q].replace('%', '%%'))
-            start = q
-            q += len(in_quote)
+                raw = q > 0 and code[q - 1] in 'rR'
+                if n >= q + 3 and (code[q + 1] == code[q] == code[q + 2]):
+                    in_quote = code[q] * 3
+                else:
+                    in_quote = code[q]
+                start = q
+                q += len(in_quote)
+    return spans, (in_quote, raw)
 
-    return "".join(new_code), literals, (in_quote, raw)
+
+def mask_literals(code, spans):
+    """
+    Return code with the spans found by scan_literals blanked out: the
+    characters of string literals become \\x01 and comments become # followed
+    by \\x01's.  The result has the same length and the same lines (outside
+    of literals) as code, but brackets, quotes, etc., in literals can't
+    confuse any further parsing.
+    """
+    v = []
+    i = 0
+    for start, stop, kind in spans:
+        v.append(code[i:start])
+        if kind == 'comment':
+            v.append('#' + '\x01' * (stop - start - 1))
+        else:
+            v.append('\x01' * (stop - start))
+        i = stop
+    v.append(code[i:])
+    return ''.join(v)
+
+
+def strip_string_literals(code, state=None):
+    """
+    Replace the string literals and comments in code by %(L1)s, %(L2)s, ...
+    (and % by %%), so that code % literals is the original code.
+
+    Returns the new code, the literals dictionary and the state (see
+    scan_literals).
+    """
+    spans, state = scan_literals(code, state)
+    new_code = []
+    literals = {}
+    i = 0
+    for counter, (start, stop, kind) in enumerate(spans, 1):
+        label = "L%s" % counter
+        literals[label] = code[start:stop]
+        new_code.append(code[i:start].replace('%', '%%'))
+        new_code.append("%%(%s)s" % label)
+        i = stop
+    new_code.append(code[i:].replace('%', '%%'))
+    return "".join(new_code), literals, state
+
+
+def split_lines(code):
+    """
+    Split code into lines, like code.splitlines(), but never inside of a
+    string literal or comment.  Returns a list of pairs (masked, line),
+    where line is a line of code and masked is the same line with its
+    literals blanked out as by mask_literals.
+    """
+    masked = mask_literals(code, scan_literals(code)[0])
+    v = []
+    i = 0
+    for x, y in zip(masked.splitlines(), masked.splitlines(True)):
+        v.append((x, code[i:i + len(x)]))
+        i += len(y)
+    return v
 
 
 def end_of_expr(s):
@@ -189,61 +252,102 @@ def end_of_expr(s):
     return i
 
 
-# NOTE/TODO: The dec_args dict will leak memory over time.  However, it only
-# contains code that was entered, so it should never get big.  It
-# seems impossible to know for sure whether a bit of code will be
-# eventually needed later, so this leakiness seems necessary.
-dec_counter = 0
+# The arguments of the salvus.execute_with_code_decorators calls that
+# divide_into_blocks puts in place of code decorator lines, keyed on a hash
+# of their content, so the same cell always gives the same blocks and
+# shares them.  They are reference counted: divide_into_blocks takes a
+# reference to each one it uses, and whoever executes the blocks gives them
+# back with release_dec_args when done.
 dec_args = {}
+dec_refs = {}
 
 
-# Divide the input code (a string) into blocks of code.
-def divide_into_blocks(code):
-    global dec_counter
+def retain_dec_args(keys):
+    """
+    Take another reference to each of the dec_args entries in keys.
+    """
+    for key in keys:
+        dec_refs[key] += 1
+
+
+def release_dec_args(keys):
+    """
+    Give back a reference to each of the dec_args entries in keys, and
+    delete the entries that are no longer referenced.
+    """
+    for key in keys:
+        refs = dec_refs[key] - 1
+        if refs:
+            dec_refs[key] = refs
+        else:
+            del dec_refs[key]
+            del dec_args[key]
+
+
+def _dec_args_ref(args):
+    """
+    Store args in dec_args, unless they are already there, and take a
+    reference to them.  Returns their key.
+    """
+    decorators, expr = args
+    s = '\x00'.join(decorators + [expr])
+    if isinstance(s, six.text_type):
+        s = s.encode('utf8')
+    key = hashlib.sha1(s).hexdigest()
+    if key in dec_refs:
+        dec_refs[key] += 1
+    else:
+        dec_args[key] = args
+        dec_refs[key] = 1
+    return key
+
 
-    # strip string literals from the input, so that we can parse it without having to worry about strings
-    code, literals, state = strip_string_literals(code)
+# Divide the input code (a string) into blocks of code.  The keys of the
+# dec_args entries the blocks use are appended to dec_keys, if given; they
+# must be released with release_dec_args once the blocks are executed.
+def divide_into_blocks(code, dec_keys=None):
+    if dec_keys is None:
+        dec_keys = []
 
-    # divide the code up into line lines.
-    code = code.splitlines()
+    # divide the code up into lines, with string literals and comments
+    # blanked out, so that we can parse it without having to worry about them
+    code = split_lines(code)
 
     # Compute the line-level code decorators.
     c = list(code)
     try:
         v = []
-        for line in code:
+        for k, (masked, line) in enumerate(code):
             done = False
 
             # Transform shell escape into sh decorator.
-            if line.lstrip().startswith('!'):
-                line = line.replace('!', "%%sh ", 1)
+            if masked.lstrip().startswith('!'):
+                i = masked.find('!')
+                masked = masked[:i] + '%sh ' + masked[i + 1:]
+                line = line[:i] + '%sh ' + line[i + 1:]
 
             # Check for cell decorator
-            # NOTE: strip_string_literals maps % to %%, because %foo is used for python string templating.
-            if line.lstrip().startswith('%%'):
-                i = line.find("%")
+            if masked.lstrip().startswith('%'):
+                i = masked.find("%")
                 j = end_of_expr(
-                    line[i +
-                         2:]) + i + 2 + 1  # +1 for the space or tab delimiter
-                expr = line[j:] % literals
+                    masked[i +
+                           1:]) + i + 1 + 1  # +1 for the space or tab delimiter
+                expr = line[j:]
                 # Special case -- if % starts line *and* expr is empty (or a comment),
                 # then code decorators impacts the rest of the code.
                 sexpr = expr.strip()
                 if i == 0 and (len(sexpr) == 0 or sexpr.startswith('#')):
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
-                        line[:i], dec_counter)
-                    expr = ('\n'.join(code[len(v) + 1:])) % literals
+                    expr = '\n'.join(x[1] for x in code[k + 1:])
                     done = True
-                else:
-                    # Expr is nonempty -- code decorator only impacts this line
-                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
-                        line[:i], dec_counter)
+                # otherwise, expr is nonempty -- code decorator only impacts this line
 
-                dec_args[dec_counter] = ([line[i + 2:j] % literals], expr)
-                dec_counter += 1
+                key = _dec_args_ref(([line[i + 1:j]], expr))
+                dec_keys.append(key)
+                new_line = "%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args['%s'])" % (
+                    line[:i], key)
+                v.append((new_line, new_line))
             else:
-                new_line = line
-            v.append(new_line)
+                v.append((masked, line))
             if done:
                 break
         code = v
@@ -253,85 +357,497 @@ def divide_into_blocks(code):
     ## Tested this: Completely disable block parsing:
     ## but it requires the caller to do "exec compile(block+'\n', '', 'exec') in namespace, locals", which means no display hook,
     ## so "2+2" breaks.
-    ## return [[0,len(code)-1,('\n'.join(code))%literals]]
+    ## return [[0,len(code)-1,'\n'.join(x[1] for x in code)]]
 
     # Remove comment lines -- otherwise could get empty blocks that can't be exec'd.
     # For example, exec compile('#', '', 'single') is a syntax error.
     # Also, comments will confuse the code to break into blocks before.
-    comment_lines = {}
-    for label, v in literals.items():
-        if v.startswith('#'):
-            comment_lines["%%(%s)s" % label] = True
-    code = [x for x in code if not comment_lines.get(x.strip(), False)]
+    # Also take only non-whitespace lines now for Python code.
+    code = [
+        x for x in code if x[0].strip() and not x[0].lstrip().startswith('#')
+    ]
+
+    # Compute the blocks, walking back from the end of the code.  A block
+    # that ends at line stop starts at the last unindented line i <= stop
+    # such that none of the brackets in lines i..stop are left unopened,
+    # i.e., such that depth[i] <= depth[stop+1] for each kind of bracket,
+    # where depth[k] is the bracket depth before line k.
+    n = len(code)
+    paren = [0] * (n + 1)
+    brack = [0] * (n + 1)
+    curly = [0] * (n + 1)
+    # unindented[k] = the last unindented line <= k, or -1
+    unindented = [-1] * n
+    last = -1
+    for k, (masked, line) in enumerate(code):
+        paren[k + 1] = paren[k] + masked.count('(') - masked.count(')')
+        brack[k + 1] = brack[k] + masked.count('[') - masked.count(']')
+        curly[k + 1] = curly[k] + masked.count('{') - masked.count('}')
+        if masked[0] not in string.whitespace:
+            last = k
+        unindented[k] = last
 
-    # take only non-whitespace lines now for Python code (string literals have already been removed).
-    code = [x for x in code if x.strip()]
-
-    # Compute the blocks
-    i = len(code) - 1
     blocks = []
-    while i >= 0:
-        stop = i
-        paren_depth = code[i].count('(') - code[i].count(')')
-        brack_depth = code[i].count('[') - code[i].count(']')
-        curly_depth = code[i].count('{') - code[i].count('}')
-        while i >= 0 and (
-            (len(code[i]) > 0 and (code[i][0] in string.whitespace))
-                or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
-            i -= 1
-            if i >= 0:
-                paren_depth += code[i].count('(') - code[i].count(')')
-                brack_depth += code[i].count('[') - code[i].count(']')
-                curly_depth += code[i].count('{') - code[i].count('}')
-        block = ('\n'.join(code[i:])) % literals
+    stop = n - 1
+    while stop >= 0:
+        i = unindented[stop]
+        while i >= 0 and (paren[i] > paren[stop + 1]
+                          or brack[i] > brack[stop + 1]
+                          or curly[i] > curly[stop + 1]):
+            i = unindented[i - 1] if i > 0 else -1
+        if i >= 0:
+            block = '\n'.join(x[1] for x in code[i:stop + 1])
+            next_stop = i - 1
+        else:
+            # no line can start the block, so it is just the last line
+            block = code[stop][1]
+            next_stop = stop - 1
         bs = block.strip()
         if bs:  # has to not be only whitespace
-            blocks.insert(0, [i, stop, bs])
-        code = code[:i]
-        i = len(code) - 1
+            blocks.append([i, stop, bs])
+        stop = next_stop
+    blocks.reverse()
+
+    # merge try/except/finally/decorator/else/elif blocks into the block
+    # before them; parts is the list of (stripped) blocks merged so far
+    def merges(s, parts):
+        "Whether block s should be merged with the block made of parts."
+        # finally/except lines after a try
+        if s.startswith('finally') or s.startswith('except'):
+            return parts[0].startswith('try')
+        # function definitions
+        if s.startswith('def') or s.startswith('@'):
+            return parts[-1].splitlines()[-1].lstrip().startswith('@')
+        # lines starting with else conditions (if *and* for *and* while!)
+        if s.startswith('else'):
+            return parts[0].startswith(('if', 'while', 'for', 'try', 'elif'))
+        # lines starting with elif
+        if s.startswith('elif'):
+            return parts[0].startswith('if')
+        return False
 
-    # merge try/except/finally/decorator/else/elif blocks
-    i = 1
+    merged = []
+    for start, stop, s in blocks:
+        if merged and merges(s, merged[-1][2]):
+            merged[-1][1] = stop
+            merged[-1][2].append(s)
+        else:
+            merged.append([start, stop, [s]])
 
-    def merge():
-        "Merge block i-1 with block i."
-        blocks[i - 1][-1] += '\n' + blocks[i][-1]
-        blocks[i - 1][1] = blocks[i][1]
-        del blocks[i]
+    return [[start, stop, '\n'.join(parts)] for start, stop, parts in merged]
 
-    while i < len(blocks):
-        s = blocks[i][-1].lstrip()
 
-        # finally/except lines after a try
-        if (s.startswith('finally') or s.startswith('except')
-            ) and blocks[i - 1][-1].lstrip().startswith('try'):
-            merge()
+class ExecuteCache(object):
+    """
+    Bounded LRU cache of the work Salvus.execute does before executing a
+    cell: dividing it into blocks, preparsing the blocks, and finding the
+    __future__ features of and compiling each block.
 
-        # function definitions
-        elif (s.startswith('def') or s.startswith('@')) and blocks[
-                i - 1][-1].splitlines()[-1].lstrip().startswith('@'):
-            merge()
+    Entries are keyed on the content of the code and on everything else
+    the result depends on: the state of the Sage preparser, and the
+    compiler flags of the __future__ features already in effect.  So when
+    a cell is executed again, only the blocks that changed are redone.
 
-        # lines starting with else conditions (if *and* for *and* while!)
-        elif s.startswith('else') and (
-                blocks[i - 1][-1].lstrip().startswith('if')
-                or blocks[i - 1][-1].lstrip().startswith('while')
-                or blocks[i - 1][-1].lstrip().startswith('for')
-                or blocks[i - 1][-1].lstrip().startswith('try')
-                or blocks[i - 1][-1].lstrip().startswith('elif')):
-            merge()
+    Cached blocks hold a reference to the dec_args entries they use, which
+    is released when they are evicted.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _get(self, key):
+        value = self._cache.pop(key, None)
+        if value is None:
+            self.stats['misses'] += 1
+        else:
+            self._cache[key] = value  # most recently used
+            self.stats['hits'] += 1
+        return value
+
+    def _set(self, key, value):
+        self._cache[key] = value
+        while len(self._cache) > self.maxsize:
+            self._evict(*self._cache.popitem(last=False))
+        return value
+
+    def _evict(self, key, value):
+        if key[0] == 'blocks':
+            release_dec_args(value[1])
+
+    def divide_into_blocks(self, code, dec_keys):
+        """
+        Like divide_into_blocks(code, dec_keys).  The blocks are shared
+        between calls, so must not be changed.
+        """
+        key = ('blocks', code)
+        value = self._get(key)
+        if value is None:
+            keys = []
+            value = (divide_into_blocks(code, keys), keys)
+            # one reference for the caller, and the other for the cache
+            retain_dec_args(keys)
+            self._set(key, value)
+        else:
+            retain_dec_args(value[1])
+        dec_keys.extend(value[1])
+        return value[0]
+
+    def preparse_code(self, code):
+        """
+        Like preparse_code(code).
+        """
+        # implicit_multiplication(...) changes what the preparser does
+        state = getattr(sys.modules.get('sage.repl.preparse'),
+                        'implicit_mul_level', None)
+        key = ('preparse', code, state)
+        value = self._get(key)
+        if value is None:
+            value = self._set(key, (preparse_code(code), ))
+        return value[0]
+
+    def compile(self, code, flags=0):
+        """
+        Return the __future__ features of code, as get_future_features(code,
+        'single') does, and code compiled in 'single' mode with flags and
+        the compiler flags of those features.
+        """
+        key = ('compile', code, flags)
+        value = self._get(key)
+        if value is None:
+            features = get_future_features(code, 'single')
+            for feature in features.values():
+                flags |= feature.compiler_flag
+            value = self._set(key, (features,
+                                    compile(code + '\n',
+                                            '',
+                                            'single',
+                                            flags=flags)))
+        return value
+
+    def clear(self):
+        while self._cache:
+            self._evict(*self._cache.popitem())
 
-        # lines starting with elif
-        elif s.startswith('elif') and blocks[i -
-                                             1][-1].lstrip().startswith('if'):
-            merge()
 
-        # do not merge blocks -- move on to next one
+############################################
+# Global names read and written by code
+############################################
+
+# reading or binding names via these can't be seen in the code
+_DYNAMIC_NAMES = frozenset([
+    'globals', 'locals', 'vars', 'eval', 'exec', 'execfile', 'sage_eval',
+    'load', 'attach', 'reset', 'restore', 'load_session', 'input', 'raw_input'
+])
+
+# methods that (usually) change their object in place
+_IN_PLACE_METHODS = frozenset([
+    'append', 'extend', 'insert', 'remove', 'pop', 'popitem', 'clear',
+    'update', 'sort', 'reverse', 'add', 'discard', 'setdefault', 'rename',
+    'fill', '__setitem__', '__delitem__', '__setattr__', '__delattr__'
+])
+_IN_PLACE_PREFIXES = ('set_', 'add_', 'append_', 'insert_', 'delete_', 'del_',
+                      'remove_', 'clear_', 'update_', 'relabel', 'subdivide')
+
+_FUNCTION_DEFS = tuple(
+    getattr(ast, name) for name in ['FunctionDef', 'AsyncFunctionDef']
+    if hasattr(ast, name))
+_COMPREHENSIONS = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+
+def _arg_names(args):
+    names = []
+    for a in (getattr(args, 'posonlyargs', []) + args.args +
+              getattr(args, 'kwonlyargs', [])):
+        if isinstance(a, ast.Name):  # Python 2
+            names.append(a.id)
+        elif hasattr(a, 'arg'):
+            names.append(a.arg)
+    for a in [args.vararg, args.kwarg]:
+        if a is not None:
+            names.append(a if isinstance(a, six.string_types) else a.arg)
+    return names
+
+
+def _scope_names(body):
+    """
+    Return the names bound in and declared global in body, the body of a
+    function or class, not counting nested functions and classes.
+    """
+    bound = set()
+    declared = set()
+    todo = list(body)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, _FUNCTION_DEFS + (ast.ClassDef, )):
+            bound.add(node.name)
+            # these are evaluated in the enclosing scope
+            todo.extend(node.decorator_list)
+            todo.extend(getattr(node, 'bases', []))
+            if hasattr(node, 'args'):
+                todo.extend(node.args.defaults)
+            continue
+        if isinstance(node, ast.Lambda):
+            todo.extend(node.args.defaults)
+            continue
+        if isinstance(node, ast.Global):
+            declared.update(node.names)
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                bound.add((alias.asname or alias.name).split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and isinstance(
+                node.name, six.string_types):
+            bound.add(node.name)
+        todo.extend(ast.iter_child_nodes(node))
+    return bound - declared, declared
+
+
+class _GlobalNames(ast.NodeVisitor):
+    """
+    Find the global names read and written by a module; see global_names.
+    """
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.uses = {}
+        self.changes = {}
+        self.dynamic = False
+        # names bound so far at the top level
+        self._bound = set()
+        # (bound, declared global, kind) for the enclosing function, class
+        # and comprehension scopes, innermost last
+        self._scopes = []
+        # names bound in the current top level statement, and the global
+        # names read and written by the function bodies in it
+        self._stmt_writes = set()
+        self._stmt_uses = set()
+        self._stmt_changes = set()
+
+    def run(self, tree):
+        for stmt in tree.body:
+            self._stmt_writes = set()
+            self._stmt_uses = set()
+            self._stmt_changes = set()
+            self.visit(stmt)
+            for x in self._stmt_writes:
+                if self._stmt_uses:
+                    self.uses.setdefault(x, set()).update(self._stmt_uses)
+                if self._stmt_changes:
+                    self.changes.setdefault(x,
+                                            set()).update(self._stmt_changes)
+
+    def _local(self, x):
+        for i, (bound, declared, kind) in enumerate(reversed(self._scopes)):
+            if i == 0 and x in declared:
+                return False
+            # class bodies are not visible from the functions in them
+            if x in bound and (i == 0 or kind != 'class'):
+                return True
+        return False
+
+    def _deferred(self):
+        # whether we are in a function body, which runs when it is called
+        return any(kind == 'function' for _, _, kind in self._scopes)
+
+    def _read(self, x):
+        if x in _DYNAMIC_NAMES:
+            self.dynamic = True
+        if self._local(x):
+            return
+        if self._deferred():
+            self._stmt_uses.add(x)
+        elif x not in self._bound:
+            self.reads.add(x)
+
+    def _write(self, x):
+        if not self._scopes:
+            self._bound.add(x)
+            self._stmt_writes.add(x)
+            self.writes.add(x)
+        elif not self._local(x):  # declared global
+            self._changed(x)
+
+    def _change(self, node):
+        # node, e.g., x.a or x[0], may be changed in place, and so may x
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        if isinstance(node, ast.Name) and not self._local(node.id):
+            self._changed(node.id)
+
+    def _changed(self, x):
+        # the global x is changed, though not bound at the top level
+        if self._deferred():
+            self._stmt_changes.add(x)
         else:
-            i += 1
+            self.writes.add(x)
+            self._stmt_writes.add(x)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self._read(node.id)
+        else:
+            self._write(node.id)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._change(node.value)
+        self.generic_visit(node)
+
+    visit_Subscript = visit_Attribute
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            attr = node.func.attr
+            if attr in _IN_PLACE_METHODS or attr.startswith(
+                    _IN_PLACE_PREFIXES):
+                self._change(node.func.value)
+        self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        for target in node.targets:
+            self.visit(target)
+
+    def visit_AugAssign(self, node):
+        self.visit(node.value)
+        if isinstance(node.target, ast.Name):
+            self._read(node.target.id)
+        self.visit(node.target)
+
+    def visit_AnnAssign(self, node):
+        for child in [node.value, node.annotation, node.target]:
+            if child is not None:
+                self.visit(child)
+
+    def visit_NamedExpr(self, node):
+        self.visit(node.value)
+        self.visit(node.target)
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.visit(node.target)
+        for stmt in node.body + node.orelse:
+            self.visit(stmt)
+
+    visit_AsyncFor = visit_For
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.dynamic = True
+            else:
+                self._write((alias.asname or alias.name).split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Exec(self, node):  # Python 2
+        self.dynamic = True
+
+    def visit_ExceptHandler(self, node):
+        if node.type is not None:
+            self.visit(node.type)
+        if isinstance(node.name, six.string_types):
+            self._write(node.name)
+        elif node.name is not None:
+            self.visit(node.name)
+        for stmt in node.body:
+            self.visit(stmt)
+
+    def visit_FunctionDef(self, node):
+        for child in node.decorator_list + node.args.defaults + [
+                x for x in getattr(node.args, 'kw_defaults', []) if x is not None
+        ]:
+            self.visit(child)
+        self._write(node.name)
+        bound, declared = _scope_names(node.body)
+        bound.update(_arg_names(node.args))
+        self._scopes.append((bound, declared, 'function'))
+        for stmt in node.body:
+            self.visit(stmt)
+        self._scopes.pop()
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        for child in node.args.defaults:
+            self.visit(child)
+        self._scopes.append((set(_arg_names(node.args)), set(), 'function'))
+        self.visit(node.body)
+        self._scopes.pop()
+
+    def visit_ClassDef(self, node):
+        for child in (node.decorator_list + node.bases +
+                      [k.value for k in getattr(node, 'keywords', [])]):
+            self.visit(child)
+        bound, declared = _scope_names(node.body)
+        self._scopes.append((bound, declared, 'class'))
+        for stmt in node.body:
+            self.visit(stmt)
+        self._scopes.pop()
+        self._write(node.name)
+
+    def _visit_comprehension(self, node, elts):
+        # the first iterable is evaluated outside of the comprehension
+        self.visit(node.generators[0].iter)
+        bound = set()
+        for gen in node.generators:
+            bound.update(x.id for x in ast.walk(gen.target)
+                         if isinstance(x, ast.Name))
+        self._scopes.append((bound, set(), 'comprehension'))
+        for i, gen in enumerate(node.generators):
+            if i:
+                self.visit(gen.iter)
+            self.visit(gen.target)
+            for cond in gen.ifs:
+                self.visit(cond)
+        for elt in elts:
+            self.visit(elt)
+        self._scopes.pop()
+
+    def visit_ListComp(self, node):
+        self._visit_comprehension(node, [node.elt])
+
+    visit_SetComp = visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node):
+        self._visit_comprehension(node, [node.key, node.value])
+
+
+def global_names(code):
+    """
+    Find the global names that code reads and writes when it is executed
+    at the top level of a namespace, e.g., as a cell.
+
+    Returns None if the code can't be parsed or uses names in ways that
+    can't be followed, e.g., via globals(), eval or "from x import *".
+    Otherwise, returns a tuple (reads, writes, uses, changes):
 
-    return blocks
+    - reads -- the set of names the code reads before binding them
 
+    - writes -- the set of names the code binds, deletes, or might change
+      in place, via subscript or attribute assignment or a call to a method
+      like append, update or set_*; changes in place via other methods, or
+      by functions the objects are passed to, are not found
+
+    - uses -- a dict mapping names the code binds to the set of global names
+      read by the bodies of the functions (and classes) bound to them, i.e.,
+      what calling them depends on
+
+    - changes -- a dict mapping names the code binds to the set of global
+      names written by the bodies of the functions bound to them, as for
+      writes, i.e., what calling them might change
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    v = _GlobalNames()
+    v.run(tree)
+    if v.dynamic:
+        return None
+    return v.reads, v.writes, v.uses, v.changes
 
 ############################################
 
@@ -366,7 +882,52 @@ _builtin_completions = list(__builtins__.keys()) + [
 ]
 
 
-def introspect(code, namespace, preparse=True):
+class IntrospectCache(object):
+    """
+    Bounded LRU cache of the results of introspect: completions,
+    docstrings and source code.
+
+    Results are keyed on the expression, the id of the object it evaluates
+    to, and the version of the namespace, which changed() increments; call
+    it whenever the namespace changes, e.g., via Namespace.on('change', None, ...).
+    Cached objects are kept alive, so their ids can't be reused, but only
+    until the next change, which drops all entries.
+
+    Only binding or deleting names changes the version: mutating an object,
+    e.g., assigning to one of its attributes, doesn't, so completions of it
+    may be stale until the next change.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.version = 0
+        self._cache = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def changed(self, *args):
+        self.version += 1
+        # entries of older versions can never be hit again
+        self._cache.clear()
+
+    def get(self, key, obj=None):
+        key = (key, id(obj), self.version)
+        entry = self._cache.pop(key, None)
+        if entry is None or entry[0] is not obj:
+            self.stats['misses'] += 1
+            return None
+        self._cache[key] = entry  # most recently used
+        self.stats['hits'] += 1
+        return entry[1]
+
+    def set(self, key, result, obj=None):
+        self._cache[(key, id(obj), self.version)] = (obj, result)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def introspect(code, namespace, preparse=True, cache=None):
     """
     INPUT:
 
@@ -377,6 +938,8 @@ def introspect(code, namespace, preparse=True):
 
     - preparse -- a boolean
 
+    - cache -- an IntrospectCache for namespace, or None
+
     OUTPUT:
 
     An object: {'result':, 'target':, 'expr':, 'status':, 'get_help':, 'get_completions':, 'get_source':}
@@ -403,10 +966,11 @@ def introspect(code, namespace, preparse=True):
     get_completions = True  # getting completions of an identifier in some namespace
 
     try:
-        # Strip all strings from the code, replacing them by template
-        # symbols; this makes parsing much easier.
+        # Blank out all strings in the code, keeping their offsets;
+        # this makes parsing much easier.
         # we strip, since trailing space could cause confusion below
-        code0, literals, state = strip_string_literals(code.strip())
+        code = code.strip()
+        code0 = mask_literals(code, scan_literals(code)[0])
 
         # Move i so that it points to the start of the last expression in the code.
         # (TODO: this should probably be replaced by using ast on preparsed version.  Not easy.)
@@ -416,10 +980,10 @@ def introspect(code, namespace, preparse=True):
 
         # Break the line in two pieces: before_expr | expr; we may
         # need before_expr in order to evaluate and make sense of
-        # expr.  We also put the string literals back in, so that
-        # evaluation works.
-        expr = code0[i:] % literals
-        before_expr = code0[:i] % literals
+        # expr.  Since code0 has the same offsets as code, the string
+        # literals are still in there, so that evaluation works.
+        expr = code[i:]
+        before_expr = code[:i]
 
         chrs = set('.()[]? ')
         if not any(c in expr for c in chrs):
@@ -466,7 +1030,14 @@ def introspect(code, namespace, preparse=True):
                     else:
                         target = expr
 
-        if get_completions and target == expr:
+        hit = None
+        if get_completions and target == expr and cache is not None:
+            hit = cache.get(('names', expr))
+            if hit is not None:
+                v, target = hit
+        if hit is not None:
+            pass
+        elif get_completions and target == expr:
             j = len(expr)
             if '*' in expr:
                 # this case includes *_factors<TAB> and abc =...;3 * ab[tab]
@@ -506,6 +1077,8 @@ def introspect(code, namespace, preparse=True):
                                             _builtin_completions)
                             if x.startswith(gle)
                         ]
+            if cache is not None:
+                cache.set(('names', expr), (v, target))
         else:
 
             # We will try to evaluate
@@ -562,7 +1135,15 @@ def introspect(code, namespace, preparse=True):
                 except Exception as err:
                     return "Unable to read source filename (%s)" % err
 
-            if get_help:
+            key = (get_help, get_source, preparse, expr)
+            if cache is not None and O is not None:
+                hit = cache.get(key, O)
+            if hit is not None:
+                if get_completions:
+                    v = hit
+                else:
+                    result = hit
+            elif get_help:
                 import sage.misc.sageinspect
                 result = get_file()
                 try:
@@ -639,6 +1220,9 @@ def introspect(code, namespace, preparse=True):
                 else:
                     v = []
 
+            if cache is not None and O is not None and hit is None:
+                cache.set(key, v if get_completions else result, O)
+
         if get_completions:
             result = list(sorted(set(v), key=lambda x: x.lower()))
 
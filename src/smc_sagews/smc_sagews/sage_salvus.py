@@ -20,7 +20,7 @@ import matplotlib
 import imp
 matplotlib.use('Agg')
 
-import copy, os, sys, types, re
+import copy, hashlib, os, sys, types, re
 
 import sage.all
 
@@ -66,11 +66,24 @@ def uuid():
 ##########################################################################
 # New function interact implementation
 ##########################################################################
+import collections
 import inspect
+import time
 
 interacts = {}
 
 
+class InteractCancelled(KeyboardInterrupt):
+    """
+    Raised in a running interact function when it sends output after a
+    newer update of the same interact arrived, so that it stops and the
+    newer update runs instead.  It is never raised between outputs, so an
+    interact that computes for a long time without any output is not
+    stopped.
+    """
+    pass
+
+
 def jsonable(x):
     """
     Given any object x, make a JSON-able version of x, doing as best we can.
@@ -97,7 +110,8 @@ class InteractCell(object):
                  update_args=None,
                  auto_update=True,
                  flicker=False,
-                 output=True):
+                 output=True,
+                 cache=None):
         """
         Given a function f, create an object that describes an interact
         for working with f interactively.
@@ -115,6 +129,10 @@ class InteractCell(object):
           never shrinks; it can only grow, which aleviates flicker.
         - ``output`` -- (default: True) if False, do not automatically
           provide any area to display output.
+        - ``cache`` -- (default: None) if a positive integer, remember the
+          output of f for that many of the most recently used values of the
+          inputs, and send it again instead of calling f when the inputs
+          have one of those values again.
         """
         self._flicker = flicker
         self._output = output
@@ -144,6 +162,12 @@ class InteractCell(object):
         self._last_vals = {}
         for arg in args:
             self._last_vals[arg] = self._controls[arg].default()
+        # when f was last called
+        self._last_run = 0
+        # values of the inputs --> output messages of f, least recently
+        # used first
+        self._cache_size = int(cache) if cache else 0
+        self._cache = collections.OrderedDict()
 
         self._ordered_args = args
         self._args = set(args)
@@ -251,6 +275,22 @@ class InteractCell(object):
         X['flicker'] = self._flicker
         return X
 
+    def delay(self, changed):
+        """
+        Return how many seconds to wait for a newer update before calling
+        self._f after the inputs in the list changed changed, according to
+        the debounce and throttle options of their controls.
+        """
+        wait = 0
+        for arg in changed:
+            c = self._controls.get(arg)
+            if c is None:
+                continue
+            debounce = c._opts.get('debounce') or 0
+            throttle = c._opts.get('throttle') or 0
+            wait = max(wait, debounce, self._last_run + throttle - time.time())
+        return wait
+
     def __call__(self, vals):
         """
         Call self._f with inputs specified by vals.  Any input variables not
@@ -269,11 +309,56 @@ class InteractCell(object):
             if not do_it:
                 return
 
+        key = self._cache_key()
+        if key in self._cache:
+            output = self._cache.pop(key)
+            # output showing blobs that expire is evaluated again instead
+            if salvus._replay(output):
+                self._cache[key] = output
+                return
+
         interact_exec_stack.append(self)
+        self._last_run = time.time()
+        if key is not None:
+            outer, salvus._interact_output = salvus._interact_output, []
         try:
             self._f(**dict([(k, self._last_vals[k]) for k in self._args]))
+            if key is not None:
+                salvus._flush_stdio()
+                self._remember(key, salvus._interact_output)
         finally:
             interact_exec_stack.pop()
+            if key is not None:
+                if outer is not None:
+                    outer.extend(salvus._interact_output)
+                salvus._interact_output = outer
+
+    def _cache_key(self):
+        """
+        Return the key of the current values of the inputs in self._cache,
+        or None if output isn't cached or the values aren't hashable.
+        """
+        if not self._cache_size:
+            return None
+        key = tuple((k, self._last_vals[k]) for k in sorted(self._args))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _remember(self, key, output):
+        # the output of a nested interact or of raw_input refers to state
+        # that is gone when it is sent again
+        for mesg in output:
+            if 'interact' in mesg or 'raw_input' in mesg:
+                return
+        self._cache[key] = [
+            dict((k, v) for k, v in mesg.items() if k not in ('id', 'done'))
+            for mesg in output
+        ]
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
 
 
 class InteractFunction(object):
@@ -380,9 +465,14 @@ class Interact(object):
       to the widths.   Use var_name='' to specify where the output
       goes, if you don't want it to last.  You may specify entries for
       controls that you will create later using interact.var_name = foo.
+    - ``cache`` -- (default: None); if a positive integer, the output
+      for that many of the most recently used values of the controls is
+      remembered and shown again, instead of evaluating the function,
+      when the controls are set back to one of those values.  Only use
+      this if the output of the function only depends on the controls.
 
 
-    NOTES: The flicker and layout options above are only in SALVUS.
+    NOTES: The flicker, layout and cache options above are only in SALVUS.
         For backwards compatibility with the Sage notebook, if layout
         is a dictionary (with keys 'top', 'bottom', 'left', 'right'),
         then the appropriate layout will be rendered as it used to be
@@ -424,6 +514,13 @@ class Interact(object):
         def _(a=x^2, b=(0..20), c=100, d=x+1, e=sin(2)):
             print(a+b+c+d+e)
 
+    The cache option, so that moving the slider back to a value shows the
+    plot for it right away::
+
+        @interact(cache=100)
+        def _(a=slider(0, 10, 0.1)):
+            show(plot(sin(a*x), (x, 0, 2*pi)))
+
     We illustrate some features that are only in Salvus, not in the
     Sage cell server or Sage notebook.
 
@@ -507,10 +604,11 @@ class Interact(object):
                  update_args=None,
                  auto_update=True,
                  flicker=False,
-                 output=True):
+                 output=True,
+                 cache=None):
         if f is None:
             return _interact_layout(layout, width, style, update_args,
-                                    auto_update, flicker)
+                                    auto_update, flicker, output, cache)
         else:
             return salvus.interact(f,
                                    layout=layout,
@@ -519,7 +617,8 @@ class Interact(object):
                                    update_args=update_args,
                                    auto_update=auto_update,
                                    flicker=flicker,
-                                   output=output)
+                                   output=output,
+                                   cache=cache)
 
     def __setattr__(self, arg, value):
         I = interact_exec_stack[-1]
@@ -770,7 +869,9 @@ def input_box(default=None,
               nrows=1,
               width=None,
               readonly=False,
-              submit_button=None):
+              submit_button=None,
+              debounce=None,
+              throttle=None):
     """
     An input box interactive control for use with the :func:`interact` command.
 
@@ -783,6 +884,10 @@ def input_box(default=None,
         - width -- width; how wide the box is
         - readonly -- is it read-only?
         - submit_button -- defaults to true if nrows > 1 and false otherwise.
+        - debounce -- seconds; if given, wait this long after a change for
+          another one before evaluating the interact  [SALVUS only]
+        - throttle -- seconds; if given, evaluate the interact at most once
+          this often because of changes of this control  [SALVUS only]
     """
     return control(control_type='input-box',
                    opts=locals(),
@@ -1064,7 +1169,9 @@ def slider(start,
            step_size=None,
            range=False,
            width=None,
-           animate=True):
+           animate=True,
+           debounce=None,
+           throttle=None):
     """
     An interactive slider control for use with :func:`interact`.
 
@@ -1086,6 +1193,18 @@ def slider(start,
         - ``width`` -- how wide the slider appears to the user  [SALVUS only]
         - ``animate`` -- True (default), False,"fast", "slow", or the
           duration of the animation in milliseconds.  [SALVUS only]
+        - ``debounce`` -- seconds (default: None); if given, wait this long
+          after the slider moved for it to move again before evaluating
+          the interact.  [SALVUS only]
+        - ``throttle`` -- seconds (default: None); if given, evaluate the
+          interact at most once this often while the slider moves.
+          [SALVUS only]
+
+    Updates of an interact that arrive while it is being evaluated are
+    combined, so only the latest values are evaluated next.  The
+    evaluation with the old values is stopped the next time it sends
+    output (e.g., prints or shows something); one that sends no more
+    output runs to the end before the latest values are evaluated.
 
     You may call the slider function as follows:
 
@@ -1124,7 +1243,9 @@ def slider(start,
                        'animate': animate,
                        'vals': vals,
                        'display_value': display_value,
-                       'width': width
+                       'width': width,
+                       'debounce': debounce,
+                       'throttle': throttle
                    },
                    repr="Slider",
                    convert_from_client=slider.from_client,
@@ -1142,6 +1263,12 @@ def range_slider(*args, **kwds):
         @interact
         def _(t = range_slider([1..1000], default=(100,200), label=r'Choose a range for $\alpha$')):
             print(t)
+
+    A range slider that evaluates the interact at most twice a second::
+
+        @interact
+        def _(t = range_slider([1..1000], default=(100,200), throttle=0.5)):
+            print(t)
     """
     kwds['range'] = True
     return slider(*args, **kwds)
@@ -2113,9 +2240,11 @@ def perl(code):
 
     Afterwards, p contains 'hi'.
 
-    NOTE: No state is preserved between calls.  Each call is a separate process.
+    NOTE: All %perl cells run in the same perl process, so package
+    variables (but not variables declared with my) are preserved between
+    calls.  To start over, use interpreters.close('perl').
     """
-    script('sage-native-execute perl')(code)
+    interpreters['perl'](code)
 
 
 def ruby(code):
@@ -2146,9 +2275,11 @@ def ruby(code):
 
     Afterwards, p contains 'Hello from ruby!'.
 
-    NOTE: No state is preserved between calls.  Each call is a separate process.
+    NOTE: All %ruby cells run in the same ruby process, so variables and
+    methods are preserved between calls.  To start over, use
+    interpreters.close('ruby').
     """
-    script('sage-native-execute ruby')(code)
+    interpreters['ruby'](code)
 
 
 def fortran(x, library_paths=[], libraries=[], verbose=False):
@@ -2470,49 +2601,172 @@ def prun(code):
 # The %fork cell decorator.
 ##############################################################
 
+import selectors, signal, struct, threading
+
+
+def _set_pdeathsig(sig=signal.SIGKILL):
+    """
+    Ask Linux to send sig to this process when its parent dies.  Does
+    nothing on other systems.
+    """
+    try:
+        import ctypes
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, int(sig))
+    except Exception:
+        pass
+
 
-def _wait_in_thread(pid, callback, filename):
-    from sage.structure.sage_object import load
+class _Unpicklable(object):
+    # stands for a value of the dict returned by a forked function that
+    # could not be pickled
+    def __init__(self, err):
+        self.err = err
 
-    def wait():
+
+def _dumps_result(result):
+    # pickle (True, result), or (False, error message); if result is a
+    # dict, only the values that can't be pickled are lost
+    from sage.structure.sage_object import dumps
+    try:
+        return dumps((True, result), compress=False)
+    except Exception as err:
+        if not isinstance(result, dict):
+            return dumps((False, 'unable to pickle result -- %s' % err),
+                         compress=False)
+    v = {}
+    for key, val in result.items():
         try:
-            os.waitpid(pid, 0)
-            callback(load(filename))
-        except Exception as msg:
-            callback(msg)
+            dumps(val, compress=False)
+        except Exception as err:
+            val = _Unpicklable(str(err))
+        v[key] = val
+    return dumps((True, v), compress=False)
 
-    from threading import Thread
-    t = Thread(target=wait, args=tuple([]))
-    t.start()
+
+class ForkPool(object):
+    """
+    The subprocesses forked by async_.
+
+    Each child sends its result back over a pipe, framed by its length,
+    and one thread waits for the results of all of them.  At most
+    max_children run at once; async_ waits for one of them to finish
+    before forking another one.  On Linux, children are killed when
+    the parent process dies.
+    """
+    def __init__(self, max_children=8):
+        self.max_children = max_children
+        self._lock = threading.Condition()
+        self._children = {}  # fd of pipe --> [pid, callback, chunks]
+        self._selector = None
+        self._thread = None
+
+    def __len__(self):
+        return len(self._children)
+
+    def _start_thread(self):
+        if self._thread is not None:
+            return
+        self._selector = selectors.DefaultSelector()
+        # to wake up the thread when a child is added
+        self._wakeup = os.pipe()
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._wait)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, f, args, kwds, callback):
+        """
+        Call f(*args, **kwds) in a forked child, and callback(result) in
+        a thread of this process when it is done, where result is an
+        exception if f raised one.  Returns the pid of the child.
+        """
+        with self._lock:
+            while len(self._children) >= self.max_children:
+                self._lock.wait(1)
+            self._start_thread()
+        r, w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        parent = os.getpid()
+        pid = os.fork()
+        if not pid:
+            # The child process
+            try:
+                os.close(r)
+                _set_pdeathsig()
+                if os.getppid() != parent:
+                    os._exit(1)
+                # the thread of the parent is not in the child
+                self.__init__(self.max_children)
+                try:
+                    result = f(*args, **kwds)
+                    data = _dumps_result(result)
+                except Exception as msg:
+                    from sage.structure.sage_object import dumps
+                    data = dumps((False, str(msg)), compress=False)
+                data = struct.pack('>Q', len(data)) + data
+                while data:
+                    data = data[os.write(w, data):]
+            finally:
+                os._exit(0)
+        # The parent master process
+        os.close(w)
+        with self._lock:
+            self._children[r] = [pid, callback, []]
+            self._selector.register(r, selectors.EVENT_READ)
+        os.write(self._wakeup[1], b'x')
+        return pid
+
+    def _wait(self):
+        while True:
+            for key, _ in self._selector.select():
+                fd = key.fd
+                if fd == self._wakeup[0]:
+                    os.read(fd, 4096)
+                    continue
+                data = os.read(fd, 1 << 20)
+                if data:
+                    self._children[fd][2].append(data)
+                    continue
+                with self._lock:
+                    self._selector.unregister(fd)
+                    pid, callback, chunks = self._children.pop(fd)
+                    self._lock.notify()
+                os.close(fd)
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+                try:
+                    callback(self._result(pid, b''.join(chunks)))
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+
+    def _result(self, pid, data):
+        from sage.structure.sage_object import loads
+        n = struct.unpack('>Q', data[:8])[0] if len(data) >= 8 else -1
+        if len(data) != 8 + n:
+            return RuntimeError("subprocess %s exited without a result" %
+                                pid)
+        try:
+            ok, result = loads(data[8:], compress=False)
+        except Exception as err:
+            return RuntimeError("unable to unpickle result -- %s" % err)
+        return result if ok else RuntimeError(result)
+
+
+fork_pool = ForkPool(
+    int(os.environ.get('COCALC_SAGE_SERVER_FORK_MAX', os.cpu_count() or 2)))
 
 
 def async_(f, args, kwds, callback):
     """
     Run f in a forked subprocess with given args and kwds, then call the
-    callback function when f terminates.
+    callback function when f terminates; see ForkPool.run.
     """
-    from sage.misc.all import tmp_filename
-    filename = tmp_filename() + '.sobj'
-    sys.stdout.flush()
-    sys.stderr.flush()
-    pid = os.fork()
-    if pid:
-        # The parent master process
-        try:
-            _wait_in_thread(pid, callback, filename)
-            return pid
-        finally:
-            if os.path.exists(filename):
-                os.unlink(filename)
-    else:
-        # The child process
-        try:
-            result = f(*args, **kwds)
-        except Exception as msg:
-            result = str(msg)
-        from sage.structure.sage_object import save
-        save(result, filename)
-        os._exit(0)
+    return fork_pool.run(f, args, kwds, callback)
 
 
 class Fork(object):
@@ -2539,8 +2793,11 @@ class Fork(object):
     type fork.kill(pid).  This is currently the only way to stop code
     running in %fork cells.
 
-    TODO/WARNING: The subprocesses spawned by fork are not killed
-    if the parent process is killed first!
+    At most fork_pool.max_children subprocesses run at once (set
+    COCALC_SAGE_SERVER_FORK_MAX to change the default, the number of
+    CPUs); a %fork cell waits for one of them to finish before starting
+    another.  On Linux, the subprocesses are killed if the parent
+    process is killed first.
 
     NOTE: All pexpect interfaces are reset in the child process.
     """
@@ -2577,34 +2834,33 @@ class Fork(object):
 
             salvus.namespace.on('change', None, change)
             salvus.execute(s)
-            result = {}
-            from sage.structure.sage_object import dumps
-            for var in changed_vars:
-                try:
-                    result[var] = dumps(salvus.namespace[var])
-                except:
-                    result[var] = 'unable to pickle %s' % var
-            return result
+            # pickled all at once by async_
+            return dict((var, salvus.namespace[var]) for var in changed_vars
+                        if var in salvus.namespace)
 
-        from sage.structure.sage_object import loads
+        # g may be called before async_ returns
+        lock = threading.Lock()
 
         def g(s):
+            with lock:
+                if pid not in self._children:
+                    return  # killed
+                del self._children[pid]
             if isinstance(s, Exception):
                 sys.stderr.write(str(s))
                 sys.stderr.flush()
             else:
                 for var, val in s.items():
-                    try:
-                        salvus.namespace[var] = loads(val)
-                    except:
-                        print(("unable to unpickle %s" % var))
+                    if isinstance(val, _Unpicklable):
+                        print(("unable to pickle %s" % var))
+                    else:
+                        salvus.namespace[var] = val
             salvus._conn.send_json({'event': 'output', 'id': id, 'done': True})
-            if pid in self._children:
-                del self._children[pid]
 
-        pid = async_(f, tuple([]), {}, g)
+        with lock:
+            pid = async_(f, tuple([]), {}, g)
+            self._children[pid] = id
         print(("Forked subprocess %s" % pid))
-        self._children[pid] = id
 
     def kill(self, pid):
         if pid in self._children:
@@ -2643,6 +2899,185 @@ def show_animation(obj, delay=20, gif=False, **kwds):
         salvus.file(t, raw=True)
 
 
+class _HashWriter(object):
+    """
+    File-like object that only computes the sha1 hash of what is written to
+    it, and raises ValueError once more than limit bytes were written.
+    """
+    def __init__(self, limit):
+        self.sha1 = hashlib.sha1()
+        self.limit = limit
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise ValueError("more than %s bytes" % self.limit)
+        self.sha1.update(data)
+
+
+class RenderCache(object):
+    """
+    On-disk cache of rendered 2d plots, shared by all worksheets of the
+    project.  Images are stored under the sha1 hash of the pickled plot,
+    the file type, the options, and the versions of Sage and matplotlib,
+    and the least recently used ones are deleted when there are more than
+    max_size bytes of them.
+
+    The pickle is only hashed, never kept, and plots whose pickle is larger
+    than max_key_size bytes are not cached, so a miss costs little compared
+    to rendering the plot.
+
+    INPUT:
+
+    - ``path`` -- directory; relative to $HOME, which is only known once
+      the session has dropped privileges
+    - ``max_size`` -- max total size of the images in bytes; 0 disables
+      the cache
+    - ``max_key_size`` -- max size of the pickle of a plot that is cached
+    """
+    def __init__(self, path, max_size, max_key_size=2**22):
+        self.path = path
+        self.max_size = max_size
+        self.max_key_size = max_key_size
+        self.hits = self.misses = 0
+        self.key_time = 0
+        # estimated total size of the images; None until they are listed
+        self._size = None
+        # key --> blob uuid of the image, for images put or shown in this
+        # session; the uuid only matters if the image was sent
+        self._uuids = {}
+
+    def __repr__(self):
+        return "Render cache %s: %s hits, %s misses, %.3fs computing keys" % (
+            self.directory(), self.hits, self.misses, self.key_time)
+
+    def directory(self):
+        return os.path.join(os.environ.get('HOME', ''), self.path)
+
+    def key(self, obj, ext, kwds):
+        """
+        Return the key of the image of obj with the given file extension
+        and show options, or None if it can't be cached.
+        """
+        if not self.max_size:
+            return None
+        import pickle
+        import time
+        t = time.time()
+        writer = _HashWriter(self.max_key_size)
+        try:
+            pickle.Pickler(writer, pickle.HIGHEST_PROTOCOL).dump(
+                (sage.version.version, matplotlib.__version__, ext,
+                 sorted(kwds.items()), obj))
+            return writer.sha1.hexdigest()
+        except Exception:
+            return None
+        finally:
+            self.key_time += time.time() - t
+
+    def get(self, key, ext):
+        """
+        Return the name of the file with the image stored under key, or None.
+        """
+        filename = os.path.join(self.directory(), key + ext)
+        try:
+            os.utime(filename, None)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return filename
+
+    def put(self, key, ext, filename):
+        """
+        Store a copy of the image in the given file under key.
+        """
+        directory = self.directory()
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = os.path.join(directory, '.%s-%s' % (key, os.getpid()))
+            # hash while copying, so the uuid is known on the next hit
+            sha1 = hashlib.sha1()
+            size = 0
+            with open(filename, 'rb') as src, open(tmp, 'wb') as dst:
+                while True:
+                    chunk = src.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    dst.write(chunk)
+                    size += len(chunk)
+            os.rename(tmp, os.path.join(directory, key + ext))
+            self._uuids[key] = uuid_from_sha1_hex(sha1.hexdigest())
+            # other sessions add images too, so the estimate is low, but
+            # it is corrected whenever the images are listed
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_size:
+                self.prune()
+        except (IOError, OSError):
+            # the cache is an optimization; never fail to show a plot
+            pass
+
+    def prune(self):
+        """
+        Delete the least recently used images until they take at most
+        max_size bytes.
+        """
+        directory = self.directory()
+        files = []
+        total = 0
+        for name in os.listdir(directory):
+            try:
+                st = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        files.sort()
+        for mtime, size, name in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass
+            total -= size
+        self._size = total
+
+    def uuid(self, key, filename):
+        """
+        Return the blob uuid of the image stored under key in the given file.
+        """
+        if key not in self._uuids:
+            sha1 = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                while True:
+                    chunk = f.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+            self._uuids[key] = uuid_from_sha1_hex(sha1.hexdigest())
+        return self._uuids[key]
+
+    def clear(self):
+        """
+        Delete all images in the cache.
+        """
+        import shutil
+        shutil.rmtree(self.directory(), ignore_errors=True)
+        self._size = None
+        self._uuids.clear()
+
+
+render_cache = RenderCache(
+    os.environ.get('COCALC_SAGE_SERVER_RENDER_CACHE',
+                   '.smc/sage_server/render_cache'),
+    int(os.environ.get('COCALC_SAGE_SERVER_RENDER_CACHE_MB', 100)) * 2**20)
+
+
 def show_2d_plot_using_matplotlib(obj, svg, **kwds):
     if isinstance(obj, matplotlib.image.AxesImage):
         # The result of imshow, e.g.,
@@ -2669,11 +3104,30 @@ def show_2d_plot_using_matplotlib(obj, svg, **kwds):
         del kwds2['events']
         ig.show(**kwds2)
     else:
-        t = tmp_filename(ext='.svg' if svg else '.png')
+        ext = '.svg' if svg else '.png'
+        key = None
+        if not isinstance(obj, matplotlib.figure.Figure):
+            key = render_cache.key(obj, ext, kwds)
+        if key is not None:
+            filename = render_cache.get(key, ext)
+            if filename is not None:
+                # not even sent, if the hub saved it during this session and
+                # it doesn't expire soon (see Salvus._saved_blob_ttl)
+                try:
+                    salvus.file(filename,
+                                file_uuid=render_cache.uuid(key, filename))
+                    return
+                except (IOError, OSError):
+                    # another session pruned it after get(); nothing was
+                    # sent yet, so just render it again
+                    pass
+        t = tmp_filename(ext=ext)
         if isinstance(obj, matplotlib.figure.Figure):
             obj.savefig(t, **kwds)
         else:
             obj.save(t, **kwds)
+        if key is not None:
+            render_cache.put(key, ext, t)
         salvus.file(t)
         os.unlink(t)
 
@@ -4382,6 +4836,12 @@ try:
 except:
     from sage_jupyter import jupyter
 
+# The long-lived interpreters of %perl and %ruby.
+try:
+    from .sage_interpreters import interpreters
+except:
+    from sage_interpreters import interpreters
+
 
 # license() workaround for IPython pager
 # could also set os.environ['TERM'] to 'dumb' to workaround the pager
@@ -4413,9 +4873,11 @@ def which(pgm):
 
 
 try:
-    from .sage_server import MAX_CODE_SIZE
+    from .sage_server import (MAX_CODE_SIZE, FILE_CHUNK_SIZE,
+                              uuid_from_sha1_hex)
 except:
-    from sage_server import MAX_CODE_SIZE
+    from sage_server import (MAX_CODE_SIZE, FILE_CHUNK_SIZE,
+                             uuid_from_sha1_hex)
 
 
 def search_src(str, max_chars=MAX_CODE_SIZE):
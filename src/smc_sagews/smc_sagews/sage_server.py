@@ -58,19 +58,124 @@ def unicode8(s):
 LOGFILE = os.path.realpath(__file__)[:-3] + ".log"
 PID = os.getpid()
 from datetime import datetime
+import atexit, threading
 
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+# Buffered log records are written out once there are this many bytes of them,
+# or once the oldest one is this many seconds old.
+LOG_FLUSH_SIZE = 16384
+LOG_FLUSH_INTERVAL = 0.5
 
-def log(*args):
-    try:
-        debug_log = open(LOGFILE, 'a')
-        mesg = "%s (%s): %s\n" % (PID, datetime.utcnow().strftime(
-            '%Y-%m-%d %H:%M:%S.%f')[:-3], ' '.join([unicode8(x)
-                                                    for x in args]))
-        debug_log.write(mesg)
-        debug_log.flush()
-    except Exception as err:
-        print(("an error writing a log message (ignoring) -- %s" % err, args))
 
+class Log(object):
+    """
+    Buffered logger writing to LOGFILE.
+
+    Calling log(...) logs at level INFO; use log.debug(...) etc. for other
+    levels.  Records below the current level are dropped without being
+    formatted.  The rest are buffered in memory and appended to LOGFILE,
+    which is kept open, once LOG_FLUSH_SIZE bytes are buffered or the oldest
+    record is LOG_FLUSH_INTERVAL seconds old.  ERROR records are written out
+    immediately.  The server calls log.flush() before it blocks waiting for
+    a connection or message, so nothing sits in the buffer while idle.
+
+    There is deliberately no background flushing thread: this object is
+    inherited by every forked session, and the main loop must stay
+    single threaded (see serve).  Instead, the buffer is flushed right
+    before any fork, and discarded in the child.
+    """
+    def __init__(self, level='INFO'):
+        self._lock = threading.Lock()
+        self._records = []
+        self._size = 0
+        self._first = None
+        self._fd = None
+        self._path = None
+        self.set_level(level)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self.flush,
+                                after_in_child=self._after_fork)
+        atexit.register(self.flush)
+
+    def set_level(self, level):
+        """
+        Set the log level to one of 'DEBUG', 'INFO', 'WARNING' or 'ERROR'.
+        """
+        self.level = LOG_LEVELS[level.upper()]
+        self.debugging = self.level <= LOG_LEVELS['DEBUG']
+
+    def __call__(self, *args):
+        self._log(20, args)
+
+    def debug(self, *args):
+        if self.debugging:
+            self._log(10, args)
+
+    def info(self, *args):
+        self._log(20, args)
+
+    def warning(self, *args):
+        self._log(30, args)
+
+    def error(self, *args):
+        self._log(40, args)
+
+    def _log(self, level, args):
+        if level < self.level:
+            return
+        try:
+            mesg = "%s (%s): %s\n" % (PID, datetime.utcnow().strftime(
+                '%Y-%m-%d %H:%M:%S.%f')[:-3], ' '.join(
+                    [unicode8(x) for x in args]))
+            if six.PY3:
+                mesg = mesg.encode('utf8', 'replace')
+            with self._lock:
+                self._records.append(mesg)
+                self._size += len(mesg)
+                now = time.time()
+                if self._first is None:
+                    self._first = now
+                if (level >= 40 or self._size >= LOG_FLUSH_SIZE
+                        or now - self._first >= LOG_FLUSH_INTERVAL):
+                    self._write()
+        except Exception as err:
+            print(("an error writing a log message (ignoring) -- %s" % err,
+                   args))
+
+    def flush(self):
+        try:
+            with self._lock:
+                self._write()
+        except Exception as err:
+            print("an error flushing the log (ignoring) -- %s" % err)
+
+    def _write(self):
+        # call with self._lock held
+        if not self._records:
+            return
+        if self._path != LOGFILE:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._fd = os.open(LOGFILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                               0o644)
+            self._path = LOGFILE
+        data = b''.join(self._records)
+        del self._records[:]
+        self._size = 0
+        self._first = None
+        while data:
+            data = data[os.write(self._fd, data):]
+
+    def _after_fork(self):
+        # the parent already wrote everything out right before the fork.
+        self._lock = threading.Lock()
+        del self._records[:]
+        self._size = 0
+        self._first = None
+
+
+log = Log(os.environ.get('COCALC_SAGE_SERVER_LOG_LEVEL', 'INFO'))
 
 # used for clearing pylab figure
 pylab = None
@@ -86,17 +191,17 @@ MAX_STDOUT_SIZE = MAX_STDERR_SIZE = MAX_CODE_SIZE = MAX_HTML_SIZE = MAX_MD_SIZE
 MAX_OUTPUT = 150000
 
 # Standard imports.
-import json, resource, shutil, signal, socket, struct, \
-       tempfile, time, traceback, pwd, re
+import collections, errno, fcntl, gc, json, resource, select, selectors, shutil, \
+       signal, socket, struct, tempfile, time, traceback, pwd, re
 
 # for "3x^2 + 4xy - 5(1+x) - 3 abc4ok", this pattern matches "3x", "5(" and "4xy" but not "abc4ok"
 # to understand it, see https://regex101.com/ or https://www.debuggex.com/
 RE_POSSIBLE_IMPLICIT_MUL = re.compile(r'(?:(?<=[^a-zA-Z])|^)(\d+[a-zA-Z\(]+)')
 
 try:
-    from . import sage_parsing, sage_salvus
+    from . import sage_jupyter, sage_parsing, sage_salvus
 except:
-    import sage_parsing, sage_salvus
+    import sage_jupyter, sage_parsing, sage_salvus
 
 uuid = sage_salvus.uuid
 
@@ -156,12 +261,16 @@ if 'base_url' not in INFO:
 
 # A CoffeeScript version of this function is in misc_node.coffee.
 import hashlib
+from contextlib import contextmanager
 
 
 def uuidsha1(data):
     sha1sum = hashlib.sha1()
     sha1sum.update(data)
-    s = sha1sum.hexdigest()
+    return uuid_from_sha1_hex(sha1sum.hexdigest())
+
+
+def uuid_from_sha1_hex(s):
     t = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'
     r = list(t)
     j = 0
@@ -176,30 +285,215 @@ def uuidsha1(data):
     return ''.join(r)
 
 
+# Files are hashed and (if sendfile isn't available) sent in chunks of this many bytes.
+FILE_CHUNK_SIZE = 1 << 20
+
+# perf_counter is not available in Python 2
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def _encode_string_no_nul(s, _encode=json.encoder.encode_basestring_ascii):
+    if '\x00' in s:
+        raise RuntimeError("NULL bytes not allowed")
+    return _encode(s)
+
+
+def _has_nul_escape(s, esc='\\u0000', backslash='\\'):
+    """
+    Return True if the encoded JSON string s contains an escaped NULL byte,
+    i.e., an occurrence of \\u0000 whose backslash is not itself escaped.
+    """
+    i = s.find(esc)
+    while i != -1:
+        j = i
+        while j > 0 and s[j - 1:j] == backslash:
+            j -= 1
+        if (i - j) % 2 == 0:
+            return True
+        i = s.find(esc, i + 1)
+    return False
+
+
+class _NoNulJSONEncoder(json.JSONEncoder):
+    """
+    The stdlib JSON encoder, except that it raises a RuntimeError while
+    encoding a string that contains a NULL byte (PostgreSQL TEXT can't
+    contain those).
+    """
+    def iterencode(self, o, _one_shot=False):
+        c_make_encoder = json.encoder.c_make_encoder
+        if _one_shot and c_make_encoder is not None and self.indent is None:
+            return c_make_encoder({} if self.check_circular else None,
+                                  self.default, _encode_string_no_nul,
+                                  self.indent, self.key_separator,
+                                  self.item_separator, self.sort_keys,
+                                  self.skipkeys, self.allow_nan)(o, 0)
+        # no C accelerator -- check the result instead
+        chunks = json.JSONEncoder.iterencode(self, o, _one_shot)
+        s = ''.join(chunks)
+        if _has_nul_escape(s):
+            raise RuntimeError("NULL bytes not allowed")
+        return [s]
+
+
+class JSONCodec(object):
+    """
+    Encoding and decoding of JSON messages on the wire using the stdlib
+    json module.  This is the default; the faster codecs below are only
+    used if chosen explicitly with $COCALC_SAGE_SERVER_JSON, and fall back
+    to this for messages they can't encode.
+
+    dumps returns utf8 encoded bytes and raises a RuntimeError if the
+    message contains a NULL byte; loads takes a memoryview of utf8 bytes.
+    """
+    name = 'json'
+    _encoder = _NoNulJSONEncoder()
+
+    def dumps(self, m):
+        s = self._encoder.encode(m)
+        return s.encode('utf8') if six.PY3 else s
+
+    def loads(self, view):
+        if six.PY3:
+            return json.loads(str(view, 'utf8'))
+        return json.loads(view.tobytes())
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    Encoding and decoding with orjson.  Unlike json, this writes NaN and
+    infinity as null, and checks for NULL bytes by scanning the encoded
+    message once more.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, m):
+        try:
+            s = self._orjson.dumps(m, option=self._options)
+        except TypeError:
+            # e.g., integers that don't fit in 64 bits; orjson.JSONEncodeError is a TypeError.
+            return JSONCodec.dumps(self, m)
+        # orjson can't check while encoding, but this is a memchr-speed scan of the result
+        if _has_nul_escape(s, b'\\u0000', b'\\'):
+            raise RuntimeError("NULL bytes not allowed")
+        return s
+
+    def loads(self, view):
+        return self._orjson.loads(view)
+
+
+class UjsonCodec(JSONCodec):
+    """
+    Encoding and decoding with ujson, which checks for NULL bytes by
+    scanning the encoded message once more.
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, m):
+        try:
+            s = self._ujson.dumps(m)
+        except (TypeError, OverflowError):
+            return JSONCodec.dumps(self, m)
+        if _has_nul_escape(s):
+            raise RuntimeError("NULL bytes not allowed")
+        return s.encode('utf8') if six.PY3 else s
+
+    def loads(self, view):
+        return self._ujson.loads(view.tobytes())
+
+
+json_codecs = {'orjson': OrjsonCodec, 'ujson': UjsonCodec, 'json': JSONCodec}
+
+
+def get_json_codec(name=None):
+    """
+    Return an instance of the JSON codec with the given name ('json',
+    'ujson' or 'orjson'), or of the one named by $COCALC_SAGE_SERVER_JSON
+    if name is None.  The default is json, which is also used if the
+    chosen module is not installed.
+    """
+    if name is None:
+        name = os.environ.get('COCALC_SAGE_SERVER_JSON')
+    try:
+        return json_codecs.get(name, JSONCodec)()
+    except ImportError:
+        return JSONCodec()
+
+
+json_codec = get_json_codec()
+
+
 # A tcp connection with support for sending various types of messages, especially JSON.
 class ConnectionJSON(object):
-    def __init__(self, conn):
+    def __init__(self, conn, codec=None):
         # avoid common mistake -- conn is supposed to be from socket.socket...
         assert not isinstance(conn, ConnectionJSON)
         self._conn = conn
+        self._codec = json_codec if codec is None else codec
+        self.stats = {
+            'codec': self._codec.name,
+            'sent_messages': 0,
+            'sent_bytes': 0,
+            'max_message_bytes': 0,
+            'encode_time': 0.0,
+            'sent_blobs': 0,
+            'sent_blob_bytes': 0,
+            'received_messages': 0,
+            'received_bytes': 0,
+            'decode_time': 0.0
+        }
+        self._header = bytearray(4)
+        self._header_view = memoryview(self._header)
+        self._buffer_view = memoryview(bytearray(RECV_BUFFER_SIZE))
 
     def close(self):
         self._conn.close()
 
+    def poll(self, timeout=0):
+        """
+        Return True if a message (or part of one) is waiting to be received.
+        """
+        return bool(select.select([self._conn], [], [], timeout)[0])
+
     def _send(self, s):
         if six.PY3 and type(s) == str:
             s = s.encode('utf8')
         length_header = struct.pack(">L", len(s))
         # py3: TypeError: can't concat str to bytes
-        self._conn.send(length_header + s)
+        self._conn.sendall(length_header + s)
+
+    def _send_blob_header(self, s, n):
+        """
+        Send the length header and the 'b' + uuid prefix of a blob message
+        whose payload (sent separately) is n bytes long.
+        """
+        prefix = ('b' + s).encode('utf8')
+        self._conn.sendall(struct.pack(">L", len(prefix) + n) + prefix)
 
     def send_json(self, m):
-        m = json.dumps(m)
-        if '\\u0000' in m:
-            raise RuntimeError("NULL bytes not allowed")
-        log("sending message '", truncate_text(m, 256), "'")
-        self._send('j' + m)
-        return len(m)
+        t = timer()
+        m = self._codec.dumps(m)
+        stats = self.stats
+        stats['encode_time'] += timer() - t
+        n = len(m)
+        stats['sent_messages'] += 1
+        stats['sent_bytes'] += n
+        if n > stats['max_message_bytes']:
+            stats['max_message_bytes'] = n
+        if log.debugging:
+            log.debug("sending message '%s'" % truncate_text(
+                m[:257].decode('utf8', 'replace'), 256)[0])
+        self._conn.sendall(struct.pack(">L", n + 1) + b'j' + m)
+        return n
 
     def send_blob(self, blob):
         if six.PY3 and type(blob) == str:
@@ -207,65 +501,127 @@ class ConnectionJSON(object):
             blob = blob.encode('utf8')
 
         s = uuidsha1(blob)
-        if six.PY3 and type(blob) == bytes:
-            # we convert all to bytes first, to avoid unnecessary conversions
-            self._send(('b' + s).encode('utf8') + blob)
-        else:
-            # old sage py2 code
-            self._send('b' + s + blob)
+        # header and blob are sent separately, so we never build another
+        # full copy of the blob just to prepend a few bytes to it.
+        self._send_blob_header(s, len(blob))
+        self._conn.sendall(blob)
+        self.stats['sent_blobs'] += 1
+        self.stats['sent_blob_bytes'] += len(blob)
         return s
 
-    def send_file(self, filename):
-        log("sending file '%s'" % filename)
-        f = open(filename, 'rb')
-        data = f.read()
-        f.close()
-        return self.send_blob(data)
-
-    def _recv(self, n):
-        #print("_recv(%s)"%n)
-        # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
-        for i in range(20):
-            try:
-                #print "blocking recv (i = %s), pid=%s"%(i, os.getpid())
-                r = self._conn.recv(n)
-                #log("n=%s; received: '%s' of len %s"%(n,r, len(r)))
-                return r
-            except OSError as e:
-                #print("socket.error, msg=%s"%msg)
-                if e.errno != 4:
-                    raise
-        raise EOFError
+    def send_file(self, filename, announce=None):
+        """
+        Send the file as a blob, without ever holding it in memory: it is
+        hashed in chunks, then streamed to the socket with sendfile.  The
+        message on the wire is exactly the same as send_blob(data) would send.
 
-    def recv(self):
-        n = self._recv(4)
-        if len(n) < 4:
-            raise EOFError
-        n = struct.unpack('>L', n)[0]  # big endian 32 bits
-        s = self._recv(n)
-        while len(s) < n:
-            t = self._recv(n - len(s))
-            if len(t) == 0:
-                raise EOFError
-            s += t
+        If given, announce(uuid) is called with the uuid of the blob once it
+        is known, before anything is sent.
+        """
+        log.debug("sending file '%s'" % filename)
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            sha1sum = hashlib.sha1()
+            n = 0
+            while n < size:
+                chunk = f.read(min(FILE_CHUNK_SIZE, size - n))
+                if not chunk:
+                    break
+                sha1sum.update(chunk)
+                n += len(chunk)
+            # n < size only if the file was truncated while we read it
+            size = n
+            s = uuid_from_sha1_hex(sha1sum.hexdigest())
+            if announce is not None:
+                announce(s)
+            f.seek(0)
+            self._send_blob_header(s, size)
+            sent = self._send_file_data(f, size)
+        if sent < size:
+            # keep the framing intact, so the connection remains usable.
+            while sent < size:
+                k = min(FILE_CHUNK_SIZE, size - sent)
+                self._conn.sendall(b'\0' * k)
+                sent += k
+            raise RuntimeError("file '%s' changed while it was being sent" %
+                               filename)
+        self.stats['sent_blobs'] += 1
+        self.stats['sent_blob_bytes'] += size
+        return s
 
-        if six.PY3:
-            # bystream to string, in particular s[0] will be e.g. 'j' and not 106
-            #log("ConnectionJSON::recv s=%s... (type %s)" % (s[:5], type(s)))
-            # is s always of type bytes?
-            if type(s) == bytes:
-                s = s.decode('utf8')
+    def _send_file_data(self, f, size):
+        if not size:
+            # sendfile would send everything up to the end of the file
+            return 0
+        if hasattr(self._conn, 'sendfile'):
+            # zero copy on Linux (os.sendfile); falls back to send internally.
+            return self._conn.sendfile(f, 0, size)
+        sent = 0
+        while sent < size:
+            chunk = f.read(min(FILE_CHUNK_SIZE, size - sent))
+            if not chunk:
+                break
+            self._conn.sendall(chunk)
+            sent += len(chunk)
+        return sent
+
+    def _recv_into(self, view):
+        """
+        Fill the memoryview ``view`` completely from the socket.
+        """
+        n = len(view)
+        got = 0
+        while got < n:
+            # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
+            for i in range(20):
+                try:
+                    k = self._conn.recv_into(view[got:], n - got)
+                    break
+                except OSError as e:
+                    if e.errno != 4:
+                        raise
+            else:
+                raise EOFError
+            if k == 0:
+                raise EOFError
+            got += k
 
-        if s[0] == 'j':
+    def recv(self):
+        self._recv_into(self._header_view)
+        n = struct.unpack('>L', self._header)[0]  # big endian 32 bits
+        if n == 0:
+            raise ValueError("empty message")
+
+        # Receive the message into a reusable buffer (or a fresh one if it is
+        # large, so that we don't hold on to it after the message is handled).
+        if n <= RECV_BUFFER_SIZE:
+            view = self._buffer_view[:n]
+        else:
+            view = memoryview(bytearray(n))
+        self._recv_into(view)
+        self.stats['received_messages'] += 1
+        self.stats['received_bytes'] += n
+
+        # Dispatch on the type byte *before* decoding anything.
+        typ = view[:1].tobytes()
+        if typ == b'j':
+            t = timer()
             try:
-                return 'json', json.loads(s[1:])
+                mesg = self._codec.loads(view[1:])
             except Exception as msg:
-                log("Unable to parse JSON '%s'" % s[1:])
+                log.error("Unable to parse JSON '%s'" % view[1:].tobytes())
                 raise
+            self.stats['decode_time'] += timer() - t
+            return 'json', mesg
+        elif typ == b'b':
+            # blobs are binary data, so they are returned as bytes.
+            return 'blob', view[1:].tobytes()
+        raise ValueError("unknown message type '%s'" % typ)
 
-        elif s[0] == 'b':
-            return 'blob', s[1:]
-        raise ValueError("unknown message type '%s'" % s[0])
+
+# Messages up to this many bytes are received into a buffer that is
+# preallocated once per connection.
+RECV_BUFFER_SIZE = 1 << 20
 
 
 def truncate_text(s, max_size):
@@ -469,47 +825,180 @@ def client1(port, hostname):
 
 
 class BufferedOutputStream(object):
-    def __init__(self, f, flush_size=4096, flush_interval=.1):
+    """
+    File-like object that sends what is written to it to the function f
+    (e.g., salvus.stdout), coalescing writes into as few output messages
+    as possible.
+
+    Output is sent once flush_size characters are buffered, or
+    flush_interval seconds after it was last sent.  While output keeps
+    coming faster than that, both double (up to max_flush_size and
+    max_flush_interval); as soon as it pauses for flush_interval, they
+    go back to their initial values.
+
+    If budget is given, budget() must return how many more bytes of
+    output messages and how many more messages the cell may send (see
+    Salvus._output_budget).  Output that does not fit is not sent: the
+    first part that fits is, and the next explicit flush sends the last
+    tail_size characters along with how many were elided in between,
+    instead of the cell being terminated.
+    """
+    def __init__(self,
+                 f,
+                 flush_size=4096,
+                 flush_interval=.1,
+                 max_flush_size=32768,
+                 max_flush_interval=2.0,
+                 budget=None,
+                 tail_size=4096):
         self._f = f
-        self._buf = ''
-        self._flush_size = flush_size
-        self._flush_interval = flush_interval
+        self._chunks = []
+        self._size = 0
+        self._base_flush_size = flush_size
+        self._base_flush_interval = flush_interval
+        self._max_flush_size = max_flush_size
+        self._max_flush_interval = max_flush_interval
+        self._budget = budget
+        self._tail_size = tail_size
+        # number of characters elided since the last flush; None until
+        # the output no longer fits in the budget
+        self._elided = None
         self.reset()
 
     def reset(self):
-        self._last_flush_time = time.time()
+        self._flush_size = self._base_flush_size
+        self._flush_interval = self._base_flush_interval
+        self._last_flush_time = self._last_write_time = timer()
 
     def fileno(self):
         return 0
 
+    def pending(self):
+        """
+        Return True if there is output that the next flush() will send.
+        """
+        return bool(self._chunks) or bool(self._elided)
+
     def write(self, output):
         # CRITICAL: we need output to valid PostgreSQL TEXT, so no null bytes
         # This is not going to silently corrupt anything -- it's just output that
         # is destined to be *rendered* in the browser.  This is only a partial
         # solution to a more general problem, but it is safe.
         try:
-            self._buf += output.replace('\x00', '')
+            output = output.replace('\x00', '')
         except UnicodeDecodeError:
-            self._buf += output.decode('utf-8').replace('\x00', '')
-        #self.flush()
-        t = time.time()
-        if ((len(self._buf) >= self._flush_size)
-                or (t - self._last_flush_time >= self._flush_interval)):
-            self.flush()
-            self._last_flush_time = t
+            output = output.decode('utf-8').replace('\x00', '')
+        self._chunks.append(output)
+        self._size += len(output)
+        t = timer()
+        if t - self._last_write_time >= self._base_flush_interval:
+            # output paused, so be responsive again
+            self._flush_size = self._base_flush_size
+            self._flush_interval = self._base_flush_interval
+        self._last_write_time = t
+        if self._size >= self._flush_size:
+            if t - self._last_flush_time < self._flush_interval:
+                self._flush_size = min(2 * self._flush_size,
+                                       self._max_flush_size)
+                self._flush_interval = min(2 * self._flush_interval,
+                                           self._max_flush_interval)
+            self._send(t)
+        elif t - self._last_flush_time >= self._flush_interval:
+            self._flush_interval = min(2 * self._flush_interval,
+                                       self._max_flush_interval)
+            self._send(t)
+
+    def _join(self):
+        try:
+            return ''.join(self._chunks)
+        except UnicodeDecodeError:  # Python 2: mixed unicode and utf-8 str
+            return u''.join(
+                c.decode('utf-8', 'replace') if isinstance(c, bytes) else c
+                for c in self._chunks)
 
-    def flush(self, done=False):
-        if not self._buf and not done:
-            # no point in sending an empty message
-            return
+    def _call(self, output, done):
         try:
-            self._f(self._buf, done=done)
+            self._f(output, done=done)
         except UnicodeDecodeError:
             if six.PY2:  # str doesn't have errors option in python2!
-                self._f(unicode(self._buf, errors='replace'), done=done)
+                self._f(unicode(output, errors='replace'), done=done)
+            else:
+                self._f(str(output, errors='replace'), done=done)
+
+    def _send(self, t):
+        self._last_flush_time = t
+        if self._elided is None:
+            output = self._join()
+            self._chunks = []
+            self._size = 0
+            head = self._head(output)
+            if head is not None:
+                # the rest does not fit -- start eliding
+                self._elided = 0
+                self._chunks = [output[len(head):]]
+                self._size = len(self._chunks[0])
+                if head:
+                    self._call(head, False)
             else:
-                self._f(str(self._buf, errors='replace'), done=done)
-        self._buf = ''
+                self._call(output, False)
+        if self._elided is not None:
+            self._trim()
+
+    def _head(self, output):
+        """
+        Return None if all of output fits in the budget, and otherwise the
+        longest initial part of it that does (leaving room for a summary).
+        """
+        if self._budget is None:
+            return None
+        bytes_left, messages_left = self._budget()
+        # room for this message, the summary and the final done message
+        if messages_left < 3:
+            return ''
+        # JSON encoding can make output longer (and the message has other
+        # fields); the summary is at most about twice tail_size
+        bytes_left -= 2 * self._tail_size + 1000
+        n = len(output)
+        if 6 * n < bytes_left:  # certainly fits
+            return None
+        m = len(json.dumps(output))
+        if m < bytes_left:
+            return None
+        while n > 0 and m > bytes_left:
+            n = max(0, min(n - 1, n * bytes_left // m))
+            m = len(json.dumps(output[:n]))
+        return output[:n]
+
+    def _trim(self):
+        # only keep the last tail_size characters
+        if self._size > self._tail_size:
+            output = self._join()
+            self._elided += len(output) - self._tail_size
+            self._chunks = [output[-self._tail_size:]]
+            self._size = self._tail_size
+
+    def flush(self, done=False):
+        if self._elided:
+            self._trim()
+            tail = self._join()
+            # start the tail at a new line
+            i = tail.find('\n')
+            if 0 <= i < len(tail) - 1:
+                self._elided += i + 1
+                tail = tail[i + 1:]
+            self._chunks = [
+                "\n...(%s characters of output elided)...\n" % self._elided,
+                tail
+            ]
+            self._elided = 0
+        if not self._chunks and not done:
+            # no point in sending an empty message
+            return
+        output = self._join()
+        self._chunks = []
+        self._size = 0
+        self._last_flush_time = timer()
+        self._call(output, done)
 
     def isatty(self):
         return False
@@ -597,8 +1086,400 @@ class TemporaryURL:
         return self.url
 
 
+def cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size (VmHWM) of this process, so that
+    peak_rss() measures from now on.  Linux only; does nothing elsewhere.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in kB.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def memory_usage(pid='self'):
+    """
+    Return the memory usage of the process with the given pid (default:
+    this one) in kB, as a dictionary with keys 'rss', 'pss', 'shared' and
+    'private'.  Pages a session still shares with the sage_server it was
+    forked from count as 'shared'.  Linux only; returns None elsewhere.
+    """
+    fields = {
+        'Rss:': 'rss',
+        'Pss:': 'pss',
+        'Shared_Clean:': 'shared',
+        'Shared_Dirty:': 'shared',
+        'Private_Clean:': 'private',
+        'Private_Dirty:': 'private'
+    }
+    usage = dict(rss=0, pss=0, shared=0, private=0)
+    # smaps_rollup is much cheaper, but only exists since Linux 4.14
+    for name in ['smaps_rollup', 'smaps']:
+        try:
+            with open('/proc/%s/%s' % (pid, name)) as f:
+                for line in f:
+                    v = line.split()
+                    if v and v[0] in fields:
+                        usage[fields[v[0]]] += int(v[1])
+            return usage
+        except (IOError, OSError, ValueError):
+            pass
+    return None
+
+
+class CellProfile(object):
+    """
+    Timings for one cell, collected by Salvus.execute if profiling is
+    enabled (see Salvus.profile).  All times are in seconds and memory is
+    in kB.  For the cell and each block, this records the wall and CPU
+    time and peak RSS, and the time spent in divide_into_blocks, preparsing,
+    compiling, and sending output (including flushing stdout/stderr).
+    """
+    def __init__(self, cell_id=None):
+        self._wall0 = timer()
+        self._cpu0 = cpu_time()
+        self._depth = 0
+        reset_peak_rss()
+        self.data = {
+            'cell_id': cell_id,
+            'divide_into_blocks': 0.0,
+            'preparse': 0.0,
+            'compile': 0.0,
+            'exec': 0.0,
+            'output': 0.0,
+            'output_messages': 0,
+            'blocks': []
+        }
+
+    def add(self, key, t):
+        self.data[key] += t
+
+    def output(self, t):
+        self.data['output'] += t
+        self.data['output_messages'] += 1
+
+    def start_block(self, start, stop):
+        self._depth += 1
+        d = self.data
+        return {
+            'start': start,
+            'stop': stop,
+            'depth': self._depth,
+            # totals at the start of the block; turned into deltas in end_block
+            'wall': timer(),
+            'cpu': cpu_time(),
+            'preparse': d['preparse'],
+            'compile': d['compile'],
+            'output': d['output']
+        }
+
+    def end_block(self, b):
+        self._depth -= 1
+        d = self.data
+        b['wall'] = timer() - b['wall']
+        b['cpu'] = cpu_time() - b['cpu']
+        for k in ['preparse', 'compile', 'output']:
+            b[k] = d[k] - b[k]
+        b['peak_rss'] = peak_rss()
+        d['blocks'].append(b)
+
+    def finish(self):
+        d = self.data
+        d['wall'] = timer() - self._wall0
+        d['cpu'] = cpu_time() - self._cpu0
+        d['peak_rss'] = peak_rss()
+        return d
+
+    def summary(self):
+        """
+        Return a plain text table of the timings.
+        """
+        d = self.data
+        v = [
+            "cell: wall %.3fs  cpu %.3fs  peak rss %s kB" %
+            (d['wall'], d['cpu'], d['peak_rss']),
+            "  divide_into_blocks %.4fs  preparse %.4fs  compile %.4fs  exec %.4fs  output %.4fs (%s messages)"
+            % (d['divide_into_blocks'], d['preparse'], d['compile'], d['exec'],
+               d['output'], d['output_messages'])
+        ]
+        for b in d['blocks']:
+            v.append(
+                "%slines %s-%s: wall %.4fs  cpu %.4fs  preparse %.4fs  compile %.4fs  output %.4fs  peak rss %s kB"
+                % ('  ' * b['depth'], b['start'] + 1, b['stop'] + 1, b['wall'],
+                   b['cpu'], b['preparse'], b['compile'], b['output'],
+                   b['peak_rss']))
+        return '\n'.join(v)
+
+
 namespace = Namespace({})
 
+# LRU cache of completions, docstrings and source code for introspection in namespace
+introspect_cache = sage_parsing.IntrospectCache(
+    int(os.environ.get('COCALC_SAGE_SERVER_INTROSPECT_CACHE_SIZE', 256)))
+
+# LRU cache of the blocks, preparsed blocks and code objects of executed cells,
+# so that running the same cell again (interacts, %auto, run all) goes straight
+# to exec
+execute_cache = sage_parsing.ExecuteCache(
+    int(os.environ.get('COCALC_SAGE_SERVER_EXECUTE_CACHE_SIZE', 1024)))
+
+
+# Prefetch the docstrings and source code of names that cells bind while
+# the session is idle, so that foo? and foo?? are answered from introspect_cache.
+INTROSPECT_PREFETCH = os.environ.get('COCALC_SAGE_SERVER_INTROSPECT_PREFETCH',
+                                     '1') not in ['0', '']
+# names whose docstrings and source code are still to be prefetched (at most 100)
+prefetch_names = collections.OrderedDict()
+
+
+def namespace_changed(x, *args):
+    # every Salvus object (i.e., every execute and introspect request)
+    # rebinds these, which doesn't invalidate anything
+    if x in ('salvus', 'smc', 'require', 'sage_salvus'):
+        return
+    introspect_cache.changed()
+    if args and INTROSPECT_PREFETCH and not x.startswith('_'):
+        prefetch_names.pop(x, None)
+        prefetch_names[x] = True
+        if len(prefetch_names) > 100:
+            prefetch_names.popitem(last=False)
+    elif not args:  # deleted
+        prefetch_names.pop(x, None)
+
+
+def prefetch_introspection():
+    """
+    Compute what foo? and foo?? would show for the name foo that was
+    bound longest ago in prefetch_names, and cache it in introspect_cache.
+    """
+    name, _ = prefetch_names.popitem(last=False)
+    obj = dict.get(namespace, name)
+    if not (callable(obj) or isinstance(obj, type(sys))):
+        # docstrings of numbers, lists, etc., are rarely wanted
+        return
+    try:
+        for line in [name + '?', name + '??']:
+            sage_parsing.introspect(line,
+                                    namespace=namespace,
+                                    preparse=False,
+                                    cache=introspect_cache)
+    except (Exception, KeyboardInterrupt) as err:
+        # e.g., interrupted by the 1 second limit of introspect
+        log.debug("prefetching introspection of %s failed -- %s" %
+                  (name, err))
+
+
+class IncrementalExecution(object):
+    r"""
+    Bookkeeping for incremental execution (see Salvus.incremental): when
+    each global name last changed, and which names each cell reads and
+    writes, according to sage_parsing.global_names on its preparsed blocks
+    and to the names it actually bound or deleted.
+
+    A cell may be skipped, and its output replayed, if its code is the same
+    as when it last executed successfully, and none of the names it read
+    or wrote have changed since then.  Cells that read a name they also
+    write (e.g., x = x + 1), that have code decorators (other than %auto,
+    %hide, %hideall and %sage, see transparent), or that use names in ways
+    global_names can't follow are always executed.
+
+    A cell that calls a function also reads (and might change) the names
+    the body of the function reads (and changes), so it is executed again
+    when they change too.
+    """
+    # every Salvus object (i.e., every execute request) rebinds these
+    ignore = ('salvus', 'smc', 'require', 'sage_salvus')
+    # code decorators that just execute the code
+    transparent = ('auto', 'hide', 'hideall', 'sage')
+    # output that refers to state outside of the cell
+    unreplayable = ('file', 'interact', 'raw_input')
+
+    def __init__(self, max_output=10000000):
+        # max total size of the recorded output of all cells
+        self.max_output = max_output
+        self.version = 0
+        self.versions = {}  # name --> version when it last changed
+        self.uses = {}  # name of function --> names its body reads
+        self.call_changes = {}  # name of function --> what calling it changes
+        # names last bound by cells that were analyzed
+        self.analyzed = set()
+        # cell_id --> what it read, wrote and output the last time it was
+        # executed successfully, least recently executed first
+        self.cells = collections.OrderedDict()
+        self.output_size = 0
+        self._cell = None  # the cell being tracked, if any
+
+    def changed(self, x, *args):
+        """
+        Record that x was bound or deleted (a Namespace 'change' and 'del'
+        callback).
+        """
+        if x in self.ignore:
+            return
+        self.analyzed.discard(x)
+        self.version += 1
+        self.versions[x] = self.version
+        if self._cell is not None:
+            self._cell['changed'].add(x)
+
+    def skip(self, cell_id, code, preparse):
+        """
+        Return the output messages to send instead of executing code in
+        the cell with id cell_id, or None if it has to be executed.
+        """
+        cell = self.cells.get(cell_id)
+        if cell is None or cell['code'] != code or cell['preparse'] != preparse:
+            return None
+        for x, version in cell['versions'].items():
+            if self.versions.get(x, 0) != version:
+                return None
+        self.cells[cell_id] = self.cells.pop(cell_id)  # most recently used
+        return cell['output']
+
+    def start(self, cell_id, code, preparse):
+        """
+        Start tracking the execution of code in the cell with id cell_id.
+        """
+        self._forget(cell_id)
+        self._cell = {
+            'id': cell_id,
+            'code': code,
+            'preparse': preparse,
+            'blocks': [],  # or None, if they can't be analyzed
+            'reads': set(),
+            'changed': set(),
+            'ok': True,
+            'output': [],  # or None, if it can't be replayed
+            'output_size': 0
+        }
+
+    def block(self, block):
+        """
+        The tracked cell executes block (after preparsing).
+        """
+        if self._cell['blocks'] is not None:
+            self._cell['blocks'].append(block)
+
+    def code_decorators(self, code_decorators):
+        """
+        The tracked cell applies code_decorators.
+        """
+        for name in code_decorators:
+            if name.strip() in self.transparent:
+                self._cell['reads'].add(name.strip())
+            else:
+                self._cell['blocks'] = None
+
+    def output(self, mesg, size):
+        """
+        The tracked cell sent the output message mesg of the given size, or
+        something that can't be replayed, if mesg is None.
+        """
+        cell = self._cell
+        if cell['output'] is None:
+            return
+        if mesg is None or any(key in mesg for key in self.unreplayable):
+            cell['output'] = None
+            return
+        mesg = dict(mesg)
+        for key in ['id', 'done']:
+            mesg.pop(key, None)
+        if len(mesg) > 1:  # not just the event, e.g., the final done message
+            cell['output'].append(mesg)
+            cell['output_size'] += size
+
+    def error(self):
+        """
+        The tracked cell raised an exception.
+        """
+        self._cell['ok'] = False
+
+    def finish(self, ok):
+        """
+        The tracked cell is done executing; ok is whether it ran to the end
+        and its output is complete.
+        """
+        cell, self._cell = self._cell, None
+        if cell['blocks'] is None:
+            return
+        names = sage_parsing.global_names('\n'.join(cell['blocks']))
+        if names is None:
+            return
+        reads, writes, uses, changes = names
+        self.uses.update(uses)
+        self.call_changes.update(changes)
+        # calling a function reads and might change what its body does, and
+        # what the functions it calls do
+        todo = list(reads)
+        while todo:
+            x = todo.pop()
+            writes.update(self.call_changes.get(x, ()))
+            for y in self.uses.get(x, ()):
+                if y not in reads:
+                    reads.add(y)
+                    todo.append(y)
+        # changes in place (and via global statements) don't go through
+        # the namespace callbacks
+        for x in writes - cell['changed']:
+            self.changed(x)
+        self.analyzed.update(writes)
+        writes.update(cell['changed'])
+        if not (ok and cell['ok']) or cell['output'] is None:
+            return
+        if reads & writes:  # e.g., x = x + 1
+            return
+        for x in reads:
+            # what calling functions and classes bound by other cells
+            # changes is unknown
+            if (self.versions.get(x) and x not in self.analyzed
+                    and callable(dict.get(namespace, x))):
+                return
+        names = reads | writes | cell['reads']
+        self.cells[cell['id']] = {
+            'code': cell['code'],
+            'preparse': cell['preparse'],
+            'versions': dict((x, self.versions.get(x, 0)) for x in names),
+            'output': cell['output'],
+            'output_size': cell['output_size']
+        }
+        self.output_size += cell['output_size']
+        while self.output_size > self.max_output:
+            self._forget(next(iter(self.cells)))
+
+    def _forget(self, cell_id):
+        cell = self.cells.pop(cell_id, None)
+        if cell is not None:
+            self.output_size -= cell['output_size']
+
+    def clear(self):
+        self.cells.clear()
+        self.output_size = 0
+        self._cell = None
+
+
+# see Salvus.incremental
+incremental = IncrementalExecution()
+
 
 class Salvus(object):
     """
@@ -624,12 +1505,25 @@ class Salvus(object):
 
         sage_server.MAX_OUTPUT            # max total character output for a single cell; computation
                                           # terminated/truncated if sum of above exceeds this.
+
+    Printed output (stdout and stderr) that would exceed these limits is not sent; instead,
+    its beginning and end are shown, along with how many characters were elided in between.
     """
     Namespace = Namespace
     _prefix = ''
     _postfix = ''
     _default_mode = 'sage'
     _py_features = {}
+    # profile every cell; see Salvus.profile
+    _profile = os.environ.get('COCALC_SAGE_SERVER_PROFILE', '') not in ('',
+                                                                        '0')
+    _profile_show = False
+    # skip cells whose code and inputs are unchanged; see Salvus.incremental
+    _incremental = os.environ.get('COCALC_SAGE_SERVER_INCREMENTAL',
+                                  '') not in ('', '0')
+    # uuid --> when the blob that the hub saved with that uuid during this
+    # session expires (0 if never); see Salvus.file
+    _saved_blobs = {}
 
     def _flush_stdio(self):
         """
@@ -654,6 +1548,13 @@ class Salvus(object):
         self.namespace = namespace
         self.message_queue = message_queue
         self.code_decorators = []  # gets reset if there are code decorators
+        self._cell_profile = None  # set by execute() if profiling is on
+        self._tracking = False  # set by execute() if this cell is tracked
+        # list that the output messages are appended to while an interact
+        # with a cache is evaluated
+        self._interact_output = None
+        # InteractCancellation of the interact being evaluated, if any
+        self._interact_cancellation = None
         # Alias: someday remove all references to "salvus" and instead use smc.
         # For now this alias is easier to think of and use.
         namespace['smc'] = namespace[
@@ -667,6 +1568,9 @@ class Salvus(object):
     def _send_output(self, *args, **kwds):
         if self._output_warning_sent:
             raise KeyboardInterrupt
+        if self._interact_cancellation is not None:
+            # may raise InteractCancelled; nothing is being sent right now
+            self._interact_cancellation.check()
         mesg = message.output(*args, **kwds)
         if not mesg.get('once', False):
             self._num_output_messages += 1
@@ -680,8 +1584,17 @@ class Salvus(object):
                 message.output(stderr=err, id=self._id, once=False, done=True))
             raise KeyboardInterrupt
 
-        n = self._conn.send_json(mesg)
+        if self._cell_profile is None:
+            n = self._conn.send_json(mesg)
+        else:
+            t = timer()
+            n = self._conn.send_json(mesg)
+            self._cell_profile.output(timer() - t)
         self._total_output_length += n
+        if self._tracking:
+            incremental.output(mesg, n)
+        if self._interact_output is not None:
+            self._interact_output.append(mesg)
 
         if self._total_output_length > sage_server.MAX_OUTPUT:
             self._output_warning_sent = True
@@ -691,6 +1604,15 @@ class Salvus(object):
                 message.output(stderr=err, id=self._id, once=False, done=True))
             raise KeyboardInterrupt
 
+    def _output_budget(self):
+        """
+        Return how many more bytes of output messages and how many more
+        output messages this cell may send before it gets terminated.
+        """
+        from . import sage_server
+        return (sage_server.MAX_OUTPUT - self._total_output_length,
+                sage_server.MAX_OUTPUT_MESSAGES - self._num_output_messages)
+
     def obj(self, obj, done=False):
         self._send_output(obj=obj, id=self._id, done=done)
         return self
@@ -922,7 +1844,8 @@ class Salvus(object):
              once=False,
              events=None,
              raw=False,
-             text=None):
+             text=None,
+             file_uuid=None):
         """
         Display or provide a link to the given file.  Raises a RuntimeError if this
         is not possible, e.g, if the file is too large.
@@ -961,7 +1884,9 @@ class Salvus(object):
 
         The uuid is based on the Sha-1 hash of the file content (it is computed using the
         function sage_server.uuidsha1).  Any two files with the same content have the
-        same Sha1 hash.
+        same Sha1 hash.  If the caller already knows it, it may pass it as file_uuid;
+        then the file is not sent again if the server already stored it during this
+        session (and it does not expire soon).
         """
         filename = unicode8(filename)
         if raw:
@@ -991,20 +1916,83 @@ class Salvus(object):
             else:
                 return TemporaryURL(url=url, ttl=0)
 
-        file_uuid = self._conn.send_file(filename)
-
-        mesg = None
-        while mesg is None:
-            self.message_queue.recv()
-            for i, (typ, m) in enumerate(self.message_queue.queue):
-                if typ == 'json' and m.get('event') == 'save_blob' and m.get(
-                        'sha1') == file_uuid:
-                    mesg = m
-                    del self.message_queue[i]
-                    break
+        if file_uuid is not None:
+            ttl = self._saved_blob_ttl(file_uuid)
+            if ttl is not None:
+                return self._file_output(filename, file_uuid, show, done,
+                                         download, once, events, text,
+                                         {'ttl': ttl})
+        file_uuid = self._send_file(filename)
+        return self._file_output(filename, file_uuid, show, done, download,
+                                 once, events, text)
+
+    def files(self,
+              filenames,
+              show=True,
+              download=False,
+              once=False,
+              events=None,
+              depth=32):
+        """
+        Like file(filename, ...) for each of the given files, but up to
+        depth files are sent before waiting for the server to store the
+        first one, which is much faster for many files (e.g., the frames
+        of an animation).  Returns the list of what file() would return.
+        """
+        filenames = [unicode8(filename) for filename in filenames]
+        uuids = []
+        result = []
+        for filename in filenames:
+            if len(uuids) - len(result) >= depth:
+                i = len(result)
+                result.append(
+                    self._file_output(filenames[i], uuids[i], show, False,
+                                      download, once, events, None))
+            uuids.append(self._send_file(filename))
+        for i in range(len(result), len(filenames)):
+            result.append(
+                self._file_output(filenames[i], uuids[i], show, False,
+                                  download, once, events, None))
+        return result
+
+    def _send_file(self, filename):
+        # expect the ack before the blob goes out, so that it is kept aside
+        # for wait_ack however soon it arrives and whoever reads it
+        return self._conn.send_file(filename,
+                                    announce=self.message_queue.expect_ack)
+
+    def _saved_blob_ttl(self, file_uuid, margin=600):
+        """
+        Return the remaining time to live of the blob with the given uuid if
+        the server saved it during this session and it does not expire in
+        the next margin seconds (0 if it never expires), and None otherwise.
+        """
+        expires = Salvus._saved_blobs.get(file_uuid)
+        if expires is None:
+            return None
+        if not expires:
+            return 0
+        ttl = int(expires - time.time())
+        return ttl if ttl > margin else None
+
+    def _file_output(self,
+                     filename,
+                     file_uuid,
+                     show,
+                     done,
+                     download,
+                     once,
+                     events,
+                     text,
+                     mesg=None):
+        # mesg is the save_blob ack, if the file wasn't sent again
+        if mesg is None:
+            mesg = self.message_queue.wait_ack(file_uuid)
 
         if 'error' in mesg:
             raise RuntimeError("error saving blob -- %s" % mesg['error'])
+        ttl = mesg.get('ttl', 0)
+        Salvus._saved_blobs[file_uuid] = time.time() + ttl if ttl else 0
 
         self._flush_stdio()
         self._send_output(id=self._id,
@@ -1131,6 +2119,113 @@ class Salvus(object):
         else:
             Salvus._postfix = postfix
 
+    def profile(self, enable=None, show=False):
+        """
+        Turn profiling of cell execution on or off for this worksheet.
+
+        When profiling is on, every cell records the wall time, CPU time and
+        peak memory (RSS) of each block of code it runs, along with the time
+        spent dividing the cell into blocks, preparsing, compiling, and
+        sending output.  These are sent as a JSON object at the end of the
+        cell, in an output message with once=True and obj={'profile': ...},
+        which is not saved in the worksheet.
+
+        To profile all worksheets, set the environment variable
+        COCALC_SAGE_SERVER_PROFILE=1 before starting the Sage server.
+
+        INPUT:
+
+        - ``enable`` -- None (to return whether profiling is on), True or False
+        - ``show`` -- (default: False) if True, also display a summary of the
+          timings below each cell
+
+        EXAMPLES:
+
+            salvus.profile(True, show=True)
+        """
+        if enable is None:
+            return Salvus._profile
+        Salvus._profile = bool(enable)
+        Salvus._profile_show = bool(show)
+
+    def incremental(self, enable=None):
+        """
+        Turn incremental execution on or off for this worksheet.
+
+        When incremental execution is on, a cell whose code is the same as
+        when it last ran without an error, and none of whose inputs changed
+        since then, is not executed again; instead, its previous output is
+        sent again.  This makes re-running all cells of a worksheet fast
+        when only a few of them changed.
+
+        The inputs of a cell are the global names it reads or writes
+        (including those read or written by the functions it calls), as
+        found by parsing its code.  A cell is always executed if it
+        reads a name it also writes (e.g., ``x = x + 1`` or
+        ``L.append(1)``), has code decorators (other than %auto, %hide,
+        %hideall and %sage), uses names in ways that can't be followed
+        (e.g., via ``globals()``, ``eval`` or ``load``), or asks for input.
+
+        Changes that can't be seen in the code are missed: e.g., if a cell
+        changes an object in place by calling a method other than
+        ``append``, ``update``, ``set_*``, etc., cells that read it are
+        not executed again.  Also, cells with random output, or that read
+        files, show their previous output.  Turn incremental execution off
+        (or change the cell) to force it to run.
+
+        To turn it on for all worksheets, set the environment variable
+        COCALC_SAGE_SERVER_INCREMENTAL=1 before starting the Sage server.
+
+        INPUT:
+
+        - ``enable`` -- None (to return whether incremental execution is
+          on), True or False
+
+        EXAMPLES:
+
+            salvus.incremental(True)
+        """
+        if enable is None:
+            return Salvus._incremental
+        Salvus._incremental = bool(enable)
+        if not enable:
+            incremental.clear()
+
+    def _replay(self, output):
+        """
+        Send the output messages that a cell recorded the last time it ran,
+        and return True, unless one of them shows a blob that may no longer
+        be saved by the time it is shown; then send nothing and return False.
+        """
+        for mesg in output:
+            file_uuid = (mesg.get('file') or {}).get('uuid')
+            if file_uuid is not None and self._saved_blob_ttl(
+                    file_uuid) is None:
+                return False
+        for mesg in output:
+            n = self._conn.send_json(dict(mesg, id=self._id, done=False))
+            self._num_output_messages += 1
+            self._total_output_length += n
+        return True
+
+    def _send_profile(self):
+        prof = self._cell_profile
+        if prof is None:
+            return
+        data = prof.finish()
+        self._conn.send_json(
+            message.output(id=self._id, obj={'profile': data}, once=True))
+        if Salvus._profile_show:
+            self._conn.send_json(
+                message.output(id=self._id,
+                               code={
+                                   'source': prof.summary(),
+                                   'mode': 'text',
+                                   'filename': None,
+                                   'lineno': -1
+                               },
+                               once=True))
+
     def execute(self, code, namespace=None, preparse=True, locals=None):
 
         ascii_warn = False
@@ -1153,8 +2248,16 @@ class Salvus(object):
                                 for feature in Salvus._py_features.values()),
                                0)
 
+        prof = self._cell_profile
+        if prof is not None:
+            t = timer()
+
         #code   = sage_parsing.strip_leading_prompts(code)  # broken -- wrong on "def foo(x):\n   print(x)"
-        blocks = sage_parsing.divide_into_blocks(code)
+        dec_keys = []
+        blocks = execute_cache.divide_into_blocks(code, dec_keys)
+
+        if prof is not None:
+            prof.add('divide_into_blocks', timer() - t)
 
         try:
             import sage.repl
@@ -1167,49 +2270,61 @@ class Salvus(object):
         except:
             pass  # expected behavior usually, since sage.repl.interpreter usually not imported (only used by command line...)
 
-        import sage.misc.session
-        for start, stop, block in blocks:
-            # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
-            try:
-                do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
-            except:
-                do_pp = True
-            if preparse and do_pp:
-                block = sage_parsing.preparse_code(block)
-            sys.stdout.reset()
-            sys.stderr.reset()
-            try:
-                b = block.rstrip()
-                # get rid of comments at the end of the line -- issue #1835
-                #from ushlex import shlex
-                #s = shlex(b)
-                #s.commenters = '#'
-                #s.quotes = '"\''
-                #b = ''.join(s)
-                # e.g. now a line like 'x = test?   # bar' becomes 'x=test?'
-                if b.endswith('??'):
-                    p = sage_parsing.introspect(b,
-                                                namespace=namespace,
-                                                preparse=False)
-                    self.code(source=p['result'], mode="python")
-                elif b.endswith('?'):
-                    p = sage_parsing.introspect(b,
-                                                namespace=namespace,
-                                                preparse=False)
-                    self.code(source=p['result'], mode="text/x-rst")
-                else:
-                    reload_attached_files_if_mod_smc()
-                    if execute.count < 2:
-                        execute.count += 1
-                        if execute.count == 2:
-                            # this fixup has to happen after first block has executed (os.chdir etc)
-                            # but before user assigns any variable in worksheet
-                            # sage.misc.session.init() is not called until first call of show_identifiers
-                            # BUGFIX: be careful to *NOT* assign to _!!  see https://github.com/sagemathinc/cocalc/issues/1107
-                            block2 = "sage.misc.session.state_at_init = dict(globals());sage.misc.session._dummy=sage.misc.session.show_identifiers();\n"
-                            exec(compile(block2, '', 'single'), namespace,
-                                 locals)
-                            b2a = """
+        try:
+            import sage.misc.session
+            for start, stop, block in blocks:
+                if prof is not None:
+                    prof_block = prof.start_block(start, stop)
+                # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
+                try:
+                    do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
+                except:
+                    do_pp = True
+                if preparse and do_pp:
+                    if prof is None:
+                        block = execute_cache.preparse_code(block)
+                    else:
+                        t = timer()
+                        block = execute_cache.preparse_code(block)
+                        prof.add('preparse', timer() - t)
+                if self._tracking:
+                    incremental.block(block)
+                sys.stdout.reset()
+                sys.stderr.reset()
+                try:
+                    b = block.rstrip()
+                    # get rid of comments at the end of the line -- issue #1835
+                    #from ushlex import shlex
+                    #s = shlex(b)
+                    #s.commenters = '#'
+                    #s.quotes = '"\''
+                    #b = ''.join(s)
+                    # e.g. now a line like 'x = test?   # bar' becomes 'x=test?'
+                    if b.endswith('??'):
+                        p = sage_parsing.introspect(b,
+                                                    namespace=namespace,
+                                                    preparse=False,
+                                                    cache=introspect_cache)
+                        self.code(source=p['result'], mode="python")
+                    elif b.endswith('?'):
+                        p = sage_parsing.introspect(b,
+                                                    namespace=namespace,
+                                                    preparse=False,
+                                                    cache=introspect_cache)
+                        self.code(source=p['result'], mode="text/x-rst")
+                    else:
+                        reload_attached_files_if_mod_smc()
+                        if execute.count < 2:
+                            execute.count += 1
+                            if execute.count == 2:
+                                # this fixup has to happen after first block has executed (os.chdir etc)
+                                # but before user assigns any variable in worksheet
+                                # sage.misc.session.init() is not called until first call of show_identifiers
+                                # BUGFIX: be careful to *NOT* assign to _!!  see https://github.com/sagemathinc/cocalc/issues/1107
+                                block2 = "sage.misc.session.state_at_init = dict(globals());sage.misc.session._dummy=sage.misc.session.show_identifiers();\n"
+                                exec(compile(block2, '', 'single'), namespace,
+                                     locals)
+                                b2a = """
 if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP_FILE']):
     try:
         load(os.environ['SAGE_STARTUP_FILE'])
@@ -1219,64 +2334,84 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         sys.stderr.flush()
         raise
 """
-                            exec(compile(b2a, '', 'exec'), namespace, locals)
-                    features = sage_parsing.get_future_features(
-                        block, 'single')
-                    if features:
-                        compile_flags = reduce(
-                            operator.or_, (feature.compiler_flag
-                                           for feature in features.values()),
-                            compile_flags)
-                    exec(
-                        compile(block + '\n',
-                                '',
-                                'single',
-                                flags=compile_flags), namespace, locals)
-                    if features:
-                        Salvus._py_features.update(features)
-                sys.stdout.flush()
-                sys.stderr.flush()
-            except:
-                if ascii_warn:
-                    sys.stderr.write(
-                        '\n\n*** WARNING: Code contains non-ascii characters    ***\n'
-                    )
-                    for c in '\u201c\u201d':
-                        if c in code:
-                            sys.stderr.write(
-                                '*** Maybe the character < %s > should be replaced by < " > ? ***\n'
-                                % c)
-                            break
-                    sys.stderr.write('\n\n')
-
-                if six.PY2:
-                    from exceptions import SyntaxError, TypeError
-                # py3: all standard errors are available by default via "builtin", not available here for some reason ...
-                if six.PY3:
-                    from builtins import SyntaxError, TypeError
-
-                exc_type, _, _ = sys.exc_info()
-                if exc_type in [SyntaxError, TypeError]:
-                    from .sage_parsing import strip_string_literals
-                    code0, _, _ = strip_string_literals(code)
-                    implicit_mul = RE_POSSIBLE_IMPLICIT_MUL.findall(code0)
-                    if len(implicit_mul) > 0:
-                        implicit_mul_list = ', '.join(
-                            str(_) for _ in implicit_mul)
-                        # we know there is a SyntaxError and there could be an implicit multiplication
+                                exec(compile(b2a, '', 'exec'), namespace, locals)
+                        if prof is None:
+                            features, c = execute_cache.compile(
+                                block, compile_flags)
+                        else:
+                            t = timer()
+                            features, c = execute_cache.compile(
+                                block, compile_flags)
+                            prof.add('compile', timer() - t)
+                        if features:
+                            compile_flags = reduce(
+                                operator.or_, (feature.compiler_flag
+                                               for feature in features.values()),
+                                compile_flags)
+                        if prof is None:
+                            exec(c, namespace, locals)
+                        else:
+                            t1 = timer()
+                            try:
+                                exec(c, namespace, locals)
+                            finally:
+                                if prof_block['depth'] == 1:
+                                    # nested blocks (e.g., from code decorators) are part of this
+                                    prof.add('exec', timer() - t1)
+                        if features:
+                            Salvus._py_features.update(features)
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    if prof is not None:
+                        prof.end_block(prof_block)
+                except:
+                    if prof is not None:
+                        prof.end_block(prof_block)
+                    if self._tracking:
+                        incremental.error()
+                    if ascii_warn:
                         sys.stderr.write(
-                            '\n\n*** WARNING: Code contains possible implicit multiplication    ***\n'
+                            '\n\n*** WARNING: Code contains non-ascii characters    ***\n'
                         )
-                        sys.stderr.write(
-                            '*** Check if any of [ %s ] need a "*" sign for multiplication, e.g. 5x should be 5*x ! ***\n\n'
-                            % implicit_mul_list)
-
-                sys.stdout.flush()
-                sys.stderr.write('Error in lines %s-%s\n' %
-                                 (start + 1, stop + 1))
-                traceback.print_exc()
-                sys.stderr.flush()
-                break
+                        for c in '\u201c\u201d':
+                            if c in code:
+                                sys.stderr.write(
+                                    '*** Maybe the character < %s > should be replaced by < " > ? ***\n'
+                                    % c)
+                                break
+                        sys.stderr.write('\n\n')
+
+                    if six.PY2:
+                        from exceptions import SyntaxError, TypeError
+                    # py3: all standard errors are available by default via "builtin", not available here for some reason ...
+                    if six.PY3:
+                        from builtins import SyntaxError, TypeError
+
+                    exc_type, _, _ = sys.exc_info()
+                    if exc_type in [SyntaxError, TypeError]:
+                        from .sage_parsing import strip_string_literals
+                        code0, _, _ = strip_string_literals(code)
+                        implicit_mul = RE_POSSIBLE_IMPLICIT_MUL.findall(code0)
+                        if len(implicit_mul) > 0:
+                            implicit_mul_list = ', '.join(
+                                str(_) for _ in implicit_mul)
+                            # we know there is a SyntaxError and there could be an implicit multiplication
+                            sys.stderr.write(
+                                '\n\n*** WARNING: Code contains possible implicit multiplication    ***\n'
+                            )
+                            sys.stderr.write(
+                                '*** Check if any of [ %s ] need a "*" sign for multiplication, e.g. 5x should be 5*x ! ***\n\n'
+                                % implicit_mul_list)
+
+                    sys.stdout.flush()
+                    sys.stderr.write('Error in lines %s-%s\n' %
+                                     (start + 1, stop + 1))
+                    traceback.print_exc()
+                    sys.stderr.flush()
+                    break
+        finally:
+            # the dec_args of code decorators in the blocks are no longer needed
+            sage_parsing.release_dec_args(dec_keys)
 
     def execute_with_code_decorators(self,
                                      code_decorators,
@@ -1292,6 +2427,9 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         if is_string(code_decorators):
             code_decorators = [code_decorators]
 
+        if self._tracking:
+            incremental.code_decorators(code_decorators)
+
         if preparse:
             code_decorators = list(
                 map(sage_parsing.preparse_code, code_decorators))
@@ -1448,7 +2586,16 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
             print("(Evaluate this cell to use this interact.)")
             #raise RuntimeError("Error: No interact with id %s"%id)
         else:
-            sage_salvus.interacts[id](vals)
+            try:
+                with interact_cancellation(self.message_queue,
+                                           id) as cancellation:
+                    self._interact_cancellation = cancellation
+                    try:
+                        sage_salvus.interacts[id](vals)
+                    finally:
+                        self._interact_cancellation = None
+            except sage_salvus.InteractCancelled:
+                pass
 
     def interact(self, f, done=False, once=None, **kwds):
         I = sage_salvus.InteractCell(f, **kwds)
@@ -1534,8 +2681,12 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         if placeholder:
             m['placeholder'] = unicode8(placeholder)
         self._send_output(raw_input=m, id=self._id)
+        if self._tracking:
+            incremental.output(None, 0)
         typ, mesg = self.message_queue.next_mesg()
-        log("handling raw input message ", truncate_text(unicode8(mesg), 400))
+        if log.debugging:
+            log.debug("handling raw input message ",
+                      truncate_text(unicode8(mesg), 400))
         if typ == 'json' and mesg['event'] == 'sage_raw_input':
             # everything worked out perfectly
             self.delete_last_output()
@@ -1613,6 +2764,8 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
 
         See the docs for the top-level javascript function for more details.
         """
+        if self._tracking:
+            incremental.output(None, 0)
         self._conn.send_json(
             message.execute_javascript(code,
                                        coffeescript=coffeescript,
@@ -1715,6 +2868,34 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         """
         return INFO
 
+    def connection_stats(self):
+        """
+        Return a dictionary of counters for the connection between this
+        worksheet session and the hub: number of JSON messages and bytes sent
+        and received, the largest message, time spent encoding and decoding
+        JSON (in seconds), and the number of blobs and their total size.
+
+        The JSON codec is the stdlib json module, unless the environment
+        variable COCALC_SAGE_SERVER_JSON was set to 'ujson' or 'orjson'
+        before starting the server (and that module is installed).  These
+        are faster, but orjson writes NaN and infinity as null.
+        """
+        return dict(self._conn.stats)
+
+    def memory_usage(self):
+        """
+        Return the memory usage of this worksheet session in kB: 'shared' is
+        memory still shared with the Sage server process it was forked from
+        (mostly the imported Sage library), 'private' is memory used only by
+        this session, and 'pss' counts shared memory proportionally.
+
+        EXAMPLES::
+
+            sage: salvus.memory_usage()
+            {'rss': 312040, 'pss': 98211, 'shared': 254112, 'private': 57928}
+        """
+        return memory_usage()
+
 
 if six.PY2:
     Salvus.pdf.__func__.__doc__ = sage_salvus.show_pdf.__doc__
@@ -1735,14 +2916,18 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
                     data=data,
                     message_queue=message_queue,
                     cell_id=cell_id)
+    if Salvus._profile:
+        salvus._cell_profile = CellProfile(cell_id)
 
     #salvus.start_executing()  # with our new mainly client-side execution this isn't needed; not doing this makes evaluation roundtrip around 100ms instead of 200ms too, which is a major win.
 
     try:
         # initialize the salvus output streams
         streams = (sys.stdout, sys.stderr)
-        sys.stdout = BufferedOutputStream(salvus.stdout)
-        sys.stderr = BufferedOutputStream(salvus.stderr)
+        sys.stdout = BufferedOutputStream(salvus.stdout,
+                                          budget=salvus._output_budget)
+        sys.stderr = BufferedOutputStream(salvus.stderr,
+                                          budget=salvus._output_budget)
         try:
             # initialize more salvus functionality
             sage_salvus.set_salvus(salvus)
@@ -1757,17 +2942,39 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         if salvus._postfix:
             code += '\n' + salvus._postfix
 
-        salvus.execute(code, namespace=namespace, preparse=preparse)
+        ok = False
+        output = None
+        if Salvus._incremental and cell_id is not None:
+            # attached files that changed are reloaded before deciding
+            reload_attached_files_if_mod_smc()
+            output = incremental.skip(cell_id, code, preparse)
+            if output is None:
+                incremental.start(cell_id, code, preparse)
+                salvus._tracking = True
+
+        if output is not None:
+            salvus._replay(output)
+        else:
+            salvus.execute(code, namespace=namespace, preparse=preparse)
+        ok = True
+
+        if salvus._cell_profile is not None:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            salvus._send_profile()
 
     finally:
         # there must be exactly one done message, unless salvus._done is False.
-        if sys.stderr._buf:
-            if sys.stdout._buf:
+        if sys.stderr.pending():
+            if sys.stdout.pending():
                 sys.stdout.flush()
             sys.stderr.flush(done=salvus._done)
         else:
             sys.stdout.flush(done=salvus._done)
         (sys.stdout, sys.stderr) = streams
+        if salvus._tracking:
+            salvus._tracking = False
+            incremental.finish(ok and salvus._done)
 
 
 # execute.count goes from 0 to 2
@@ -1799,10 +3006,18 @@ def drop_privileges(id, home, transient, username):
     sage.misc.misc.DOT_SAGE = home + '/.sage/'
 
 
+# the code the client sends to update an interact
+INTERACT_CODE = 'salvus._execute_interact(salvus.data["id"], salvus.data["vals"])'
+
+
 class MessageQueue(list):
     def __init__(self, conn):
-        self.queue = []
+        self.queue = collections.deque()
         self.conn = conn
+        # sha1 -> number of save_blob acks expected for that blob
+        self._expected = {}
+        # sha1 -> list of save_blob acks that arrived for that blob
+        self._acks = {}
 
     def __repr__(self):
         return "Sage Server Message Queue"
@@ -1820,34 +3035,151 @@ class MessageQueue(list):
         and return it (does not place it in the queue).
         """
         if self.queue:
-            return self.queue.pop()
+            return self.queue.popleft()
         else:
             return self.conn.recv()
 
     def recv(self):
         """
-        Wait until one message is received and enqueue it.
+        Wait until one message is received and enqueue it, unless it is
+        an expected save_blob ack (see expect_ack).
         Also returns the mesg.
         """
         mesg = self.conn.recv()
-        self.queue.insert(0, mesg)
+        typ, m = mesg
+        if typ == 'json' and m.get('event') == 'save_blob' and m.get(
+                'sha1') in self._expected:
+            sha1 = m['sha1']
+            self._expected[sha1] -= 1
+            if not self._expected[sha1]:
+                del self._expected[sha1]
+            self._acks.setdefault(sha1, []).append(m)
+        else:
+            self.queue.append(mesg)
         return mesg
 
+    def expect_ack(self, sha1):
+        """
+        Announce that a blob with the given sha1 is being sent, so that
+        its save_blob ack is kept aside for wait_ack.
+        """
+        self._expected[sha1] = self._expected.get(sha1, 0) + 1
 
-def session(conn):
+    def wait_ack(self, sha1):
+        """
+        Wait for the save_blob ack of a blob announced with expect_ack and
+        return it.  Other messages that arrive meanwhile are enqueued.
+        """
+        while sha1 not in self._acks:
+            self.recv()
+        acks = self._acks[sha1]
+        mesg = acks.pop(0)
+        if not acks:
+            del self._acks[sha1]
+        return mesg
+
+    def receive_pending(self, timeout=0):
+        """
+        Enqueue the messages that arrive within timeout seconds.
+        """
+        deadline = time.time() + timeout
+        while self.conn.poll(max(0, deadline - time.time())):
+            self.recv()
+
+    def newer_interact_update(self, id):
+        """
+        Return the oldest enqueued update of the interact with the given
+        id, or None if there is none.
+        """
+        for typ, m in self.queue:
+            if (typ == 'json' and m.get('event') == 'execute_code'
+                    and m.get('code') == INTERACT_CODE
+                    and (m.get('data') or {}).get('id') == id):
+                return m
+
+
+class InteractCancellation(object):
     """
-    This is run by the child process that is forked off on each new
-    connection.  It drops privileges, then handles the complete
-    compute session.
+    Cancels the evaluation of the interact with the given id once a newer
+    update of it arrives, so that the newer values are evaluated instead of
+    finishing with the old ones.
+
+    The profiling timer (see interact_cancellation) only sets due; check()
+    does the actual work, and is called by Salvus._send_output before each
+    output message, i.e., never while a message is being written to the
+    connection.  So an interact is only cancelled when it sends output.
+    """
+    def __init__(self, message_queue, id):
+        self.message_queue = message_queue
+        self.id = id
+        self.due = False
 
-    INPUT:
+    def check(self):
+        if not self.due:
+            return
+        self.due = False
+        self.message_queue.receive_pending()
+        if self.message_queue.newer_interact_update(self.id) is not None:
+            raise sage_salvus.InteractCancelled()
 
-    - ``conn`` -- the TCP connection
+
+@contextmanager
+def interact_cancellation(message_queue, id, interval=0.1):
     """
-    mq = MessageQueue(conn)
+    Return an InteractCancellation for the interact with the given id,
+    which is due to check for a newer update every interval seconds of CPU
+    time while in this context.
 
-    pid = os.getpid()
+    Uses the profiling timer, since Sage's alarm uses SIGALRM.
+    """
+    cancellation = InteractCancellation(message_queue, id)
 
+    def tick(signum, frame):
+        # nothing else is safe here: the signal may arrive anywhere
+        cancellation.due = True
+
+    old_handler = signal.signal(signal.SIGPROF, tick)
+    old_timer = signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        yield cancellation
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, old_handler)
+        if old_timer[0]:
+            signal.setitimer(signal.ITIMER_PROF, *old_timer)
+
+
+def coalesce_interact_update(conn, mq, mesg):
+    """
+    If mesg is an update of an interact, wait as long as the debounce and
+    throttle options of its changed controls say, and if a newer update of
+    the same interact arrives by then, merge the values of mesg into it and
+    return True, since mesg no longer needs to be evaluated.
+    """
+    if mesg.get('code') != INTERACT_CODE:
+        return False
+    data = mesg.get('data') or {}
+    I = sage_salvus.interacts.get(data.get('id'))
+    vals = data.get('vals')
+    if I is None or not isinstance(vals, dict):
+        return False
+    mq.receive_pending(I.delay(list(vals.keys())))
+    newer = mq.newer_interact_update(data['id'])
+    if newer is None:
+        return False
+    # the newer update only has the controls that changed since mesg
+    newer['data']['vals'] = dict(vals, **newer['data']['vals'])
+    conn.send_json(message.output(id=mesg['id'], done=True))
+    return True
+
+
+def init_session():
+    """
+    Per-process initialization of a freshly forked session.  This is
+    normally done by session() right after the fork, but warm children
+    in the SessionPool do it *before* they have a connection, so it is
+    not on the critical path of the first cell.
+    """
     # seed the random number generator(s)
     import sage.all
     sage.all.set_random_seed()
@@ -1858,18 +3190,79 @@ def session(conn):
     import sage.misc.getusage
     sage.misc.getusage._proc_status = "/proc/%s/status" % os.getpid()
 
+    if SESSION_GC_THRESHOLD:
+        gc.set_threshold(*SESSION_GC_THRESHOLD)
+
+    # cached introspection results are stale once the namespace changes
+    namespace.on('change', None, namespace_changed)
+    namespace.on('del', None, namespace_changed)
+    # so that incremental execution knows when each name last changed
+    namespace.on('change', None, incremental.changed)
+    namespace.on('del', None, incremental.changed)
+
+    init_session.done = True
+
+
+init_session.done = False
+
+
+def session(conn):
+    """
+    This is run by the child process that is forked off on each new
+    connection.  It drops privileges, then handles the complete
+    compute session.
+
+    INPUT:
+
+    - ``conn`` -- the TCP connection
+    """
+    mq = MessageQueue(conn)
+
+    pid = os.getpid()
+
+    if not init_session.done:
+        init_session()
+
     cnt = 0
     while True:
         try:
+            log.flush()  # about to wait for the next message
+            # use idle time to warm the introspection cache, one name at
+            # a time, so a new message never waits for more than one
+            while prefetch_names and not mq.queue and not conn.poll():
+                prefetch_introspection()
+            # start the jupyter kernels that are kept ready, one at a time
+            while not mq.queue and not conn.poll(
+            ) and sage_jupyter.kernels.warm():
+                pass
+            # stop %perl and %ruby interpreters, and jupyter kernels started
+            # in advance, once they have been idle for a while
+            while not mq.queue:
+                wait = [
+                    w for w in (sage_salvus.interpreters.close_idle(),
+                                sage_jupyter.kernels.close_idle())
+                    if w is not None
+                ]
+                if not wait or conn.poll(min(wait)):
+                    break
             typ, mesg = mq.next_mesg()
 
             #print('INFO:child%s: received message "%s"'%(pid, mesg))
-            log("handling message ", truncate_text(unicode8(mesg), 400))
+            if log.debugging:
+                log.debug("handling message ",
+                          truncate_text(unicode8(mesg), 400))
             event = mesg['event']
             if event == 'terminate_session':
+                log("session connection stats: %s" % conn.stats)
+                log("session memory usage (kB): %s" % memory_usage())
+                log("session introspection cache: %s" % introspect_cache.stats)
+                log("session execute cache: %s" % execute_cache.stats)
+                log("session %s" % sage_salvus.render_cache)
                 return
             elif event == 'execute_code':
                 try:
+                    if coalesce_interact_update(conn, mq, mesg):
+                        continue
                     execute(conn=conn,
                             id=mesg['id'],
                             code=mesg['code'],
@@ -1878,7 +3271,8 @@ def session(conn):
                             preparse=mesg.get('preparse', True),
                             message_queue=mq)
                 except Exception as err:
-                    log("ERROR -- exception raised '%s' when executing '%s'" %
+                    log.error(
+                        "ERROR -- exception raised '%s' when executing '%s'" %
                         (err, mesg['code']))
             elif event == 'introspect':
                 try:
@@ -1886,7 +3280,7 @@ def session(conn):
                     prefix = Salvus._default_mode
                     if 'top' in mesg:
                         top = mesg['top']
-                        log('introspect cell top line %s' % top)
+                        log.debug('introspect cell top line %s' % top)
                         if top.startswith("%"):
                             prefix = top[1:]
                     try:
@@ -1895,8 +3289,8 @@ def session(conn):
                                   namespace, locals())
                         kn = eval(prefix + "(get_kernel_name=True)", namespace,
                                   locals())
-                        log("jupyter introspect prefix %s kernel %s" %
-                            (prefix, kn))  # e.g. "p2", "python2"
+                        log.debug("jupyter introspect prefix %s kernel %s" %
+                                  (prefix, kn))  # e.g. "p2", "python2"
                         jupyter_introspect(conn=conn,
                                            id=mesg['id'],
                                            line=mesg['line'],
@@ -1954,7 +3348,7 @@ def jupyter_introspect(conn, id, line, preparse, kc):
             if msg['parent_header'].get('msg_id') != msg_id:
                 continue
 
-            log("jupyter iopub recv %s %s" % (msg_type, str(content)))
+            log.debug("jupyter iopub recv %s %s" % (msg_type, str(content)))
 
             if msg_type == 'status' and content['execution_state'] == 'idle':
                 break
@@ -1974,7 +3368,7 @@ def jupyter_introspect(conn, id, line, preparse, kc):
             if msg['parent_header'].get('msg_id') != msg_id:
                 continue
 
-            log("jupyter shell recv %s %s" % (msg_type, str(content)))
+            log.debug("jupyter shell recv %s %s" % (msg_type, str(content)))
 
             if msg_type == 'complete_reply' and content['status'] == 'ok':
                 # jupyter kernel returns matches like "xyz.append" and smc wants just "append"
@@ -1994,7 +3388,10 @@ def introspect(conn, id, line, preparse):
     salvus = Salvus(
         conn=conn, id=id
     )  # so salvus.[tab] works -- note that Salvus(...) modifies namespace.
-    z = sage_parsing.introspect(line, namespace=namespace, preparse=preparse)
+    z = sage_parsing.introspect(line,
+                                namespace=namespace,
+                                preparse=preparse,
+                                cache=introspect_cache)
     if z['get_completions']:
         mesg = message.introspect_completions(id=id,
                                               completions=z['result'],
@@ -2010,15 +3407,6 @@ def introspect(conn, id, line, preparse):
     conn.send_json(mesg)
 
 
-def handle_session_term(signum, frame):
-    while True:
-        try:
-            pid, exit_status = os.waitpid(-1, os.WNOHANG)
-        except:
-            return
-        if not pid: return
-
-
 secret_token = None
 
 if 'COCALC_SECRET_TOKEN' in os.environ:
@@ -2027,11 +3415,17 @@ else:
     secret_token_path = os.path.join(os.environ['SMC'], 'secret_token')
 
 
-def unlock_conn(conn):
+def load_secret_token():
     global secret_token
+    if secret_token is None:
+        secret_token = open(secret_token_path).read().strip()
+    return secret_token
+
+
+def unlock_conn(conn):
     if secret_token is None:
         try:
-            secret_token = open(secret_token_path).read().strip()
+            load_secret_token()
         except:
             conn.send(six.b('n'))
             conn.send(
@@ -2047,7 +3441,7 @@ def unlock_conn(conn):
         if token != secret_token[:len(token)]:
             break  # definitely not right -- don't try anymore
     if token != six.b(secret_token):
-        log("token='%s'; secret_token='%s'" % (token, secret_token))
+        log.warning("token='%s'; secret_token='%s'" % (token, secret_token))
         conn.send(six.b('n'))  # no -- invalid login
         conn.send(six.b("Invalid secret token."))
         conn.close()
@@ -2074,9 +3468,10 @@ def serve_connection(conn):
     try:
         conn = ConnectionJSON(conn)
         typ, mesg = conn.recv()
-        log("Received message %s" % mesg)
+        log.debug("Received message %s" % mesg)
     except Exception as err:
-        log("Error receiving message: %s (connection terminated)" % str(err))
+        log.error("Error receiving message: %s (connection terminated)" %
+                  str(err))
         raise
 
     if mesg['event'] == 'send_signal':
@@ -2098,26 +3493,230 @@ def serve_connection(conn):
     session(conn=conn)
 
 
-def serve(port, host, extra_imports=False):
+def serve_child(s, conn):
+    """
+    Serve the connection conn in a freshly forked child of the server, then
+    exit the child.  The child never returns into the server's accept loop,
+    and doesn't run the server's cleanup (e.g., removing the pidfile), even
+    if the session ends with sys.exit.
+    """
+    status = 0
+    try:
+        s.close()
+        serve_connection(conn)
+    except SystemExit:
+        pass
+    except:
+        log.error("session process failed -- %s" % traceback.format_exc())
+        status = 1
+    finally:
+        log.flush()
+        os._exit(status)
+
+
+class SessionPool(object):
+    """
+    A pool of pre-forked, fully initialized session processes.
+
+    Each idle child has already run init_session() and read the
+    secret token, and is blocked in accept() on the listening socket,
+    so a new connection is picked up directly by a warm child.  When a
+    child takes a connection, it tells the parent by writing its pid to
+    a pipe; the parent then counts a hit and refills the pool.  Any
+    connection the parent accepts itself (because no warm child was
+    available) is a miss, and is handled by forking on demand as before.
+
+    INPUT:
+
+    - ``s`` -- the listening socket
+    - ``size`` -- number of idle children to keep around (0 disables the pool)
+    - ``low_water`` -- refill the pool (back up to ``size``) only once the
+      number of idle children drops to this; default ``size - 1``, i.e.,
+      replace each child as soon as it is used.
+    - ``in_child`` -- function called first thing in each forked child
+    """
+    def __init__(self, s, size, low_water=None, in_child=None):
+        self._s = s
+        self._in_child = in_child
+        self.size = max(0, int(size))
+        if low_water is None:
+            low_water = self.size - 1
+        self.low_water = max(0, min(int(low_water), self.size - 1))
+        self.idle = set()
+        self.busy = set()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'spawned': 0,
+            'died_idle': 0
+        }
+        self._r, self._w = os.pipe() if self.size else (None, None)
+
+    def __repr__(self):
+        return "SessionPool(size=%s, idle=%s, busy=%s, stats=%s)" % (
+            self.size, len(self.idle), len(self.busy), self.stats)
+
+    def fileno(self):
+        return self._r
+
+    def refill(self):
+        """
+        Fork warm children until there are ``size`` idle ones, but only if
+        we are at or below the low water mark.
+        """
+        if not self.size or len(self.idle) > self.low_water:
+            return
+        while len(self.idle) < self.size:
+            pid = os.fork()
+            if pid:
+                self.idle.add(pid)
+                self.stats['spawned'] += 1
+            else:
+                self._child()
+
+    def _child(self):
+        global PID
+        PID = os.getpid()
+        parent = os.getppid()
+        if self._in_child is not None:
+            self._in_child()
+        os.close(self._r)
+        try:
+            log("warm session process waiting for a connection")
+            init_session()
+            load_secret_token()
+            # The server's socket is non-blocking; wait in accept(), but
+            # wake up now and then to see whether the server is still there.
+            self._s.settimeout(5)
+            while True:
+                try:
+                    conn, addr = self._s.accept()
+                    break
+                except socket.error as err:
+                    # The listening socket is shared with the parent and
+                    # other warm children, so losing the race for a
+                    # connection (EAGAIN) is normal.  Anything else (EMFILE,
+                    # EBADF, ...) would just fail again right away.
+                    if not isinstance(err, socket.timeout) and \
+                       err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                         errno.EINTR):
+                        raise
+                    if os.getppid() != parent:
+                        log("server went away; warm session process exiting")
+                        log.flush()
+                        os._exit(0)
+            os.write(self._w, struct.pack('>L', PID))
+            os.close(self._w)
+            log("warm session process accepted a connection from", addr)
+        except:
+            log.error("warm session process failed -- %s" %
+                      traceback.format_exc())
+            log.flush()
+            os._exit(1)
+        serve_child(self._s, conn)
+
+    def handle_ready(self):
+        """
+        Read the pids of children that just took a connection; call this
+        when ``self.fileno()`` is readable.
+        """
+        data = os.read(self._r, 4 * max(1, len(self.idle)))
+        for i in range(0, len(data) - len(data) % 4, 4):
+            pid = struct.unpack('>L', data[i:i + 4])[0]
+            self.idle.discard(pid)
+            self.busy.add(pid)
+            self.stats['hits'] += 1
+            log.debug("session pool hit (pid %s) -- %s" % (pid, self))
+
+    def miss(self):
+        self.stats['misses'] += 1
+        log.debug("session pool miss -- %s" % self)
+
+    def child_exited(self, pid, status=0):
+        """
+        Called by the parent when the child with the given pid was reaped
+        (``status`` as returned by ``os.waitpid``); returns False if it
+        isn't one of ours.
+
+        An idle child only fails if it couldn't start or accept (e.g.,
+        EMFILE); then the pool is switched off, rather than forking a
+        replacement that fails the same way over and over again.
+        """
+        if pid in self.idle:
+            self.idle.discard(pid)
+            self.stats['died_idle'] += 1
+            if status:
+                log.error("warm session process %s failed; "
+                          "disabling the session pool" % pid)
+                self.size = 0
+        elif pid in self.busy:
+            self.busy.discard(pid)
+        else:
+            return False
+        log("pooled session process %s terminated" % pid)
+        return True
+
+
+# Number of pre-forked warm session processes waiting for connections; 0 = fork on demand only.
+# Off by default, since each warm process holds on to memory while idle.
+SESSION_POOL_SIZE = int(os.environ.get('COCALC_SAGE_SERVER_POOL_SIZE', 0))
+# The pool is refilled when the number of idle processes drops to this; default SESSION_POOL_SIZE-1.
+SESSION_POOL_LOW_WATER = os.environ.get('COCALC_SAGE_SERVER_POOL_LOW_WATER',
+                                        None)
+
+session_pool = None
+
+# (step, seconds) for each step of init_library() in the server; used to
+# find out why restarting the server after a project restart takes so long.
+startup_timing = []
+
+# Freeze all objects that exist after importing the Sage library (gc.freeze,
+# Python 3.7+), so the cyclic garbage collector in sessions never writes to
+# their headers, which would un-share the pages sessions inherit from the server.
+SESSION_GC_FREEZE = os.environ.get('COCALC_SAGE_SERVER_GC_FREEZE',
+                                   '1') not in ['0', '']
+# gc.set_threshold() in session processes, e.g., "10000,20,20"; "" = Python's default.
+# Since the library is frozen, a larger first generation only means fewer collections.
+SESSION_GC_THRESHOLD = [
+    int(x) for x in os.environ.get('COCALC_SAGE_SERVER_GC_THRESHOLD',
+                                   '10000,20,20').split(',') if x.strip()
+]
+
+
+def serve(port, host, extra_imports=False, pool_size=None):
+    freeze = SESSION_GC_FREEZE and hasattr(gc, 'freeze')
+    if freeze:
+        # The server never collects: collecting while importing leaves
+        # freed holes all over the pages that will be shared with the
+        # sessions.  Everything is frozen right before each fork instead,
+        # and the sessions turn the collector back on (see in_child).
+        gc.disable()
+
     #log.info('opening connection on port %s', port)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    # check for children that have finished every few seconds, so
-    # we don't end up with zombies.
-    s.settimeout(5)
+    # The listening socket is shared with the warm children in the session
+    # pool, so a connection the selector reports may already be taken by one
+    # of them; in the server, accept() must then fail right away instead of
+    # blocking.  (Warm children set a timeout on their own socket object.)
+    s.setblocking(False)
 
     s.bind((host, port))
     log('Sage server %s:%s' % (host, port))
 
-    # Enabling the following signal completely breaks subprocess pexpect in many cases, which is
-    # obviously totally unacceptable.
-    #signal.signal(signal.SIGCHLD, handle_session_term)
-
     def init_library():
         tm = time.time()
         log("pre-importing the sage library...")
 
+        del startup_timing[:]
+        t = [tm]
+
+        def done(step):
+            now = time.time()
+            startup_timing.append((step, now - t[0]))
+            t[0] = now
+
         # FOR testing purposes.
         ##log("fake 40 second pause to slow things down for testing....")
         ##time.sleep(40)
@@ -2128,6 +3727,7 @@ def serve(port, host, extra_imports=False):
         log("import sage...")
         import sage.all
         log("imported sage.")
+        done('import sage.all')
 
         # Monkey patching interact using the new and improved Salvus
         # implementation of interact.
@@ -2158,6 +3758,7 @@ def serve(port, host, extra_imports=False):
 
         # Monkey patch latex.eval, so that %latex works in worksheets
         sage.misc.latex.latex.eval = sage_salvus.latex0
+        done('monkey patching')
 
         # Plot, integrate, etc., -- so startup time of worksheets is minimal.
         cmds = [
@@ -2174,6 +3775,7 @@ def serve(port, host, extra_imports=False):
         for cmd in cmds:
             log(cmd)
             exec(cmd, namespace)
+            done(cmd)
 
         global pylab
         pylab = namespace['pylab']  # used for clearing
@@ -2223,39 +3825,126 @@ def serve(port, host, extra_imports=False):
 
         # this way client code can tell it is running as a Sage Worksheet.
         namespace['__SAGEWS__'] = True
+        done('namespace')
+
+        log("init_library timing: %s" % ', '.join('%s %.3fs' % x
+                                                   for x in startup_timing))
 
     log("Initialize sage library.")
     init_library()
+    if freeze:
+        gc.freeze()
+        log("froze %s objects for copy-on-write" % gc.get_freeze_count())
+    log("server memory usage (kB): %s" % memory_usage())
 
-    t = time.time()
     s.listen(128)
-    i = 0
 
+    global session_pool
+    if pool_size is None:
+        pool_size = SESSION_POOL_SIZE
+
+    # SIGCHLD wakes up the loop below through a self-pipe, so children are
+    # reaped as soon as they exit.  The Python handler does nothing; it just
+    # has to exist so that the C level handler writes to the wakeup fd.
+    wakeup_r, wakeup_w = os.pipe()
+    for fd in (wakeup_r, wakeup_w):
+        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    signal.set_wakeup_fd(wakeup_w)
+
+    sel = selectors.DefaultSelector()
+
+    def in_child():
+        # A SIGCHLD handler completely breaks subprocess and pexpect in many
+        # cases, which is obviously totally unacceptable, so only the server
+        # process itself has one; sessions get the default back right away.
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if freeze:
+            gc.enable()
+        sel.close()
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+
+    session_pool = pool = SessionPool(s,
+                                      pool_size,
+                                      SESSION_POOL_LOW_WATER,
+                                      in_child=in_child)
+
+    # pid -> the server's copy of the connection that child is serving
     children = {}
+
+    def reap():
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:  # ECHILD -- no children at all
+                return
+            if not pid:
+                return
+            conn = children.pop(pid, None)
+            if conn is not None:
+                log("subprocess %s terminated, closing connection" % pid)
+                conn.close()
+            elif not pool.child_exited(pid, status):
+                log("unknown subprocess %s terminated" % pid)
+
+    sel.register(wakeup_r, selectors.EVENT_READ, 'sigchld')
+    if pool.size:
+        sel.register(pool.fileno(), selectors.EVENT_READ, 'pool')
+    accepting = False
+
     log("Starting server listening for connections")
     try:
         while True:
-            i += 1
-            #print i, time.time()-t, 'cps: ', int(i/(time.time()-t))
             # do not use log.info(...) in the server loop; threads = race conditions that hang server every so often!!
-            try:
-                if children:
-                    for pid in list(children.keys()):
-                        if os.waitpid(pid, os.WNOHANG) != (0, 0):
-                            log("subprocess %s terminated, closing connection"
-                                % pid)
-                            conn.close()
-                            del children[pid]
+            log.flush()  # about to wait for a connection
+            if freeze:
+                gc.freeze()  # refill() forks
+            pool.refill()
+            # While warm children are waiting in accept(), leave new
+            # connections to them and only watch for pool hits.
+            if accepting != (not pool.idle):
+                accepting = not pool.idle
+                if accepting:
+                    sel.register(s, selectors.EVENT_READ, 'accept')
+                else:
+                    sel.unregister(s)
 
+            # the timeout is only a safety net in case a wakeup gets lost
+            events = sel.select(60)
+            ready = set(key.data for key, mask in events)
+            if 'sigchld' in ready or not events:
                 try:
-                    conn, addr = s.accept()
-                    log("Accepted a connection from", addr)
-                except:
-                    # this will happen periodically since we did s.settimeout above, so
-                    # that we wait for children above periodically.
-                    continue
-            except socket.error:
+                    while os.read(wakeup_r, 4096):
+                        pass
+                except OSError:  # EAGAIN -- drained
+                    pass
+                reap()
+            if 'pool' in ready:
+                pool.handle_ready()
+            if 'accept' not in ready:
+                continue
+
+            try:
+                conn, addr = s.accept()
+                log("Accepted a connection from", addr)
+            except BlockingIOError:
+                # a warm child took it first
                 continue
+            except socket.error as err:
+                # e.g., ECONNABORTED -- the client already gave up
+                log("Error accepting a connection: ", err)
+                continue
+            # accept() doesn't pass on O_NONBLOCK, but be explicit, since
+            # the session does blocking reads and writes on conn.
+            conn.setblocking(True)
+            if pool.size:
+                pool.miss()
+            if freeze:
+                gc.freeze()
             child_pid = os.fork()
             if child_pid:  # parent
                 log("forked off child with pid %s to handle this connection" %
@@ -2265,12 +3954,14 @@ def serve(port, host, extra_imports=False):
                 # child
                 global PID
                 PID = os.getpid()
+                in_child()
                 log("child process, will now serve this new connection")
-                serve_connection(conn)
+                serve_child(s, conn)
 
         # end while
     except Exception as err:
-        log("Error taking connection: ", err)
+        log.error("Error taking connection: ", err)
+        log.flush()
         traceback.print_exc(file=open(LOGFILE, 'a'))
         #log.error("error: %s %s", type(err), str(err))
 
@@ -2280,10 +3971,17 @@ def serve(port, host, extra_imports=False):
         s.close()
 
 
-def run_server(port, host, pidfile, logfile=None):
+def run_server(port,
+               host,
+               pidfile,
+               logfile=None,
+               pool_size=None,
+               log_level=None):
     global LOGFILE
     if logfile:
         LOGFILE = logfile
+    if log_level:
+        log.set_level(log_level)
     if pidfile:
         pid = str(os.getpid())
         print("os.getpid() = %s" % pid)
@@ -2291,7 +3989,7 @@ def run_server(port, host, pidfile, logfile=None):
     log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s'" %
         (port, host, pidfile, LOGFILE))
     try:
-        serve(port, host)
+        serve(port, host, pool_size=pool_size)
     finally:
         if pidfile:
             os.unlink(pidfile)
@@ -2312,9 +4010,10 @@ if __name__ == "__main__":
         "-l",
         dest='log_level',
         type=str,
-        default='INFO',
+        default=os.environ.get('COCALC_SAGE_SERVER_LOG_LEVEL', 'INFO'),
         help=
-        "log level (default: INFO) useful options include WARNING and DEBUG")
+        "log level (default: $COCALC_SAGE_SERVER_LOG_LEVEL or INFO) useful options include WARNING and DEBUG; DEBUG logs every message"
+    )
     parser.add_argument("-d",
                         dest="daemon",
                         default=False,
@@ -2354,6 +4053,14 @@ if __name__ == "__main__":
                         type=str,
                         default='',
                         help="write port to this file")
+    parser.add_argument(
+        "--pool_size",
+        dest="pool_size",
+        type=int,
+        default=None,
+        help=
+        "number of pre-forked warm session processes (default: $COCALC_SAGE_SERVER_POOL_SIZE or %s); 0 = fork on demand"
+        % SESSION_POOL_SIZE)
 
     args = parser.parse_args()
 
@@ -2362,9 +4069,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if args.log_level:
-        pass
-        #level = getattr(logging, args.log_level.upper())
-        #log.setLevel(level)
+        log.set_level(args.log_level)
 
     if args.client:
         client1(
@@ -2388,7 +4093,10 @@ if __name__ == "__main__":
         open(LOGFILE, 'w')  # for now we clear it on restart...
         log("setting logfile to %s" % LOGFILE)
 
-    main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile)
+    main = lambda: run_server(port=args.port,
+                              host=args.host,
+                              pidfile=pidfile,
+                              pool_size=args.pool_size)
     if args.daemon and args.pidfile:
         from . import daemon
         daemon.daemonize(args.pidfile)
@@ -13,3 +13,34 @@ def test_start_new_kernel(kname):
         km.shutdown_kernel()
     except:
         assert 0, "kernel {} failed to start".format(kname)
+
+
+def test_kernel_pool(kname):
+    """get a kernel that was started in advance by the sagews jupyter bridge"""
+    from smc_sagews.sage_jupyter import KernelPool
+    pool = KernelPool(size=1, warm=[kname])
+    try:
+        assert pool.warm()
+        assert not pool.warm()
+        km, kc = pool.get(kname)
+        assert km.is_alive()
+        assert pool.warm()
+        print(("kernel {} taken from the pool".format(kname)))
+        km.shutdown_kernel()
+    finally:
+        pool.shutdown()
+
+
+def test_kernel_pool_idle(kname):
+    """kernels started in advance are stopped when they are not used"""
+    from smc_sagews.sage_jupyter import KernelPool
+    pool = KernelPool(warm=[kname], idle_timeout=0)
+    try:
+        assert pool.warm()
+        km = pool._pool[kname][0][0]
+        assert pool.close_idle() is None
+        assert not km.is_alive()
+        # not started again until it is asked for
+        assert not pool.warm()
+    finally:
+        pool.shutdown()
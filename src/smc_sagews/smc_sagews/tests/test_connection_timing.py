@@ -0,0 +1,242 @@
+# test_connection_timing.py
+# micro-benchmark of the sage_server wire protocol receive path
+#
+# Compares ConnectionJSON.recv in sage_server.py with the old
+# implementation, which is still what conftest.ConnectionJSON uses.
+# Run with -s to see the throughput numbers.
+from __future__ import absolute_import, print_function
+import conftest
+import json
+import math
+import os
+import select
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def sage_server():
+    # importing sage_server takes a while, since it imports the Sage library
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import sage_server
+    return sage_server
+
+
+def frame(typ, payload):
+    s = typ + payload
+    return struct.pack('>L', len(s)) + s
+
+
+def time_recv(Connection, data, count):
+    r"""
+    Send ``count`` copies of the frame ``data`` through a socket pair and
+    return the elapsed time it takes ``Connection`` to receive all of them,
+    along with the last received message.
+    """
+    a, b = socket.socketpair()
+
+    def send():
+        for i in range(count):
+            a.sendall(data)
+
+    t = threading.Thread(target=send)
+    conn = Connection(b)
+    start = time.time()
+    t.start()
+    for i in range(count):
+        mesg = conn.recv()
+    elapsed = time.time() - start
+    t.join()
+    a.close()
+    b.close()
+    return elapsed, mesg
+
+
+class TestRecvTiming:
+    r"""
+    These tests do not talk to a running sage_server; they only time the
+    receive path of the connection class.
+    """
+    @pytest.mark.parametrize("size,count", [(1 << 10, 2000), (1 << 20, 50),
+                                            (100 << 20, 1)])
+    def test_recv_json(self, sage_server, size, count):
+        data = frame(b'j', json.dumps({'x': 'a' * (size - 10)}).encode('utf8'))
+        old, m_old = time_recv(conftest.ConnectionJSON, data, count)
+        new, m_new = time_recv(sage_server.ConnectionJSON, data, count)
+        assert m_old == m_new
+        mb = len(data) * count / 1e6
+        print("\njson %8s bytes x %4s: old %8.1f MB/s, new %8.1f MB/s" %
+              (size, count, mb / old, mb / new))
+
+    @pytest.mark.parametrize("size,count", [(1 << 10, 2000), (1 << 20, 50),
+                                            (100 << 20, 1)])
+    def test_recv_blob(self, sage_server, size, count):
+        blob = b'a' * size
+        data = frame(b'b', sage_server.uuidsha1(blob).encode('utf8') + blob)
+        old, m_old = time_recv(conftest.ConnectionJSON, data, count)
+        new, m_new = time_recv(sage_server.ConnectionJSON, data, count)
+        # blobs are now returned as bytes instead of decoded text
+        assert m_new[0] == 'blob'
+        assert m_new[1] == m_old[1].encode('utf8')
+        mb = len(data) * count / 1e6
+        print("\nblob %8s bytes x %4s: old %8.1f MB/s, new %8.1f MB/s" %
+              (size, count, mb / old, mb / new))
+
+
+def recv_file(sage_server, path):
+    r"""
+    Send the file at path with sage_server.ConnectionJSON.send_file through
+    a socket pair, and return what send_file returned and the message the
+    other end received.
+    """
+    a, b = socket.socketpair()
+    result = []
+
+    def send():
+        try:
+            result.append(sage_server.ConnectionJSON(a).send_file(path))
+        finally:
+            # so that recv fails instead of waiting forever if send_file does
+            a.close()
+
+    t = threading.Thread(target=send)
+    t.start()
+    try:
+        mesg = sage_server.ConnectionJSON(b).recv()
+    finally:
+        t.join()
+        b.close()
+    return result[0], mesg
+
+
+class TestSendFile:
+    r"""
+    These tests check that files are framed exactly like send_blob would
+    frame their content.
+    """
+    def check(self, sage_server, data):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            uuid, mesg = recv_file(sage_server, f.name)
+        assert uuid == sage_server.uuidsha1(data)
+        assert mesg == ('blob', uuid.encode('utf8') + data)
+
+    def test_send_empty_file(self, sage_server):
+        self.check(sage_server, b'')
+
+    def test_send_large_file(self, sage_server):
+        # several chunks, and a partial one
+        self.check(sage_server,
+                   os.urandom(3 * sage_server.FILE_CHUNK_SIZE + 17))
+
+    def test_announce(self, sage_server):
+        # the uuid is announced before anything is sent, e.g., so that
+        # Salvus can expect the ack of the blob before it can arrive
+        a, b = socket.socketpair()
+        announced = []
+
+        def announce(uuid):
+            announced.append((uuid, select.select([b], [], [], 0)[0]))
+
+        try:
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(b'data')
+                f.flush()
+                uuid = sage_server.ConnectionJSON(a).send_file(
+                    f.name, announce=announce)
+            assert announced == [(uuid, [])]
+            mesg = sage_server.ConnectionJSON(b).recv()
+            assert mesg == ('blob', uuid.encode('utf8') + b'data')
+        finally:
+            a.close()
+            b.close()
+
+
+MESSAGE = {
+    'event': 'output',
+    'id': 'a8f2fb0e-4bd7-4c4c-a5e9-3d4bb5c9e0ab',
+    'stdout': u'unicode \u00e9\u4e2d and "quotes"\n',
+    'done': False,
+    'once': None,
+    'n': 2**40,
+    'x': 1.5,
+    'list': [1, [2, {'a': []}]]
+}
+
+
+def json_codec(sage_server, name):
+    # orjson and ujson are optional test dependencies (see setup.py)
+    if name != 'json':
+        pytest.importorskip(name)
+    codec = sage_server.get_json_codec(name)
+    assert codec.name == name
+    return codec
+
+
+class TestJSONCodecs:
+    @pytest.mark.parametrize("name", ['json', 'ujson', 'orjson'])
+    def test_round_trip(self, sage_server, name):
+        codec = json_codec(sage_server, name)
+        s = codec.dumps(MESSAGE)
+        assert isinstance(s, bytes)
+        assert json.loads(s.decode('utf8')) == MESSAGE
+        assert codec.loads(memoryview(s)) == MESSAGE
+
+    @pytest.mark.parametrize("name", ['json', 'ujson', 'orjson'])
+    def test_big_int(self, sage_server, name):
+        # too big for orjson and ujson, which fall back to json when
+        # encoding (orjson decodes it as a float)
+        codec = json_codec(sage_server, name)
+        m = {'n': 10**30}
+        assert json.loads(codec.dumps(m).decode('utf8')) == m
+
+    @pytest.mark.parametrize("name", ['json', 'ujson', 'orjson'])
+    def test_nan(self, sage_server, name):
+        codec = json_codec(sage_server, name)
+        x = codec.loads(memoryview(codec.dumps({'x': float('nan')})))['x']
+        if name == 'orjson':
+            # orjson writes NaN and infinity as null
+            assert x is None
+        else:
+            assert math.isnan(x)
+
+    @pytest.mark.parametrize("name", ['json', 'ujson', 'orjson'])
+    def test_no_nul(self, sage_server, name):
+        codec = json_codec(sage_server, name)
+        for m in [{'s': 'a\x00b'}, {'a\x00': 1}, {'k': {'\x00': 'v'}},
+                  ['x', ['\x00']]]:
+            with pytest.raises(RuntimeError):
+                codec.dumps(m)
+        # an escaped backslash followed by u0000 is not a NULL byte
+        m = {'s': '\\u0000'}
+        assert codec.loads(memoryview(codec.dumps(m))) == m
+
+    def test_default(self, sage_server, monkeypatch):
+        # the fast codecs are opt-in, even if installed
+        monkeypatch.delenv('COCALC_SAGE_SERVER_JSON', raising=False)
+        codec = sage_server.get_json_codec()
+        assert codec.name == 'json'
+        m = {'x': float('inf'), 'y': -float('inf')}
+        assert codec.loads(memoryview(codec.dumps(m))) == m
+        assert math.isnan(
+            codec.loads(memoryview(codec.dumps([float('nan')])))[0])
+
+    def test_fallback(self, sage_server, monkeypatch):
+        monkeypatch.setitem(sys.modules, 'orjson', None)
+        monkeypatch.setitem(sys.modules, 'ujson', None)
+        assert sage_server.get_json_codec('orjson').name == 'json'
+        assert sage_server.get_json_codec('ujson').name == 'json'
+        assert sage_server.get_json_codec('nonsense').name == 'json'
+
+    @pytest.mark.parametrize("name", ['json', 'ujson', 'orjson'])
+    def test_env(self, sage_server, monkeypatch, name):
+        json_codec(sage_server, name)
+        monkeypatch.setenv('COCALC_SAGE_SERVER_JSON', name)
+        assert sage_server.get_json_codec().name == name
@@ -56,6 +56,32 @@ class TestGraphics:
     def test_plot(self, execblob):
         execblob("plot(cos(x),x,0,pi)", want_html=False, file_type='svg')
 
+    def test_render_cache(self, execblob, test_id, sagews):
+        code = "show(plot(sin(x), (x, 0, 1), color='red'), svg=False)"
+        execblob(code, want_html=False, file_type='png')
+        # shown again from the render cache, and not sent again
+        m = conftest.message.execute_code(code=code, id=test_id)
+        sagews.send_json(m)
+        typ, mesg = sagews.recv()
+        assert typ == 'json'
+        assert mesg['id'] == test_id
+        assert 'render_cache' in mesg['file']['filename']
+        if not mesg.get('done'):
+            conftest.recv_til_done(sagews, test_id)
+
+    def test_render_cache_pruned(self, execblob):
+        # another session deleted the image right after the hit; the plot
+        # is rendered and sent as usual
+        code = dedent(r"""
+        import sys
+        rc = sys.modules[show.__module__].render_cache
+        rc.get = lambda key, ext: '/nonexistent/render_cache.png'
+        try:
+            show(plot(cos(x), (x, 0, 1), color='green'), svg=False)
+        finally:
+            del rc.get""")
+        execblob(code, want_html=False, file_type='png')
+
 
 class TestOctavePlot:
     def test_octave_plot(self, execblob):
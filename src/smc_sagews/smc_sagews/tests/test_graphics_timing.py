@@ -0,0 +1,151 @@
+# test_graphics_timing.py
+# micro-benchmark of the 3d graphics to JSON conversion
+#
+# Compares graphics.parse_obj_geometry, which graphics3d_to_jsonable uses
+# to read the OBJ text of each IndexFaceSet, with the old line by line
+# parser, which is kept below.  The corpus is made of the OBJ text of Sage
+# 3d plots, up to a 200x200 plot3d, and random text checks that unusual
+# lines are read the same way too.
+# Run with -s to see the timings.
+from __future__ import absolute_import, print_function
+import json
+import math
+import os
+import random
+import sys
+import time
+
+import pytest
+
+PKG = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def graphics():
+    # importing graphics takes a while, since it imports the Sage library
+    sys.path.insert(0, os.path.dirname(PKG))
+    from smc_sagews import graphics
+    return graphics
+
+
+def sage_3d(code):
+    def f():
+        import sage.all
+        g = dict(sage.all.__dict__)
+        for v in sage.all.SR.var('x y z u v'):
+            g[str(v)] = v
+        return eval(sage.all.preparse(code), g)
+
+    return f
+
+
+CORPUS = {
+    'sphere': sage_3d("sphere()"),
+    'cube': sage_3d("cube(color='red', opacity=.5)"),
+    'torus': sage_3d("parametric_plot3d("
+                     "((2 + cos(v))*cos(u), (2 + cos(v))*sin(u), sin(v)), "
+                     "(u, 0, 2*pi), (v, 0, 2*pi), plot_points=60)"),
+    'implicit': sage_3d("implicit_plot3d(x^2 + y^2 + z^2 == 4, "
+                        "(x, -3, 3), (y, -3, 3), (z, -3, 3))"),
+    # nan and infinity at the pole
+    'pole': sage_3d("plot3d(1/(x^2 + y^2), (x, -1, 1), (y, -1, 1), "
+                    "plot_points=51)"),
+    'plot3d 200x200': sage_3d("plot3d(sin(x*y), (x, -3, 3), (y, -3, 3), "
+                              "plot_points=200)"),
+}
+
+
+def old_json_float(t):
+    if t is None:
+        return t
+    t = float(t)
+    if math.isnan(t) or math.isinf(t):
+        return None
+    else:
+        return t
+
+
+def old_parse_obj_geometry(obj):
+    # graphics3d_to_jsonable's parse_obj, then its vertex loop
+    material_name = ''
+    faces = []
+    for item in obj.split("\n"):
+        tmp = str(item.strip())
+        if not tmp:
+            continue
+        k = tmp.split()
+        if k[0] == "usemtl":  # material name
+            material_name = k[1]
+        elif k[0] == 'f':  # face
+            v = [int(a) for a in k[1:]]
+            faces.append(v)
+    face_geometry = [{"material_name": material_name, "faces": faces}]
+    vertex_geometry = []
+    for item in obj.split("\n"):
+        if "v" in item:
+            tmp = str(item.strip())
+            for t in tmp.split():
+                try:
+                    vertex_geometry.append(old_json_float(t))
+                except ValueError:
+                    pass
+    return face_geometry, vertex_geometry
+
+
+# pieces of lines for random OBJ text
+STARTS = ['v ', 'f ', 'usemtl ', 'g ', ' f ', 'vn ', 'v', 'f', '']
+TOKENS = [
+    '1', '12', '2.5', '-3e-4', '5.', '.5', '-0', '+1', '1e999', 'nan', 'inf',
+    '-inf', '1e', '1-2', 'x', 'texture3', '', ' ', '\t'
+]
+
+
+def random_obj(r):
+    return '\n'.join(
+        r.choice(STARTS) + ' '.join(
+            r.choice(TOKENS) for j in range(r.randint(0, 5)))
+        for i in range(r.randint(0, 8)))
+
+
+def parse(f, obj):
+    try:
+        return json.dumps(f(obj))
+    except Exception as err:
+        return type(err)
+
+
+def timeit(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+
+class TestGraphicsTiming:
+    r"""
+    These tests do not talk to a running sage_server; they only time the
+    OBJ parser and check that it gives the same JSON as before.
+    """
+    @pytest.mark.parametrize("name", sorted(CORPUS))
+    def test_parse_obj_geometry(self, graphics, name):
+        obj = CORPUS[name]().obj()
+        old, r_old = timeit(old_parse_obj_geometry, obj)
+        new, r_new = timeit(graphics.parse_obj_geometry, obj)
+        assert json.dumps(r_old) == json.dumps(r_new)
+        print("\nobj %16s %7s lines: old %7.3fs, new %7.3fs" %
+              (name, obj.count('\n'), old, new))
+
+    def test_graphics3d_to_jsonable(self, graphics):
+        p = CORPUS['plot3d 200x200']()
+        t, r = timeit(graphics.graphics3d_to_jsonable, p)
+        face_geometry, vertex_geometry = old_parse_obj_geometry(p.obj())
+        assert json.dumps(r[0]['face_geometry']) == json.dumps(face_geometry)
+        assert json.dumps(r[0]['vertex_geometry']) == json.dumps(
+            vertex_geometry)
+        print("\ngraphics3d_to_jsonable(plot3d 200x200): %7.3fs" % t)
+
+    def test_random_obj(self, graphics):
+        r = random.Random(0)
+        for i in range(20000):
+            obj = random_obj(r)
+            assert (parse(graphics.parse_obj_geometry, obj) == parse(
+                old_parse_obj_geometry, obj)), obj
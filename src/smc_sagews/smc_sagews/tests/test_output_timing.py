@@ -0,0 +1,42 @@
+# test_output_timing.py
+# benchmark of printing lots of output in a worksheet cell
+#
+# Run with -s to see the timing and message counts.
+from __future__ import absolute_import, print_function
+import conftest
+import time
+
+
+class TestPrintTiming:
+    def test_print_lines(self, test_id, sagews):
+        # 10^6 lines is far more than MAX_OUTPUT; the output must be elided
+        # instead of the cell being killed by too many or too long messages
+        code = "for i in range(10^6):\n    print(i)"
+        m = conftest.message.execute_code(code=code, id=test_id)
+        start = time.time()
+        sagews.send_json(m)
+        stdout = []
+        stderr = []
+        while True:
+            typ, mesg = sagews.recv()
+            assert typ == 'json'
+            assert mesg['id'] == test_id
+            if 'stdout' in mesg:
+                stdout.append(mesg['stdout'])
+            if 'stderr' in mesg:
+                stderr.append(mesg['stderr'])
+            if mesg.get('done'):
+                break
+        elapsed = time.time() - start
+        print("\n10^6 lines: %.2f s, %s stdout messages, %s characters" %
+              (elapsed, len(stdout), sum(len(x) for x in stdout)))
+        assert stderr == []
+        output = ''.join(stdout)
+        assert output.startswith('0\n1\n2\n')
+        assert output.endswith('999998\n999999\n')
+        assert 'characters of output elided' in output
+        assert len(stdout) < 20
+
+    def test_print_after_elided(self, exec2):
+        # the next cell is not affected
+        exec2("print(42)", "42\n")
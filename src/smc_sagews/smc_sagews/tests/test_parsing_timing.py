@@ -0,0 +1,354 @@
+# test_parsing_timing.py
+# micro-benchmark of the sage_parsing code scanner
+#
+# Compares strip_string_literals and divide_into_blocks in sage_parsing.py
+# with the old implementations, which are kept below.  The corpus is made
+# of large cells built from the modules in this package, since those are
+# about the size of the biggest cells users paste into worksheets, and of
+# generated 5k-10k line cells on which the old code is quadratic.  Random
+# cells check that the new code divides them into the same blocks.
+# Run with -s to see the timings.
+from __future__ import absolute_import, print_function
+import ast
+import os
+import random
+import re
+import string
+import sys
+import time
+import weakref
+
+import pytest
+
+PKG = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def sage_parsing():
+    sys.path.insert(0, PKG)
+    import sage_parsing
+    return sage_parsing
+
+
+def read(name):
+    with open(os.path.join(PKG, name)) as f:
+        return f.read()
+
+
+SAGE_CELL = r'''
+%md
+# A *title* with a "quote" and 50% off
+%sh ls -l | grep '(' # not a bracket
+!echo "hi" # shell escape
+@interact
+def f(n=(1..10), s="it's", t='say "hi"'):
+    print(n, s, t)  # a [comment
+x = {'a': [1, (2, 3)], "b": """multi
+line ) ] }
+string""", 'c': r'\d+\''}
+try:
+    1/0
+except ZeroDivisionError:
+    pass
+finally:
+    y = 'finally'
+for i in range(3):
+    if i % 2:
+        print('odd %s' % i)
+    elif i:
+        print("even")
+else:
+    z = 5 # done
+%time sum(range(100))
+'''
+
+CORPUS = {
+    'sage_server.py': lambda: read('sage_server.py'),
+    'all modules': lambda: '\n'.join(
+        read(name) for name in ['sage_server.py', 'sage_salvus.py',
+                                'sage_parsing.py', 'graphics.py']),
+    'sage cell x 200': lambda: SAGE_CELL * 200,
+    # pasted data has lots of quotes, but no comments
+    'data cell': lambda: 'data = [\n' + ''.join(
+        "    ('row%s', %s, 'x'),\n" % (i, i) for i in range(5000)) + ']\n',
+    '10k statements': lambda: ''.join(
+        'x%s = %s\n' % (i, i) for i in range(10000)),
+    '5k elif': lambda: 'if x == 0:\n    pass\n' + ''.join(
+        'elif x == %s:\n    pass\n' % i for i in range(5000)),
+    # the body of a method, pasted without dedenting it; at 10k lines this
+    # takes about a minute with the old divide_into_blocks
+    'indented': lambda: ''.join('    x%s = %s\n' % (i, i)
+                                for i in range(2000)),
+}
+
+# pieces of lines for random cells
+STARTS = [
+    'try:', 'except:', 'finally:', 'else:', 'elif x:', 'if x:', 'for i in y:',
+    'while 1:', 'def f(', '@d', '@d(', ')', 'x = [', ']', '}', '{', '"""',
+    "'", '#c', '%sh', '%time', '!ls', '', 'x = 1 # ('
+]
+ENDS = ['', '(', ')', '[', ']', '{', '}', ' 1', ' # )', ' "("', "'''"]
+
+
+def random_cell(r):
+    return '\n'.join(
+        r.choice(['', '', '    ', '\t', ' ']) + r.choice(STARTS) +
+        r.choice(ENDS) for i in range(r.randint(0, 15)))
+
+
+def old_strip_string_literals(code, state=None):
+    new_code = []
+    literals = {}
+    counter = 0
+    start = q = 0
+    if state is None:
+        in_quote = False
+        raw = False
+    else:
+        in_quote, raw = state
+    while True:
+        sig_q = code.find("'", q)
+        dbl_q = code.find('"', q)
+        hash_q = code.find('#', q)
+        q = min(sig_q, dbl_q)
+        if q == -1: q = max(sig_q, dbl_q)
+        if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
+            # it's a comment
+            newline = code.find('\n', hash_q)
+            if newline == -1: newline = len(code)
+            counter += 1
+            label = "L%s" % counter
+            literals[label] = code[hash_q:newline]
+            new_code.append(code[start:hash_q].replace('%', '%%'))
+            new_code.append("%%(%s)s" % label)
+            start = q = newline
+        elif q == -1:
+            if in_quote:
+                counter += 1
+                label = "L%s" % counter
+                literals[label] = code[start:]
+                new_code.append("%%(%s)s" % label)
+            else:
+                new_code.append(code[start:].replace('%', '%%'))
+            break
+        elif in_quote:
+            if code[q - 1] == '\\':
+                k = 2
+                while code[q - k] == '\\':
+                    k += 1
+                if k % 2 == 0:
+                    q += 1
+            if code[q:q + len(in_quote)] == in_quote:
+                counter += 1
+                label = "L%s" % counter
+                literals[label] = code[start:q + len(in_quote)]
+                new_code.append("%%(%s)s" % label)
+                q += len(in_quote)
+                start = q
+                in_quote = False
+            else:
+                q += 1
+        else:
+            raw = q > 0 and code[q - 1] in 'rR'
+            if len(code) >= q + 3 and (code[q + 1] == code[q] == code[q + 2]):
+                in_quote = code[q] * 3
+            else:
+                in_quote = code[q]
+            new_code.append(code[start:q].replace('%', '%%'))
+            start = q
+            q += len(in_quote)
+
+    return "".join(new_code), literals, (in_quote, raw)
+
+
+def old_divide_into_blocks(code, end_of_expr, dec_args, dec_counter=0):
+    code, literals, state = old_strip_string_literals(code)
+    code = code.splitlines()
+
+    c = list(code)
+    try:
+        v = []
+        for line in code:
+            done = False
+            if line.lstrip().startswith('!'):
+                line = line.replace('!', "%%sh ", 1)
+            if line.lstrip().startswith('%%'):
+                i = line.find("%")
+                j = end_of_expr(line[i + 2:]) + i + 2 + 1
+                expr = line[j:] % literals
+                sexpr = expr.strip()
+                if i == 0 and (len(sexpr) == 0 or sexpr.startswith('#')):
+                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
+                        line[:i], dec_counter)
+                    expr = ('\n'.join(code[len(v) + 1:])) % literals
+                    done = True
+                else:
+                    new_line = '%ssalvus.execute_with_code_decorators(*_salvus_parsing.dec_args[%s])' % (
+                        line[:i], dec_counter)
+                dec_args[dec_counter] = ([line[i + 2:j] % literals], expr)
+                dec_counter += 1
+            else:
+                new_line = line
+            v.append(new_line)
+            if done:
+                break
+        code = v
+    except Exception as mesg:
+        code = c
+
+    comment_lines = {}
+    for label, v in literals.items():
+        if v.startswith('#'):
+            comment_lines["%%(%s)s" % label] = True
+    code = [x for x in code if not comment_lines.get(x.strip(), False)]
+    code = [x for x in code if x.strip()]
+
+    i = len(code) - 1
+    blocks = []
+    while i >= 0:
+        stop = i
+        paren_depth = code[i].count('(') - code[i].count(')')
+        brack_depth = code[i].count('[') - code[i].count(']')
+        curly_depth = code[i].count('{') - code[i].count('}')
+        while i >= 0 and (
+            (len(code[i]) > 0 and (code[i][0] in string.whitespace))
+                or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
+            i -= 1
+            if i >= 0:
+                paren_depth += code[i].count('(') - code[i].count(')')
+                brack_depth += code[i].count('[') - code[i].count(']')
+                curly_depth += code[i].count('{') - code[i].count('}')
+        block = ('\n'.join(code[i:])) % literals
+        bs = block.strip()
+        if bs:
+            blocks.insert(0, [i, stop, bs])
+        code = code[:i]
+        i = len(code) - 1
+
+    i = 1
+
+    def merge():
+        blocks[i - 1][-1] += '\n' + blocks[i][-1]
+        blocks[i - 1][1] = blocks[i][1]
+        del blocks[i]
+
+    while i < len(blocks):
+        s = blocks[i][-1].lstrip()
+        if (s.startswith('finally') or s.startswith('except')
+            ) and blocks[i - 1][-1].lstrip().startswith('try'):
+            merge()
+        elif (s.startswith('def') or s.startswith('@')) and blocks[
+                i - 1][-1].splitlines()[-1].lstrip().startswith('@'):
+            merge()
+        elif s.startswith('else') and (
+                blocks[i - 1][-1].lstrip().startswith('if')
+                or blocks[i - 1][-1].lstrip().startswith('while')
+                or blocks[i - 1][-1].lstrip().startswith('for')
+                or blocks[i - 1][-1].lstrip().startswith('try')
+                or blocks[i - 1][-1].lstrip().startswith('elif')):
+            merge()
+        elif s.startswith('elif') and blocks[i -
+                                             1][-1].lstrip().startswith('if'):
+            merge()
+        else:
+            i += 1
+
+    return blocks
+
+
+DEC_ARGS = re.compile(r"_salvus_parsing\.dec_args\[(\d+|'[0-9a-f]+')\]")
+
+
+def resolve_dec_args(blocks, dec_args):
+    r"""
+    Replace the keys of dec_args in blocks by the code decorator arguments
+    they refer to, since the old and new divide_into_blocks use different
+    keys.
+    """
+    def arg(m):
+        return repr(dec_args[ast.literal_eval(m.group(1))])
+
+    return [[start, stop, DEC_ARGS.sub(arg, block)]
+            for start, stop, block in blocks]
+
+
+def timeit(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+
+class TestParsingTiming:
+    r"""
+    These tests do not talk to a running sage_server; they only time the
+    code scanner and check that it gives the same results as before.
+    """
+    @pytest.mark.parametrize("name", sorted(CORPUS))
+    def test_strip_string_literals(self, sage_parsing, name):
+        code = CORPUS[name]()
+        old, r_old = timeit(old_strip_string_literals, code)
+        new, r_new = timeit(sage_parsing.strip_string_literals, code)
+        assert r_old == r_new
+        print("\nstrip %16s %6s lines: old %7.3fs, new %7.3fs" %
+              (name, code.count('\n'), old, new))
+
+    @pytest.mark.parametrize("name", sorted(CORPUS))
+    def test_divide_into_blocks(self, sage_parsing, name):
+        code = CORPUS[name]()
+        dec_args = {}
+        old, r_old = timeit(old_divide_into_blocks, code,
+                            sage_parsing.end_of_expr, dec_args, 0)
+        dec_keys = []
+        new, r_new = timeit(sage_parsing.divide_into_blocks, code, dec_keys)
+        assert (resolve_dec_args(r_old, dec_args) == resolve_dec_args(
+            r_new, sage_parsing.dec_args))
+        sage_parsing.release_dec_args(dec_keys)
+        assert not sage_parsing.dec_args
+        print("\nblocks %15s %6s lines: old %7.3fs, new %7.3fs" %
+              (name, code.count('\n'), old, new))
+
+    def test_random_cells(self, sage_parsing):
+        r = random.Random(0)
+        for i in range(20000):
+            code = random_cell(r)
+            dec_args = {}
+            dec_keys = []
+            assert (resolve_dec_args(
+                sage_parsing.divide_into_blocks(code, dec_keys),
+                sage_parsing.dec_args) == resolve_dec_args(
+                    old_divide_into_blocks(code, sage_parsing.end_of_expr,
+                                           dec_args, 0), dec_args)), code
+            sage_parsing.release_dec_args(dec_keys)
+            assert not sage_parsing.dec_args, code
+
+    def test_dec_args_shared(self, sage_parsing):
+        code = '%time f(1)\n%time f(1)\n%md\nhi'
+        dec_keys = []
+        blocks = sage_parsing.divide_into_blocks(code, dec_keys)
+        assert len(dec_keys) == 3 and len(set(dec_keys)) == 2
+        assert sage_parsing.divide_into_blocks(code, dec_keys) == blocks
+        assert len(sage_parsing.dec_args) == 2
+        sage_parsing.release_dec_args(dec_keys[:3])
+        assert len(sage_parsing.dec_args) == 2
+        sage_parsing.release_dec_args(dec_keys[3:])
+        assert not sage_parsing.dec_args
+
+    def test_unterminated(self, sage_parsing):
+        for code in ['x = "abc', "'''a\nb", 'f(1, # (\n2)', 'r"\\"" + 3']:
+            assert (sage_parsing.strip_string_literals(code) ==
+                    old_strip_string_literals(code))
+
+    def test_introspect_cache_changed(self, sage_parsing):
+        class Obj(object):
+            pass
+
+        cache = sage_parsing.IntrospectCache()
+        obj = Obj()
+        ref = weakref.ref(obj)
+        cache.set('obj.', ['a'], obj)
+        assert cache.get('obj.', obj) == ['a']
+        cache.changed()
+        assert cache.get('obj.', obj) is None
+        # the cache doesn't keep objects of older versions alive
+        del obj
+        assert ref() is None
@@ -2,8 +2,11 @@
 # basic tests of sage worksheet using TCP protocol with sage_server
 from __future__ import absolute_import
 import conftest
+import json
 import os
 import re
+import socket
+import time
 
 from textwrap import dedent
 
@@ -164,6 +167,23 @@ class TestBasic:
             conftest.recv_til_done(sagews, test_id)
             break
 
+    def test_new_function_doc_setup(self, exec2):
+        # the docstring of xyzzy_f is prefetched after this cell
+        exec2(dedent(r"""
+        def xyzzy_f():
+            "docstring of xyzzy_f"
+            pass
+        """))
+
+    def test_new_function_doc(self, test_id, sagews):
+        m = conftest.message.execute_code(code="xyzzy_f?", id=test_id)
+        sagews.send_json(m)
+        typ, mesg = sagews.recv()
+        assert typ == 'json'
+        assert mesg['id'] == test_id
+        assert 'docstring of xyzzy_f' in mesg['code']['source']
+        conftest.recv_til_done(sagews, test_id)
+
 
 class TestPythonFutureFeatures:
     def test_pyfutfeats_0(self, exec2):
@@ -226,6 +246,39 @@ class TestPythonFutureImport:
         exec2("print(8r / 5r)", "1\n")
 
 
+class TestExecuteCache:
+    # the same cells again, after changing how they are preparsed
+    def test_cached_cell_1(self, exec2):
+        exec2("a = 3; 2^a", "8\n")
+
+    def test_cached_cell_2(self, exec2):
+        exec2("a = 3; 2^a", "8\n")
+
+    def test_cached_preparser_off(self, exec2):
+        exec2("preparser(False)")
+
+    def test_cached_cell_3(self, exec2):
+        exec2("a = 3; 2^a", "1\n")
+
+    def test_cached_preparser_on(self, exec2):
+        exec2("preparser(True)")
+
+    def test_cached_cell_4(self, exec2):
+        exec2("a = 3; 2^a", "8\n")
+
+    def test_cached_implicit_mul_on(self, exec2):
+        exec2("implicit_multiplication(True)")
+
+    def test_cached_implicit_mul_1(self, exec2):
+        exec2("print(2a)", "6\n")
+
+    def test_cached_implicit_mul_off(self, exec2):
+        exec2("implicit_multiplication(False)")
+
+    def test_cached_implicit_mul_2(self, exec2):
+        exec2("print(2a)", errout="SyntaxError")
+
+
 class TestPy3printMode:
     def test_py3print_mode0(self, exec2):
         exec2("py3print_mode()", "False\n")
@@ -375,6 +428,27 @@ class TestIntrospect:
     def test_sage_autocomplete_1252b(self, execintrospect):
         execintrospect('2+sqr', ["t"], 'sqr')
 
+    def test_cached_completions_1(self, exec2, execintrospect):
+        exec2("xyzzy1 = 1")
+        execintrospect('xyzz', ["y1"], 'xyzz')
+        # served from the cache
+        execintrospect('xyzz', ["y1"], 'xyzz')
+
+    def test_cached_completions_2(self, exec2, execintrospect):
+        # assignments invalidate cached completions
+        exec2("xyzzy2 = 2")
+        execintrospect('xyzz', ["y1", "y2"], 'xyzz')
+        exec2("del xyzzy1")
+        execintrospect('xyzz', ["y2"], 'xyzz')
+
+    def test_cached_completions_3(self, exec2, execintrospect):
+        # the object is part of the key, not just the expression
+        exec2("xyzzy2 = []")
+        execintrospect('xyzzy2.app', ["end"], 'app')
+        exec2("xyzzy2 = {}")
+        execintrospect('xyzzy2.ke', ["ys"], 'ke')
+        execintrospect('xyzzy2.app', [], 'app')
+
 
 class TestAttach:
     def test_define_paf(self, exec2):
@@ -477,3 +551,418 @@ class TestIdentifiers:
         sage=1
         show_identifiers()""")
         exec2(code, "['sage']\n")
+
+
+class TestProfile:
+    def test_profile(self, test_id, sagews, exec2):
+        code = "x = 2+3\nfactor(x^10 - 1)\nprint(x)"
+        exec2("salvus.profile(True)")
+        try:
+            m = conftest.message.execute_code(code=code, id=test_id)
+            sagews.send_json(m)
+            messages = []
+            while True:
+                typ, mesg = sagews.recv()
+                messages.append((typ, mesg))
+                if typ != 'json' or mesg.get('done'):
+                    break
+        finally:
+            # so that the other tests aren't profiled, even if this fails
+            exec2("salvus.profile(False)")
+        profile = None
+        for typ, mesg in messages:
+            assert typ == 'json'
+            assert mesg['id'] == test_id
+            if 'obj' in mesg and mesg.get('once'):
+                profile = json.loads(mesg['obj'])['profile']
+        assert profile is not None
+        assert [(b['start'], b['stop']) for b in profile['blocks']
+                ] == [(0, 0), (1, 1), (2, 2)]
+        for k in ['wall', 'cpu', 'peak_rss', 'divide_into_blocks', 'preparse',
+                  'compile', 'exec', 'output']:
+            assert k in profile
+        assert profile['output_messages'] >= 2
+
+
+def run_cell(sagews, test_id, cell_id, code):
+    """
+    Execute code in the cell with id cell_id and return its stdout.
+    """
+    m = conftest.message.execute_code(code=code, id=test_id)
+    m['cell_id'] = cell_id
+    sagews.send_json(m)
+    stdout = ''
+    while True:
+        typ, mesg = sagews.recv()
+        assert typ == 'json'
+        assert mesg['id'] == test_id
+        assert 'stderr' not in mesg, mesg['stderr']
+        stdout += mesg.get('stdout', '')
+        if mesg.get('done'):
+            return stdout
+
+
+class TestIncremental:
+    # cell C is only executed again when a, which f reads, changes
+    CELL_C = "import time; t = time.time()\nprint(f(3))"
+
+    def test_incremental_on(self, exec2):
+        exec2("salvus.incremental(True)")
+
+    def test_define(self, test_id, sagews):
+        assert run_cell(sagews, test_id, 'a', "a = 2") == ''
+        assert run_cell(sagews, test_id, 'b',
+                        "def f(n):\n    return a * n") == ''
+
+    def test_first_run(self, test_id, sagews, exec2):
+        assert run_cell(sagews, test_id, 'c', self.CELL_C) == "6\n"
+        exec2("t0 = t")
+
+    def test_skipped(self, test_id, sagews, exec2):
+        assert run_cell(sagews, test_id, 'c', self.CELL_C) == "6\n"
+        exec2("print(t == t0)", "True\n")
+
+    def test_input_changed(self, test_id, sagews, exec2):
+        assert run_cell(sagews, test_id, 'a', "a = 5") == ''
+        assert run_cell(sagews, test_id, 'c', self.CELL_C) == "15\n"
+        exec2("print(t == t0)", "False\n")
+
+    def test_not_idempotent(self, test_id, sagews, exec2):
+        exec2("L = []")
+        code = "L.append(1)\nprint(len(L))"
+        assert run_cell(sagews, test_id, 'd', code) == "1\n"
+        assert run_cell(sagews, test_id, 'd', code) == "2\n"
+
+    def test_incremental_off(self, exec2):
+        exec2("salvus.incremental(False)")
+
+
+def interact_update(sagews, id, interact_id, vals):
+    m = conftest.message.execute_code(
+        code='salvus._execute_interact(salvus.data["id"], salvus.data["vals"])',
+        id=id)
+    m['data'] = {'id': interact_id, 'vals': vals}
+    m['preparse'] = False
+    sagews.send_json(m)
+
+
+def define_interact(sagews, test_id, code):
+    """
+    Execute code, which makes one interact, and return the id of the interact.
+    """
+    sagews.send_json(conftest.message.execute_code(code=code, id=test_id))
+    interact_id = None
+    while True:
+        typ, mesg = sagews.recv()
+        assert mesg['id'] == test_id
+        if 'interact' in mesg:
+            interact_id = mesg['interact']['id']
+        if mesg.get('done'):
+            break
+    assert interact_id is not None
+    return interact_id
+
+
+class TestInteractUpdates:
+    def test_coalesced(self, test_id, sagews):
+        code = dedent(r"""
+        @interact
+        def f(n=slider(1, 100, debounce=0.1)):
+            print('n=%s' % n)
+        """)
+        interact_id = define_interact(sagews, test_id, code)
+        # rapid slider moves; each update gets done, but only the last one
+        # is evaluated, with the merged values
+        ids = ['%s-%s' % (test_id, i) for i in range(5)]
+        for i, id in enumerate(ids):
+            interact_update(sagews, id, interact_id, {'n': 10 + i})
+        stdout = dict((id, '') for id in ids)
+        done = set()
+        while len(done) < len(ids):
+            typ, mesg = sagews.recv()
+            assert typ == 'json'
+            stdout[mesg['id']] += mesg.get('stdout', '')
+            if mesg.get('done'):
+                done.add(mesg['id'])
+        assert [stdout[id] for id in ids] == ['', '', '', '', 'n=14\n']
+
+    def test_cancelled(self, test_id, sagews):
+        code = dedent(r"""
+        import sys
+        @interact
+        def g(n=slider(1, 100)):
+            for i in range(100):
+                print('n=%s i=%s' % (n, i))
+                sys.stdout.flush()
+                sum(range(10^6))
+        """)
+        interact_id = define_interact(sagews, test_id, code)
+        ids = ['%s-%s' % (test_id, i) for i in range(2)]
+        interact_update(sagews, ids[0], interact_id, {'n': 1})
+        stdout = dict((id, '') for id in ids)
+        done = set()
+        sent = False
+        while len(done) < len(ids):
+            typ, mesg = sagews.recv()
+            assert typ == 'json'
+            stdout[mesg['id']] += mesg.get('stdout', '')
+            if mesg.get('done'):
+                done.add(mesg['id'])
+            if not sent and stdout[ids[0]] and not done:
+                # the first update is being evaluated; move the slider again
+                interact_update(sagews, ids[1], interact_id, {'n': 2})
+                sent = True
+        assert stdout[ids[0]].startswith('n=1 i=0\n')
+        # the first evaluation stopped at its next output after the update
+        assert 'n=1 i=99\n' not in stdout[ids[0]]
+        assert stdout[ids[1]].endswith('n=2 i=99\n')
+
+    def test_not_cancelled_without_output(self, test_id, sagews, exec2):
+        # an evaluation that sends no more output is not stopped; the
+        # newer update is evaluated once it is finished
+        code = dedent(r"""
+        import sys
+        finished = []
+        @interact
+        def h(n=slider(1, 100)):
+            print('n=%s' % n)
+            sys.stdout.flush()
+            sum(range(10^7))
+            finished.append(n)
+        """)
+        interact_id = define_interact(sagews, test_id, code)
+        ids = ['%s-%s' % (test_id, i) for i in range(2)]
+        interact_update(sagews, ids[0], interact_id, {'n': 1})
+        stdout = dict((id, '') for id in ids)
+        done = set()
+        sent = False
+        while len(done) < len(ids):
+            typ, mesg = sagews.recv()
+            assert typ == 'json'
+            stdout[mesg['id']] += mesg.get('stdout', '')
+            if mesg.get('done'):
+                done.add(mesg['id'])
+            if not sent and stdout[ids[0]] and not done:
+                interact_update(sagews, ids[1], interact_id, {'n': 2})
+                sent = True
+        assert stdout == {ids[0]: 'n=1\n', ids[1]: 'n=2\n'}
+        exec2("print(finished)", "[1, 2]\n")
+
+    def test_cache(self, test_id, sagews):
+        code = dedent(r"""
+        calls = []
+        @interact(cache=2)
+        def f(n=slider(1, 100)):
+            calls.append(n)
+            print('n=%s' % n)
+        """)
+        interact_id = define_interact(sagews, test_id, code)
+
+        def recv_stdout(id):
+            stdout = ''
+            while True:
+                typ, mesg = sagews.recv()
+                assert mesg['id'] == id
+                stdout += mesg.get('stdout', '')
+                if mesg.get('done'):
+                    return stdout
+
+        def update(i, n):
+            id = '%s-%s' % (test_id, i)
+            interact_update(sagews, id, interact_id, {'n': n})
+            return recv_stdout(id)
+
+        def calls():
+            # the values f was called with, including by defining it
+            id = '%s-calls' % test_id
+            m = conftest.message.execute_code(code="print(calls)", id=id)
+            sagews.send_json(m)
+            return eval(recv_stdout(id))
+
+        before = calls()
+        assert update(0, 2) == 'n=2\n'
+        assert update(1, 3) == 'n=3\n'
+        assert calls()[len(before):] == [2, 3]
+        # replayed
+        assert update(2, 2) == 'n=2\n'
+        assert calls()[len(before):] == [2, 3]
+        # only the 2 most recently used values are remembered
+        assert update(3, 4) == 'n=4\n'
+        assert update(4, 3) == 'n=3\n'
+        assert calls()[len(before):] == [2, 3, 4, 3]
+
+    def test_replay_expired_blob(self, exec2):
+        # output showing a blob that isn't known to be saved isn't replayed
+        code = dedent(r"""
+        file_uuid = '00000000-0000-4000-8000-000000000000'
+        mesg = {'event': 'output', 'file': {'uuid': file_uuid}}
+        print(salvus._replay([mesg]))""")
+        exec2(code, "False\n")
+
+
+class TestMemoryUsage:
+    def test_memory_usage(self, exec2):
+        exec2("print(sorted(salvus.memory_usage().keys()))",
+              "['private', 'pss', 'rss', 'shared']\n")
+
+    def test_shared_with_server(self, exec2):
+        # much of the imported Sage library is still shared with the server;
+        # without the gc freeze, the first collections un-share most of it
+        code = dedent(r"""
+        import os
+        server = sage_server.memory_usage(os.getppid())
+        print(salvus.memory_usage()['shared'] > server['rss'] / 4)""")
+        exec2(code, "True\n")
+
+    def test_dec_args_released(self, exec2):
+        # every code decorator line used to leave its arguments (here, the
+        # rest of the cell) in sage_parsing.dec_args forever
+        code = dedent(r"""
+        def nop(code):
+            return ''
+        def run(n, text='x' * 1000):
+            for i in range(n):
+                salvus.execute('%%nop\n%s %s' % (i, text))
+        run(10^4)
+        rss = salvus.memory_usage()['rss']
+        run(9 * 10^4)
+        print(len(_salvus_parsing.dec_args) <= 1024)
+        print(salvus.memory_usage()['rss'] - rss < 10000)
+        """)
+        exec2(code, "True\nTrue\n", timeout=300)
+
+
+def start_session():
+    """
+    Open a new session with the running sage_server and return the
+    connection and the pid of the session process.
+    """
+    host, port = conftest.get_sage_server_info()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((host, port))
+    sock.settimeout(conftest.default_timeout)
+    conftest.client_unlock_connection(sock)
+    conn = conftest.ConnectionJSON(sock)
+    assert conn._recv(1) == b'y'
+    msg = conftest.message.start_session()
+    msg['type'] = 'sage'
+    conn.send_json(msg)
+    typ, mesg = conn.recv()
+    assert typ == 'json'
+    return conn, mesg['pid']
+
+
+def server_children():
+    """
+    Return a dict mapping the pid of each child process of the sage_server
+    to its state ('Z' for a zombie).
+    """
+    server = int(open(conftest.default_pid_file).read())
+    children = {}
+    for pid in os.listdir('/proc'):
+        try:
+            stat = open('/proc/%s/stat' % pid).read()
+        except (IOError, ValueError):
+            continue
+        # the command name may contain spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[1]) == server:
+            children[int(pid)] = fields[0]
+    return children
+
+
+class TestServer:
+    r"""
+    Tests of the server's accept loop, run against the running sage_server.
+    """
+    def test_sigchld_default(self, exec2):
+        # only the server handles SIGCHLD; sessions get the default back
+        code = dedent(r"""
+        import signal
+        print(signal.getsignal(signal.SIGCHLD) == signal.SIG_DFL)
+        print(signal.set_wakeup_fd(-1))""")
+        exec2(code, "True\n-1\n")
+
+    def test_subprocess_status(self, exec2):
+        code = dedent(r"""
+        import subprocess
+        print(subprocess.call(['sh', '-c', 'exit 3']))""")
+        exec2(code, "3\n")
+
+    def test_sessions_reaped(self, test_id):
+        # more sessions at once than there are warm children, so some of
+        # them are forked on demand by the server
+        sessions = [start_session() for i in range(5)]
+        pids = [pid for conn, pid in sessions]
+        assert len(set(pids)) == len(pids)
+        for i, (conn, pid) in enumerate(sessions):
+            m = conftest.message.execute_code(code="print(%s)" % i, id=test_id)
+            conn.send_json(m)
+            typ, mesg = conn.recv()
+            assert mesg['stdout'] == "%s\n" % i
+            conftest.recv_til_done(conn, test_id)
+        for conn, pid in sessions:
+            conn.send_json(conftest.message.terminate_session())
+        for loop_count in range(20):
+            children = server_children()
+            if not set(pids) & set(children):
+                break
+            time.sleep(0.5)
+        else:
+            pytest.fail("sessions not reaped: %s" % children)
+        assert 'Z' not in children.values()
+        # the server is still there and serving
+        assert os.path.exists(conftest.default_pid_file)
+        conn, pid = start_session()
+        conn.send_json(conftest.message.terminate_session())
+
+
+class TestFork:
+    def test_fork(self, exec2):
+        exec2("%fork\nimport time; time.sleep(0.5); fx = 6*7",
+              pattern=r"^Forked subprocess \d+")
+
+    def test_fork_result(self, exec2):
+        exec2("print(fx)", "42\n")
+
+    def test_fork_children(self, exec2):
+        exec2("print(fork.children())", "{}\n")
+
+
+class TestFiles:
+    def test_files_pipelined(self, test_id, sagews):
+        code = dedent(r"""
+        names = ['files-test-%s.txt' % i for i in range(5)]
+        for i, name in enumerate(names):
+            open(name, 'w').write('file %s' % i)
+        salvus.files(names, depth=2)""")
+        m = conftest.message.execute_code(code=code, id=test_id)
+        sagews.send_json(m)
+
+        def ack(blob):
+            # the blob starts with its uuid; conftest decodes blobs in py3
+            file_uuid = blob[:36]
+            if isinstance(file_uuid, bytes):
+                file_uuid = file_uuid.decode()
+            sagews.send_json(conftest.message.save_blob(sha1=file_uuid))
+
+        # two blobs must arrive before we acknowledge any of them
+        blobs = []
+        while len(blobs) < 2:
+            typ, mesg = sagews.recv()
+            assert typ == 'blob'
+            blobs.append(mesg)
+        for blob in blobs:
+            ack(blob)
+        names = []
+        while True:
+            typ, mesg = sagews.recv()
+            if typ == 'blob':
+                ack(mesg)
+                continue
+            assert mesg['id'] == test_id
+            if 'file' in mesg:
+                names.append(mesg['file']['filename'])
+            if mesg.get('done'):
+                break
+        assert names == ['files-test-%s.txt' % i for i in range(5)]
@@ -342,3 +342,27 @@ class TestJuliaMode:
 
     def test_julia_version(self, exec2):
         exec2("%julia\nVERSION", pattern=r'^v"1\.2\.\d+"', timeout=40)
+
+
+class TestPerlMode:
+    def test_perl_state(self, exec2):
+        exec2('%perl\n$apple_count = 5;')
+        exec2('%perl\nprint "There are $apple_count apples.\\n";',
+              'There are 5 apples.\n')
+
+    def test_perl_error(self, exec2):
+        exec2('%perl\ndie "boom\\n";\nprint "not reached";', 'boom\n')
+
+    def test_perl_close(self, exec2):
+        exec2("interpreters.close('perl')")
+        exec2('%perl print "[$apple_count]";', '[]')
+
+
+class TestRubyMode:
+    def test_ruby_state(self, exec2):
+        exec2('%ruby\nlang = "ruby"\ndef greet(s) "Hello from #{s}!" end')
+        exec2('%ruby puts greet(lang)', 'Hello from ruby!\n')
+
+    def test_capture_ruby(self, exec2):
+        exec2("%capture(stdout='p')\n%ruby print greet(lang)")
+        exec2("print(p)", 'Hello from ruby!\n')